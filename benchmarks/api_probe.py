@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compares the cost of answering "is a game running?" and "what are the teams?"
+from the full allgamedata document against the narrow endpoints used by the
+probe mode of the api module, on recorded payloads.
+
+    python -m benchmarks.api_probe [--recording FOLDER] [--game-time SECONDS]
+"""
+# =================================================================
+# Imports
+# =================================================================
+import json
+import time
+import argparse
+import modules.game.api as api
+from benchmarks import payloads
+
+def full_game_active(bodies):
+    data = json.loads(bodies["/liveclientdata/allgamedata"])
+    return api.GameSnapshot(data).game_started()
+
+def probe_game_active(bodies):
+    return "gameTime" in json.loads(bodies["/liveclientdata/gamestats"])
+
+def full_teams(bodies):
+    snapshot = api.GameSnapshot(json.loads(bodies["/liveclientdata/allgamedata"]))
+    return snapshot.all_players, snapshot.enemies
+
+def probe_teams(bodies):
+    players = json.loads(bodies["/liveclientdata/playerlist"])
+    active_player_name = json.loads(bodies["/liveclientdata/activeplayername"])
+    return players, api.find_enemies(api.split_teams(players), active_player_name)
+
+def measure(function, bodies, iterations):
+    """
+    Returns the mean time of a call in seconds
+    """
+    start = time.perf_counter()
+    for i in range(iterations):
+        function(bodies)
+    return (time.perf_counter() - start) / iterations
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--recording', type=str, default=None,
+                        help="Folder of a recorded game, a synthetic game is used if not given")
+    parser.add_argument('--game-time', type=float, default=None,
+                        help="Game time to take the payloads at, defaults to the end of the game")
+    parser.add_argument('--iterations', type=int, default=2000)
+    arguments = parser.parse_args()
+
+    recording = payloads.load(arguments.recording)
+    bodies = recording.payloads(arguments.game_time)
+
+    # both paths have to agree before their speed means anything
+    assert full_game_active(bodies) == probe_game_active(bodies)
+    assert full_teams(bodies)[1] == probe_teams(bodies)[1]
+
+    full_bytes = len(bodies["/liveclientdata/allgamedata"])
+    print(f"allgamedata: {full_bytes} bytes, "
+          f"gamestats: {len(bodies['/liveclientdata/gamestats'])} bytes, "
+          f"playerlist: {len(bodies['/liveclientdata/playerlist'])} bytes")
+
+    comparisons = [
+        ("game active", full_game_active, probe_game_active),
+        ("teams", full_teams, probe_teams)
+    ]
+    for name, full, probe in comparisons:
+        full_time = measure(full, bodies, arguments.iterations)
+        probe_time = measure(probe, bodies, arguments.iterations)
+        print(f"{name:12} full {full_time * 1e6:9.1f}us   probe {probe_time * 1e6:9.1f}us   "
+              f"{full_time / probe_time:6.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the client pipeline of main.py without a running game.
+A replay server stands in for the live game API and a local relay server is
+started for the lobby. The pipeline of main.py (waiting for the game, joining
+the lobby, polling events and refreshing the labels on a fixed rate scheduler)
+runs headless against them, while a simulated teammate in the same lobby
+sends flashes. Both drive the FlashSync of main.py, so flashes travel as
+flash events in game time like between real clients.
+
+Reports the game API poll rate and latency, the CPU used by the client and
+the latency from a teammate sending a flash to the overlay showing it.
+With --asyncio the client runs its connection and the scheduler on one
+asyncio loop like main.py, otherwise on the threaded connection.
+
+    python -m benchmarks.client_bench --duration 20 --latency 0.002 --jitter 0.001
+"""
+# =================================================================
+# Imports
+# =================================================================
+import os
+import sys
+import time
+import heapq
+import random
+import argparse
+import itertools
+import subprocess
+import asyncio
+import statistics
+import modules.game.api as api
+from modules.game.flash_sync import FlashSync
+from modules.connection.server_connection import Server
+from modules.connection.async_connection import AsyncServer
+from modules.overlay.scheduler import Scheduler
+from benchmarks.utils import ROOT_PATH, free_port, wait_for_port, percentile
+
+class HeadlessRoot:
+    """
+    Runs after() callbacks like the tkinter event loop, without a window
+    """
+    def __init__(self):
+        self._queue = []
+        self._ids = itertools.count()
+        self._cancelled = set()
+        self._running = False
+
+    def after(self, ms, callback):
+        after_id = next(self._ids)
+        heapq.heappush(self._queue, (time.monotonic() + ms / 1000, after_id, callback))
+        return after_id
+
+    def after_idle(self, callback):
+        return self.after(0, callback)
+
+    def after_cancel(self, after_id):
+        self._cancelled.add(after_id)
+
+    def quit(self):
+        self._running = False
+
+    def winfo_exists(self):
+        return True
+
+    @property
+    def tk(self):
+        return self
+
+    def dooneevent(self, flags):
+        return 0
+
+    def mainloop(self):
+        self._running = True
+        while self._running and self._queue:
+            deadline, after_id, callback = heapq.heappop(self._queue)
+            if (after_id in self._cancelled):
+                self._cancelled.discard(after_id)
+                continue
+            delay = deadline - time.monotonic()
+            if (delay > 0):
+                time.sleep(delay)
+            callback()
+
+class Label:
+    """
+    Stand-in for an overlay Player that counts how often it would repaint
+    """
+    def __init__(self, champion):
+        self.champion = champion
+        self.text = "0"
+        self.repaints = 0
+
+    def set_text(self, time):
+        text = str(time)
+        if (text != self.text):
+            self.text = text
+            self.repaints += 1
+
+def start_process(arguments, cwd, port):
+    process = subprocess.Popen([sys.executable] + arguments, cwd=cwd,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(port)
+    return process
+
+def run(arguments):
+    rng = random.Random(arguments.seed)
+
+    # start the stand-ins for the game and the relay server
+    api_port = free_port()
+    relay_port = free_port()
+    replay = start_process(["-m", "benchmarks.replay_server", "--port", str(api_port),
+                            "--latency", str(arguments.latency), "--jitter", str(arguments.jitter),
+                            "--pregame", str(arguments.pregame), "--seed", str(arguments.seed)]
+                           + (["--recording", arguments.recording] if arguments.recording else []),
+                           ROOT_PATH, api_port)
+    relay = start_process(["server.py", "127.0.0.1", str(relay_port)],
+                          os.path.join(ROOT_PATH, "server"), relay_port)
+
+    try:
+        client = api.LiveClient(f"http://127.0.0.1:{api_port}", arguments.poll_interval,
+                                arguments.max_backoff)
+        root = HeadlessRoot()
+        loop = asyncio.new_event_loop() if arguments.asyncio else None
+        scheduler = Scheduler(root, loop)
+        flashes = FlashSync()
+        labels = []
+        # champion -> (time the teammate sent its flash, expiry shown before it)
+        sent = {}
+        latencies = []
+
+        if (loop is not None):
+            server = AsyncServer("127.0.0.1", relay_port, flashes.on_message, loop=loop)
+            server.start()
+        else:
+            server = Server("127.0.0.1", relay_port)
+            server.start_listening(flashes.on_message)
+        flashes.server = server
+        teammate = Server("127.0.0.1", relay_port)
+        teammate.start_listening(lambda message: None)
+        teammate_flashes = FlashSync(teammate)
+
+        def refresh_overlay():
+            cooldowns = flashes.cooldowns
+            now = cooldowns.clock()
+            for label in labels:
+                label.set_text(cooldowns.remaining_seconds(label.champion, now))
+
+            # a flash has reached the overlay once the tick renders its expiry
+            for champion, (sent_at, previous_expiry) in list(sent.items()):
+                if (cooldowns.expiry(champion) != previous_expiry):
+                    latencies.append(time.monotonic() - sent_at)
+                    del sent[champion]
+
+        def sync_game_clock():
+            flashes.game_clock.sync(client.game_stats()["gameTime"])
+            flashes.update_haste(client.player_list())
+
+        def send_flash():
+            champion = rng.choice(sorted(flashes.enemies))
+            if (champion not in sent):
+                sent[champion] = (time.monotonic(), flashes.cooldowns.expiry(champion))
+                teammate_flashes.flash(champion)
+
+        def on_game_start():
+            snapshot = client.snapshot()
+            lobby_id = "".join(player.replace(" ", "") for player in snapshot.players)
+            # the asyncio client can not block the loop it runs on, so the
+            # teammate creates the lobby and the client joins in the background
+            teammate.create_lobby(lobby_id).result(5)
+            joined = server.join_lobby(lobby_id)
+            if (loop is None):
+                joined.result(5)
+
+            # the teammate is in the same game, so it sees the same enemies
+            # and the same game time
+            sync_game_clock()
+            teammate_flashes.game_clock.sync(flashes.game_clock())
+            teammate_flashes.add_enemies(snapshot)
+            for champion in flashes.add_enemies(snapshot):
+                labels.append(Label(champion))
+
+            events = client.events()
+            scheduler.at_rate(arguments.fps, refresh_overlay)
+            scheduler.every(arguments.clock_sync_interval, sync_game_clock, "sync_game_clock")
+            scheduler.every(arguments.poll_interval, events.poll, "poll_events")
+            scheduler.every(arguments.flash_interval, send_flash)
+
+        def wait_for_game():
+            if (client.live_game_active()):
+                on_game_start()
+            else:
+                scheduler.after(client.poll_delay(), wait_for_game)
+
+        wait_for_game()
+        scheduler.after(arguments.duration, scheduler.stop)
+
+        wall_start = time.monotonic()
+        cpu_start = time.process_time()
+        scheduler.run()
+        wall_time = time.monotonic() - wall_start
+        cpu_time = time.process_time() - cpu_start
+        if (loop is not None):
+            loop.run_until_complete(server.close())
+    finally:
+        replay.terminate()
+        relay.terminate()
+
+    print(f"duration:        {wall_time:.1f}s")
+    print(f"client cpu:      {cpu_time:.2f}s ({cpu_time / wall_time * 100:.1f}% of one core)")
+    print(f"game api:        {client.stats.requests / wall_time:.1f} requests/s, {client.stats}")
+    print(f"label repaints:  {sum(label.repaints for label in labels)}")
+    for name, stats in scheduler.stats().items():
+        print(f"{name + ':':17}{stats}")
+    if (latencies):
+        print(f"flash to overlay: {len(latencies)} flashes, "
+              f"p50 {percentile(latencies, 0.5) * 1000:.1f}ms, "
+              f"p99 {percentile(latencies, 0.99) * 1000:.1f}ms, "
+              f"mean {statistics.mean(latencies) * 1000:.1f}ms")
+    else:
+        print("flash to overlay: no flashes reached the overlay")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=float, default=20, help="Seconds to run for")
+    parser.add_argument('--recording', type=str, default=None,
+                        help="Folder of a recorded game, a synthetic game is used if not given")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help="Latency of the game API")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Jitter of the game API")
+    parser.add_argument('--pregame', type=float, default=1.0,
+                        help="Seconds before the replayed game starts")
+    parser.add_argument('--fps', type=float, default=30)
+    parser.add_argument('--poll-interval', type=float, default=api.POLL_INTERVAL)
+    parser.add_argument('--max-backoff', type=float, default=api.MAX_BACKOFF)
+    parser.add_argument('--flash-interval', type=float, default=0.5,
+                        help="Seconds between flashes sent by the teammate")
+    parser.add_argument('--clock-sync-interval', type=float, default=10,
+                        help="Seconds between syncs of the game clock with the game API")
+    parser.add_argument('--asyncio', action='store_true',
+                        help="Run the client on the asyncio connection and loop like main.py")
+    run(parser.parse_args())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for Data Dragon, the static data CDN of League of Legends.
+Serves the version list, the champion data and a small png for every
+champion, with ETags that answer conditional requests with 304. Icons can be
+changed, broken (404) or made flaky (503 on every other request) to exercise
+the icon sync of icon_downloader.py.
+
+--check syncs against the stand-in and checks that icons of a known version
+are skipped, that a new version only rewrites the changed icons, that icons
+whose file no longer has the recorded hash are downloaded again, and that
+failures are reported.
+
+    python -m benchmarks.ddragon_server --port 8000
+    python icon_downloader.py --cdn-url http://127.0.0.1:8000 --res-path /tmp/icons
+    python -m benchmarks.ddragon_server --check
+"""
+# =================================================================
+# Imports
+# =================================================================
+import os
+import sys
+import json
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from benchmarks.utils import ROOT_PATH
+import icon_downloader
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# champion id -> champion name, with names that are not valid file names as is
+CHAMPIONS = {
+    "Aatrox": "Aatrox",
+    "Chogath": "Cho'Gath",
+    "MasterYi": "Master Yi",
+    "Nunu": "Nunu & Willump",
+    "Broken": "Broken",
+    "Flaky": "Flaky",
+}
+
+class DataDragonServer:
+    """
+    Serves the champions on the given address from a background thread.
+    versions is newest first. Icons of the champion ids in changed get new
+    content, those in broken answer 404 and those in flaky answer 503 on
+    every other request. requests records (path, status) of every request.
+    """
+    def __init__(self, champions=CHAMPIONS, versions=("13.1.1",), host="127.0.0.1", port=0,
+                 broken=("Broken",), flaky=("Flaky",)):
+        self.champions = champions
+        self.versions = list(versions)
+        self.changed = set()
+        self.broken = set(broken)
+        self.flaky = set(flaky)
+        self.requests = []
+        self._flaky_requests = 0
+        self._lock = threading.Lock()
+
+        cdn = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body are written separately, which nagle and delayed
+            # acks would otherwise hold back for ~40ms on a kept alive connection
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                cdn._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def icon_requests(self):
+        """
+        Returns the (path, status) of every icon requested so far
+        """
+        with self._lock:
+            return [request for request in self.requests if request[0].endswith(".png")]
+
+    def icon(self, champion_id):
+        """
+        Returns the png served for the champion
+        """
+        suffix = b"-changed" if champion_id in self.changed else b""
+        return PNG_SIGNATURE + champion_id.encode() + suffix
+
+    def _response(self, path, etag):
+        if (path == "/api/versions.json"):
+            return 200, json.dumps(self.versions).encode(), {}
+        if (path.endswith("/champion.json")):
+            data = {champion_id: {"id": champion_id, "name": name,
+                                  "image": {"full": f"{champion_id}.png"}}
+                    for champion_id, name in self.champions.items()}
+            return 200, json.dumps({"data": data}).encode(), {}
+        if not (path.endswith(".png")):
+            return 404, b"", {}
+
+        champion_id = os.path.basename(path)[:-len(".png")]
+        if (champion_id not in self.champions or champion_id in self.broken):
+            return 404, b"", {}
+        if (champion_id in self.flaky):
+            with self._lock:
+                self._flaky_requests += 1
+                if (self._flaky_requests % 2):
+                    return 503, b"", {}
+
+        body = self.icon(champion_id)
+        headers = {"ETag": f'"{hashlib.md5(body).hexdigest()}"', "Content-Type": "image/png",
+                   "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"}
+        if (etag == headers["ETag"]):
+            return 304, b"", headers
+        return 200, body, headers
+
+    def _handle(self, request):
+        status, body, headers = self._response(request.path,
+                                               request.headers.get("If-None-Match"))
+        with self._lock:
+            self.requests.append((request.path, status))
+
+        request.send_response(status)
+        for name, value in headers.items():
+            request.send_header(name, value)
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+def expect(condition, description):
+    print(f"{'ok' if condition else 'FAILED':6} {description}")
+    return condition
+
+def check():
+    """
+    Runs the sync scenarios against a stand-in, returns True if all passed
+    """
+    cdn = DataDragonServer().start()
+    passed = True
+    try:
+        with tempfile.TemporaryDirectory() as res_path:
+            def sync(**kwargs):
+                del cdn.requests[:]
+                return icon_downloader.sync_icons(res_path, cdn_url=cdn.url, workers=4, **kwargs)
+
+            result = sync()
+            expected = sorted(set(CHAMPIONS.values()) - {"Broken"})
+            passed &= expect(sorted(result.downloaded) == expected,
+                             f"first sync downloads every icon, flaky ones after a retry: {result}")
+            passed &= expect(os.path.exists(os.path.join(res_path, "Cho'Gath.png")),
+                             "icons are saved under the champion name")
+            passed &= expect(result.failures == {"Broken": "HTTP 404"},
+                             f"broken icons are reported: {result.failures}")
+
+            result = sync()
+            passed &= expect([path for path, status in cdn.icon_requests()]
+                             == ["/cdn/13.1.1/img/champion/Broken.png"],
+                             "icons of a synced version are skipped without a request, "
+                             "only the failed icon is tried again")
+
+            cdn.versions.insert(0, "13.2.1")
+            cdn.changed.add("Aatrox")
+            result = sync()
+            not_modified = [path for path, status in cdn.icon_requests() if status == 304]
+            passed &= expect(result.downloaded == ["Aatrox"],
+                             f"a new version only rewrites the changed icon: {result}")
+            passed &= expect(len(not_modified) == len(CHAMPIONS) - 2,
+                             f"unchanged icons of a new version are answered with 304: "
+                             f"{len(not_modified)} not modified")
+
+            with open(os.path.join(res_path, "Master Yi.png"), "wb") as icon_file:
+                icon_file.write(b"not the icon")
+            result = sync()
+            with open(os.path.join(res_path, "Master Yi.png"), "rb") as icon_file:
+                content = icon_file.read()
+            passed &= expect(result.downloaded == ["Master Yi"] and content == cdn.icon("MasterYi"),
+                             f"an icon whose hash no longer matches the manifest is downloaded "
+                             f"again: {result}")
+
+            # the command line reports failures and exits with an error
+            process = subprocess.run([sys.executable, "icon_downloader.py", "--cdn-url", cdn.url,
+                                      "--res-path", res_path], cwd=ROOT_PATH,
+                                     capture_output=True, text=True)
+            passed &= expect(process.returncode == 1
+                             and "failed Broken: HTTP 404" in process.stdout,
+                             f"icon_downloader.py exits with 1 and names the failed icon "
+                             f"(exit code {process.returncode})")
+    finally:
+        cdn.stop()
+    return passed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--check', action='store_true',
+                        help="Check the icon sync against the stand-in and exit")
+    arguments = parser.parse_args()
+
+    if (arguments.check):
+        sys.exit(0 if check() else 1)
+
+    server = DataDragonServer(host=arguments.host, port=arguments.port)
+    print(f"Serving Data Dragon on {server.url}")
+    server.httpd.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Recorded live client API payloads for benchmarking without a running game.
+
+A recording is a single allgamedata document taken at the end of a game.
+Every other endpoint, and the state of the game at any earlier time, is
+derived from it, so the payloads always agree with each other.
+
+Record the current game to a folder with:
+    python -m benchmarks.payloads record benchmarks/recordings/my_game
+
+When no recording is given, a synthetic game is generated from a seed, which
+has the same shape and roughly the same size as a real one.
+"""
+# =================================================================
+# Imports
+# =================================================================
+import os
+import sys
+import json
+import copy
+import random
+
+# =================================================================
+# Constants
+# =================================================================
+RECORDING_FILE = "allgamedata.json"
+DEFAULT_GAME_LENGTH = 1800
+CHAMPIONS = [
+    "Ahri", "Annie", "Ashe", "Azir", "Braum", "Caitlyn", "Darius", "Ezreal",
+    "Garen", "Jinx", "Leona", "Lux", "Malphite", "Nami", "Orianna", "Riven",
+    "Sett", "Thresh", "Vayne", "Yasuo", "Zed", "Zyra"
+]
+POSITIONS = ["TOP", "JUNGLE", "MIDDLE", "BOTTOM", "UTILITY"]
+
+class GameRecording:
+    """
+    Serves the payloads of every live client API endpoint for a recorded game,
+    as they would have looked at any game time up to the end of the recording.
+    """
+    def __init__(self, allgamedata):
+        self.data = allgamedata
+        self.events = allgamedata["events"]["Events"]
+        self.length = allgamedata["gameData"]["gameTime"]
+
+    def events_at(self, game_time):
+        return [event for event in self.events if event["EventTime"] <= game_time]
+
+    def allgamedata(self, game_time):
+        data = copy.copy(self.data)
+        data["events"] = {"Events": self.events_at(game_time)}
+        data["gameData"] = dict(self.data["gameData"], gameTime=game_time)
+        return data
+
+    def eventdata(self, game_time, event_id=0):
+        return {"Events": [event for event in self.events_at(game_time)
+                           if event["EventID"] >= event_id]}
+
+    def gamestats(self, game_time):
+        return dict(self.data["gameData"], gameTime=game_time)
+
+    def playerlist(self):
+        return self.data["allPlayers"]
+
+    def activeplayername(self):
+        return self.data["activePlayer"]["summonerName"]
+
+    def payloads(self, game_time=None):
+        """
+        Returns the encoded response body of every endpoint by path
+        """
+        if (game_time is None):
+            game_time = self.length
+        return {
+            "/liveclientdata/allgamedata": json.dumps(self.allgamedata(game_time)).encode(),
+            "/liveclientdata/eventdata": json.dumps(self.eventdata(game_time)).encode(),
+            "/liveclientdata/gamestats": json.dumps(self.gamestats(game_time)).encode(),
+            "/liveclientdata/playerlist": json.dumps(self.playerlist()).encode(),
+            "/liveclientdata/activeplayername": json.dumps(self.activeplayername()).encode()
+        }
+
+def load(path=None, seed=0):
+    """
+    Loads the recording in the given folder, or generates a synthetic game
+    from the seed if no folder is given
+    """
+    if (path is None):
+        return GameRecording(synthetic_game(seed))
+    with open(os.path.join(path, RECORDING_FILE)) as recording_file:
+        return GameRecording(json.load(recording_file))
+
+def record(path, client=None):
+    """
+    Saves the allgamedata of the game that is currently running to the folder
+    """
+    if (client is None):
+        import modules.game.api as api
+        client = api.client
+    os.makedirs(path, exist_ok=True)
+    data = client.call_api().json()
+    with open(os.path.join(path, RECORDING_FILE), "w") as recording_file:
+        json.dump(data, recording_file)
+    return data
+
+def synthetic_game(seed=0, length=DEFAULT_GAME_LENGTH):
+    """
+    Generates the allgamedata document of a full game
+    """
+    rng = random.Random(seed)
+    champions = rng.sample(CHAMPIONS, 10)
+    players = [_player(rng, i, champion) for i, champion in enumerate(champions)]
+
+    events = [{"EventID": 0, "EventName": "GameStart", "EventTime": 0.05}]
+    game_time = 90.0
+    while game_time < length:
+        killer, victim = rng.sample(players, 2)
+        events.append({
+            "EventID": len(events),
+            "EventName": "ChampionKill",
+            "EventTime": round(game_time, 3),
+            "KillerName": killer["summonerName"],
+            "VictimName": victim["summonerName"],
+            "Assisters": [player["summonerName"] for player in rng.sample(players, 2)]
+        })
+        game_time += rng.expovariate(1 / 25)
+    events.append({"EventID": len(events), "EventName": "GameEnd",
+                   "EventTime": float(length), "Result": "Win"})
+
+    return {
+        "activePlayer": _active_player(rng, players[0]),
+        "allPlayers": players,
+        "events": {"Events": events},
+        "gameData": {
+            "gameMode": "CLASSIC",
+            "gameTime": float(length),
+            "mapName": "Map11",
+            "mapNumber": 11,
+            "mapTerrain": "Default"
+        }
+    }
+
+def _player(rng, index, champion):
+    return {
+        "championName": champion,
+        "isBot": False,
+        "isDead": False,
+        "items": [_item(rng, slot) for slot in range(rng.randint(3, 7))],
+        "level": rng.randint(10, 18),
+        "position": POSITIONS[index % 5],
+        "rawChampionName": f"game_character_displayname_{champion}",
+        "respawnTimer": 0.0,
+        "runes": {
+            "keystone": _rune(rng, "Keystone"),
+            "primaryRuneTree": _rune(rng, "Tree"),
+            "secondaryRuneTree": _rune(rng, "Tree")
+        },
+        "scores": {
+            "assists": rng.randint(0, 20),
+            "creepScore": rng.randint(0, 300),
+            "deaths": rng.randint(0, 12),
+            "kills": rng.randint(0, 15),
+            "wardScore": rng.uniform(0, 60)
+        },
+        "skinID": 0,
+        "summonerName": f"Summoner {index}",
+        "summonerSpells": {
+            "summonerSpellOne": _spell("Flash"),
+            "summonerSpellTwo": _spell(rng.choice(["Ignite", "Teleport", "Heal", "Smite"]))
+        },
+        "team": "ORDER" if index < 5 else "CHAOS"
+    }
+
+def _item(rng, slot):
+    item_id = rng.randint(1001, 6700)
+    return {
+        "canUse": False,
+        "consumable": False,
+        "count": 1,
+        "displayName": f"Item {item_id}",
+        "itemID": item_id,
+        "price": rng.randint(300, 3400),
+        "rawDescription": f"GeneratedTip_Item_{item_id}_Description",
+        "rawDisplayName": f"Item_{item_id}_Name",
+        "slot": slot
+    }
+
+def _rune(rng, kind):
+    rune_id = rng.randint(8000, 9200)
+    return {
+        "displayName": f"{kind} {rune_id}",
+        "id": rune_id,
+        "rawDescription": f"perk_tooltip_{rune_id}",
+        "rawDisplayName": f"perk_displayname_{rune_id}"
+    }
+
+def _spell(name):
+    return {
+        "displayName": name,
+        "rawDescription": f"GeneratedTip_SummonerSpell_Summoner{name}_Description",
+        "rawDisplayName": f"GeneratedTip_SummonerSpell_Summoner{name}_DisplayName"
+    }
+
+def _active_player(rng, player):
+    stats = ["abilityPower", "armor", "armorPenetrationFlat", "attackDamage",
+             "attackRange", "attackSpeed", "critChance", "currentHealth",
+             "healthRegenRate", "lifeSteal", "magicResist", "maxHealth",
+             "moveSpeed", "resourceMax", "resourceValue", "spellVamp", "tenacity"]
+    return {
+        "abilities": {key: {"abilityLevel": rng.randint(1, 5), "displayName": key}
+                      for key in ["Passive", "Q", "W", "E", "R"]},
+        "championStats": {stat: rng.uniform(0, 500) for stat in stats},
+        "currentGold": rng.uniform(0, 3000),
+        "fullRunes": {
+            "generalRunes": [_rune(rng, "Rune") for i in range(6)],
+            "keystone": player["runes"]["keystone"],
+            "primaryRuneTree": player["runes"]["primaryRuneTree"],
+            "secondaryRuneTree": player["runes"]["secondaryRuneTree"],
+            "statRunes": [_rune(rng, "Stat") for i in range(3)]
+        },
+        "level": player["level"],
+        "summonerName": player["summonerName"]
+    }
+
+if __name__ == "__main__":
+    if (len(sys.argv) == 3 and sys.argv[1] == "record"):
+        record(sys.argv[2])
+        print(f"Recorded game to {sys.argv[2]}")
+    else:
+        print("usage: python -m benchmarks.payloads record <folder>")
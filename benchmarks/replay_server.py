@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the League of Legends live client API.
+Serves a recorded (or synthetic) game over plain http, with configurable
+latency and jitter. The game clock starts when the server starts and runs at
+the given speed, so events appear as the game progresses.
+
+    python -m benchmarks.replay_server --port 2999 --latency 0.002 --jitter 0.001
+    python main.py --api-url http://127.0.0.1:2999
+"""
+# =================================================================
+# Imports
+# =================================================================
+import json
+import time
+import random
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from benchmarks import payloads
+
+class ReplayServer:
+    """
+    Serves the recording on the given address from a background thread.
+    pregame is the number of seconds before the game starts, during which
+    every endpoint answers 404 like the real API does in the loading screen.
+    """
+    def __init__(self, recording, host="127.0.0.1", port=0, latency=0.0, jitter=0.0,
+                 speed=1.0, start_time=0.0, pregame=0.0, seed=0):
+        self.recording = recording
+        self.latency = latency
+        self.jitter = jitter
+        self.speed = speed
+        self.start_time = start_time
+        self.pregame = pregame
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+
+        replay = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body are written separately, which nagle and delayed
+            # acks would otherwise hold back for ~40ms on a kept alive connection
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                replay._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_address[1]}"
+
+    def game_time(self):
+        """
+        Returns the current game time, or None before the game has started
+        """
+        elapsed = (time.monotonic() - self._started - self.pregame) * self.speed
+        if (elapsed < 0):
+            return None
+        return min(self.start_time + elapsed, self.recording.length)
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _delay(self):
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+        if (delay > 0):
+            time.sleep(delay)
+
+    def _body(self, path, query):
+        game_time = self.game_time()
+        if (game_time is None):
+            return None
+
+        if (path == "/liveclientdata/allgamedata"):
+            return self.recording.allgamedata(game_time)
+        elif (path == "/liveclientdata/eventdata"):
+            event_id = int(query.get("eventID", ["0"])[0])
+            return self.recording.eventdata(game_time, event_id)
+        elif (path == "/liveclientdata/gamestats"):
+            return self.recording.gamestats(game_time)
+        elif (path == "/liveclientdata/playerlist"):
+            return self.recording.playerlist()
+        elif (path == "/liveclientdata/activeplayername"):
+            return self.recording.activeplayername()
+        return None
+
+    def _handle(self, request):
+        self._delay()
+        url = urlparse(request.path)
+        body = self._body(url.path, parse_qs(url.query))
+
+        if (body is None):
+            data = b'{"errorCode": "RESOURCE_NOT_FOUND", "httpStatus": 404}'
+            request.send_response(404)
+        else:
+            data = json.dumps(body).encode()
+            request.send_response(200)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=2999)
+    parser.add_argument('--recording', type=str, default=None,
+                        help="Folder of a recorded game, a synthetic game is used if not given")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic game and jitter")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Random seconds added or removed")
+    parser.add_argument('--speed', type=float, default=1.0, help="Game seconds per real second")
+    parser.add_argument('--start-time', type=float, default=0.0, help="Game time to start at")
+    parser.add_argument('--pregame', type=float, default=0.0,
+                        help="Seconds of loading screen before the game starts")
+    arguments = parser.parse_args()
+
+    server = ReplayServer(payloads.load(arguments.recording, arguments.seed),
+                          arguments.host, arguments.port, arguments.latency,
+                          arguments.jitter, arguments.speed, arguments.start_time,
+                          arguments.pregame, arguments.seed)
+    print(f"Replaying game on {server.url}")
+    server.httpd.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Load generator for the relay server.
+Opens a number of simulated clients over the framed protocol, groups them into
+lobbies of five through create_lobby and join_lobby, and has them broadcast at
+a steady rate with optional bursts where every lobby broadcasts at once.
+All simulated clients run on a single selector, so thousands of them can be
+driven from one process. Runs are reproducible from the seed.
+
+Reports broadcast throughput, the fan-out latency from a broadcast being sent
+to each lobby member receiving it, the latency of the acks, and the CPU and
+memory used by the server.
+
+    python -m benchmarks.server_load --clients 1000 --rate 0.5 --duration 20
+    python -m benchmarks.server_load --connect 127.0.0.1:3389   # an already running server
+"""
+# =================================================================
+# Imports
+# =================================================================
+import os
+import sys
+import time
+import heapq
+import random
+import socket
+import argparse
+import selectors
+import subprocess
+from benchmarks.utils import ROOT_PATH, free_port, wait_for_port, percentile
+from server.protocol import HANDSHAKE, FrameDecoder, FrameType, encode_frame
+
+LOBBY_SIZE = 5
+
+class SimulatedClient:
+    """
+    A single connection to the relay server speaking the framed protocol
+    """
+    def __init__(self, index, address, selector):
+        self.index = index
+        self.socket = socket.create_connection(address)
+        self.socket.setblocking(0)
+        self.selector = selector
+        self.decoder = FrameDecoder()
+        self.out_buffer = bytearray()
+        self.handshaken = False
+        self.handshake_buffer = b""
+        self.lobby = None
+        self.next_request_id = 1
+        self.pending = {} # request id -> (command, time sent)
+        selector.register(self.socket, selectors.EVENT_READ, self)
+        self._write(HANDSHAKE)
+
+    def send_command(self, command):
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        self.pending[request_id] = (command, time.monotonic())
+        self._write(encode_frame(FrameType.COMMAND, command, request_id))
+        return request_id
+
+    def _write(self, data):
+        self.out_buffer += data
+        self.flush()
+
+    def flush(self):
+        try:
+            sent = self.socket.send(self.out_buffer)
+            del self.out_buffer[:sent]
+        except BlockingIOError:
+            pass
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if self.out_buffer else 0)
+        if (self.selector.get_key(self.socket).events != events):
+            self.selector.modify(self.socket, events, self)
+
+    def read(self):
+        """
+        Returns a list of (frame_type, request_id, content) read from the server
+        """
+        try:
+            data = self.socket.recv(65536)
+        except BlockingIOError:
+            return []
+        if not (data):
+            raise ConnectionError(f"server closed client {self.index}")
+
+        if not (self.handshaken):
+            self.handshake_buffer += data
+            if (len(self.handshake_buffer) < len(HANDSHAKE)):
+                return []
+            if not (self.handshake_buffer.startswith(HANDSHAKE)):
+                raise ConnectionError("server does not speak the framed protocol")
+            self.handshaken = True
+            data = self.handshake_buffer[len(HANDSHAKE):]
+        return self.decoder.feed(data)
+
+class ServerMonitor:
+    """
+    Samples cpu time and memory of a server process and its worker processes
+    from /proc
+    """
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak_rss = 0
+        self._ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    def available(self):
+        return self.pid is not None and os.path.exists(f"/proc/{self.pid}/stat")
+
+    def cpu_time(self):
+        if not (self.available()):
+            return None
+        total = 0
+        for fields in self._stats().values():
+            total += int(fields[11]) + int(fields[12])
+        return total / self._ticks
+
+    def sample_memory(self):
+        if not (self.available()):
+            return None
+        rss = 0
+        for pid in self._stats():
+            try:
+                with open(f"/proc/{pid}/status") as status_file:
+                    for line in status_file:
+                        if (line.startswith("VmRSS:")):
+                            rss += int(line.split()[1]) * 1024
+            except OSError:
+                pass
+        self.peak_rss = max(self.peak_rss, rss)
+        return rss
+
+    # returns the fields of /proc/<pid>/stat after the process name for the
+    # server and every process it has started, by pid
+    def _stats(self):
+        stats = {}
+        for name in os.listdir("/proc"):
+            if not (name.isdigit()):
+                continue
+            try:
+                with open(f"/proc/{name}/stat") as stat_file:
+                    fields = stat_file.read().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            if (int(name) == self.pid or int(fields[1]) == self.pid):
+                stats[int(name)] = fields
+        return stats
+
+class LoadTest:
+    def __init__(self, address, arguments):
+        self.address = address
+        self.arguments = arguments
+        self.rng = random.Random(arguments.seed)
+        self.selector = selectors.DefaultSelector()
+        self.clients = []
+        self.lobbies = []
+
+        self.sent = {} # broadcast payload -> (time sent, number of recipients)
+        self.fan_out_latencies = []
+        self.ack_latencies = []
+        self.broadcasts_sent = 0
+        self.broadcasts_acked = 0
+        self.deliveries = 0
+        self.expected_deliveries = 0
+        self.failed_commands = 0
+        self.sequence = 0
+
+    def connect(self):
+        for i in range(self.arguments.clients):
+            self.clients.append(SimulatedClient(i, self.address, self.selector))
+            # let the server keep up with the accepts on large runs
+            if (i % 500 == 499):
+                self._pump(0)
+        self._pump_until(lambda: all(client.handshaken for client in self.clients))
+
+    def setup_lobbies(self):
+        # the first client of every group creates the lobby, the rest join it
+        groups = [self.clients[i:i + LOBBY_SIZE] for i in range(0, len(self.clients), LOBBY_SIZE)]
+        for number, group in enumerate(groups):
+            lobby_id = f"load-{self.arguments.seed}-{number}"
+            group[0].send_command(f"create_lobby {lobby_id}")
+            for client in group:
+                client.lobby = lobby_id
+            self.lobbies.append(group)
+        self._pump_until(lambda: not any(client.pending for client in self.clients))
+
+        for group in self.lobbies:
+            for client in group[1:]:
+                client.send_command(f"join_lobby {client.lobby}")
+        self._pump_until(lambda: not any(client.pending for client in self.clients))
+
+        # setup responses do not count towards the results
+        self.ack_latencies.clear()
+        if (self.failed_commands):
+            raise RuntimeError(f"{self.failed_commands} lobby commands failed, "
+                               "is the server already holding lobbies with these ids?")
+
+    def _broadcast(self, client):
+        self.sequence += 1
+        payload = f"b{self.sequence}"
+        recipients = len(self.lobbies[client.index // LOBBY_SIZE]) - 1
+        self.sent[payload] = (time.monotonic(), recipients)
+        self.expected_deliveries += recipients
+        self.broadcasts_sent += 1
+        client.send_command(f"lobby_broadcast {payload}")
+
+    def broadcast_phase(self):
+        arguments = self.arguments
+        start = time.monotonic()
+        end = start + arguments.duration
+
+        # every lobby broadcasts as a poisson process of the given rate
+        timers = []
+        if (arguments.rate > 0):
+            for number in range(len(self.lobbies)):
+                timers.append((start + self.rng.expovariate(arguments.rate), number, "steady"))
+        if (arguments.burst_interval > 0):
+            timers.append((start + arguments.burst_interval, -1, "burst"))
+        heapq.heapify(timers)
+
+        while True:
+            now = time.monotonic()
+            while timers and timers[0][0] <= now and timers[0][0] < end:
+                due, number, kind = heapq.heappop(timers)
+                if (kind == "steady"):
+                    self._broadcast(self.rng.choice(self.lobbies[number]))
+                    heapq.heappush(timers, (due + self.rng.expovariate(arguments.rate), number, kind))
+                else:
+                    for group in self.lobbies:
+                        for i in range(arguments.burst_size):
+                            self._broadcast(self.rng.choice(group))
+                    heapq.heappush(timers, (due + arguments.burst_interval, number, kind))
+            if (now >= end):
+                break
+            self._pump(min(timers[0][0] - now if timers else end - now, end - now))
+
+        # give the last broadcasts time to arrive
+        self._pump_until(lambda: self.deliveries >= self.expected_deliveries
+                         and self.broadcasts_acked >= self.broadcasts_sent, timeout=5)
+        return time.monotonic() - start
+
+    def _pump_until(self, condition, timeout=30):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if (time.monotonic() > deadline):
+                raise TimeoutError("server did not answer in time")
+            self._pump(0.05)
+
+    def _pump(self, timeout):
+        for key, mask in self.selector.select(max(timeout, 0)):
+            client = key.data
+            if (mask & selectors.EVENT_WRITE):
+                client.flush()
+            if (mask & selectors.EVENT_READ):
+                for frame in client.read():
+                    self._on_frame(client, *frame)
+
+    def _on_frame(self, client, frame_type, request_id, content):
+        now = time.monotonic()
+        if (frame_type == FrameType.RESPONSE):
+            command, sent_at = client.pending.pop(request_id, (None, now))
+            self.ack_latencies.append(now - sent_at)
+            if (content is not True and command is not None
+                    and not command.startswith("lobby_list")):
+                self.failed_commands += 1
+            if (command is not None and command.startswith("lobby_broadcast")):
+                self.broadcasts_acked += 1
+
+        elif (frame_type == FrameType.MESSAGE and content in self.sent):
+            sent_at, recipients = self.sent[content]
+            self.fan_out_latencies.append(now - sent_at)
+            self.deliveries += 1
+            if (recipients <= 1):
+                del self.sent[content]
+            else:
+                self.sent[content] = (sent_at, recipients - 1)
+
+def raise_file_limit(clients):
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        wanted = min(hard, clients * 2 + 100)
+        if (soft < wanted):
+            resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=500, help="Number of simulated clients")
+    parser.add_argument('--duration', type=float, default=20, help="Seconds of broadcasting")
+    parser.add_argument('--rate', type=float, default=0.2,
+                        help="Broadcasts per second per lobby")
+    parser.add_argument('--burst-interval', type=float, default=0,
+                        help="Seconds between bursts where every lobby broadcasts at once, 0 for none")
+    parser.add_argument('--burst-size', type=int, default=5,
+                        help="Broadcasts per lobby in every burst")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--connect', type=str, default=None,
+                        help="host:port of a running server, a local server is started if not given")
+    parser.add_argument('--server-args', type=str, default="",
+                        help="Extra arguments for the started server")
+    arguments = parser.parse_args()
+
+    raise_file_limit(arguments.clients)
+    process = None
+    if (arguments.connect):
+        host, port = arguments.connect.rsplit(":", 1)
+        address = (host, int(port))
+    else:
+        address = ("127.0.0.1", free_port())
+        process = subprocess.Popen([sys.executable, "server.py", address[0], str(address[1])]
+                                   + arguments.server_args.split(),
+                                   cwd=os.path.join(ROOT_PATH, "server"),
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_for_port(address[1])
+
+    monitor = ServerMonitor(process.pid if process else None)
+    try:
+        test = LoadTest(address, arguments)
+        test.connect()
+        test.setup_lobbies()
+        monitor.sample_memory()
+        cpu_start = monitor.cpu_time()
+        duration = test.broadcast_phase()
+        cpu_end = monitor.cpu_time()
+        monitor.sample_memory()
+    finally:
+        if (process):
+            process.terminate()
+
+    print(f"clients:          {len(test.clients)} in {len(test.lobbies)} lobbies")
+    print(f"broadcasts:       {test.broadcasts_sent} sent, {test.broadcasts_acked} acked "
+          f"in {duration:.1f}s ({test.broadcasts_acked / duration:.1f}/s)")
+    print(f"deliveries:       {test.deliveries}/{test.expected_deliveries} "
+          f"({test.deliveries / duration:.1f}/s)")
+    print(f"fan-out latency:  p50 {percentile(test.fan_out_latencies, 0.5) * 1000:.2f}ms, "
+          f"p99 {percentile(test.fan_out_latencies, 0.99) * 1000:.2f}ms, "
+          f"max {max(test.fan_out_latencies, default=0) * 1000:.2f}ms")
+    print(f"ack latency:      p50 {percentile(test.ack_latencies, 0.5) * 1000:.2f}ms, "
+          f"p99 {percentile(test.ack_latencies, 0.99) * 1000:.2f}ms")
+    if (cpu_start is not None and cpu_end is not None):
+        print(f"server cpu:       {cpu_end - cpu_start:.2f}s "
+              f"({(cpu_end - cpu_start) / duration * 100:.1f}% of one core)")
+        print(f"server memory:    {monitor.peak_rss / 1024 / 1024:.1f}MiB peak rss")
+    else:
+        print("server cpu:       not available for an external server")
+
+if __name__ == "__main__":
+    main()
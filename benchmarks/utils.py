@@ -0,0 +1,31 @@
+# Helpers shared by the benchmarks for starting local servers and
+# summarising the results.
+import os
+import time
+import socket
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# returns a port that is free to listen on
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+# blocks until something accepts connections on the port
+def wait_for_port(port, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"nothing is listening on port {port}")
+
+# returns the value below which the given fraction of values fall
+def percentile(values, fraction):
+    if not (values):
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
@@ -1,172 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Syncs the champion icons of the overlay with Data Dragon, the static data CDN
+of League of Legends.
+The champions and their icon files are read from the champion data of the
+Data Dragon version, so every champion is found under its own name, e.g. the
+icon of Cho'Gath is downloaded from Chogath.png and saved as Cho'Gath.png.
+
+Icons are downloaded in parallel over a pooled session. A manifest in the
+resource folder records the version and the ETag, Last-Modified and hash of
+every icon. Icons of the same version are skipped without a request, icons of
+a new version are requested conditionally, and files are only written when
+their content changed. Icons that could not be synced are reported and
+retried on the next run.
+
+    python icon_downloader.py
+    python icon_downloader.py --version 12.10.1 --workers 16 --build-atlas
+"""
+# =================================================================
+# Imports
+# =================================================================
+import os
+import re
+import sys
+import json
+import hashlib
+import argparse
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# =================================================================
+# Constants
+# =================================================================
+CDN_URL = "https://ddragon.leagueoflegends.com"
+RES_PATH = "modules/overlay/res"
+LANGUAGE = "en_US"
+MANIFEST_NAME = "manifest.json"
+DEFAULT_WORKERS = 8
+TIMEOUT = 10
+RETRIES = 3
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# characters that can not be part of a file name on windows
+INVALID_FILENAME_CHARACTERS = re.compile(r'[<>:"/\\|?*]')
+
+class SyncError(Exception):
+    """
+    Raised when an icon can not be synced
+    """
+
+class SyncResult:
+    """
+    Outcome of a sync. Icons are counted as downloaded when their file was
+    written, and as unchanged when they were skipped or the server had
+    nothing new. failures maps champion names to the reason they failed.
+    """
+    def __init__(self, version):
+        self.version = version
+        self.downloaded = []
+        self.unchanged = []
+        self.failures = {}
+
+    def __str__(self):
+        return (f"version {self.version}: {len(self.downloaded)} downloaded, "
+                f"{len(self.unchanged)} unchanged, {len(self.failures)} failed")
+
+def create_session(workers=DEFAULT_WORKERS):
+    """
+    Returns a session that keeps a connection open for every worker and
+    retries failed requests with backoff
+    """
+    session = requests.Session()
+    retry = Retry(total=RETRIES, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def latest_version(session, cdn_url=CDN_URL):
+    """
+    Returns the newest Data Dragon version
+    """
+    response = session.get(f"{cdn_url}/api/versions.json", timeout=TIMEOUT)
+    response.raise_for_status()
+    return response.json()[0]
+
+def champion_icons(session, version, cdn_url=CDN_URL):
+    """
+    Returns the url of the icon of every champion in the version by champion name
+    """
+    response = session.get(f"{cdn_url}/cdn/{version}/data/{LANGUAGE}/champion.json",
+                           timeout=TIMEOUT)
+    response.raise_for_status()
+    return {champion["name"]: f"{cdn_url}/cdn/{version}/img/champion/{champion['image']['full']}"
+            for champion in response.json()["data"].values()}
+
+def icon_filename(champion):
+    """
+    Returns the name of the icon file of the champion in the resource folder
+    """
+    return INVALID_FILENAME_CHARACTERS.sub("", champion) + ".png"
+
+def load_manifest(path):
+    """
+    Returns the manifest at path, or an empty manifest if there is none
+    """
+    try:
+        with open(path) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return {"version": None, "icons": {}}
+    manifest.setdefault("icons", {})
+    return manifest
+
+def write_file(path, data, mode="wb"):
+    """
+    Replaces the file at path in one step, so an interrupted run never leaves
+    half a file behind
+    """
+    temporary_path = path + ".part"
+    with open(temporary_path, mode) as temporary_file:
+        temporary_file.write(data)
+    os.replace(temporary_path, path)
 
-URL = "http://ddragon.leagueoflegends.com/cdn/12.10.1/img/champion/"
-
-CHAMPS = [
-    "Aatrox",
-    "Ahri",
-    "Akali",
-    "Alistar",
-    "Amumu",
-    "Anivia",
-    "Annie",
-    "Aphelios",
-    "Ashe",
-    "AurelionSol",
-    "Azir",
-    "Bard",
-    "Blitzcrank",
-    "Brand",
-    "Braum",
-    "Caitlyn",
-    "Camille",
-    "Cassiopeia",
-    "Cho'Gath",
-    "Corki",
-    "Darius",
-    "Diana",
-    "Dr. Mundo",
-    "Draven",
-    "Ekko",
-    "Elise",
-    "Evelynn",
-    "Ezreal",
-    "Fiddlesticks",
-    "Fiora",
-    "Fizz",
-    "Galio",
-    "Gangplank",
-    "Garen",
-    "Gnar",
-    "Gragas",
-    "Graves",
-    "Hecarim",
-    "Heimerdinger",
-    "Illaoi",
-    "Irelia",
-    "Ivern",
-    "Janna",
-    "JarvanIV",
-    "Jax",
-    "Jayce",
-    "Jhin",
-    "Jinx",
-    "Kai'Sa",
-    "Kalista",
-    "Karma",
-    "Karthus",
-    "Kassadin",
-    "Katarina",
-    "Kayle",
-    "Kayn",
-    "Kennen",
-    "Kha'Zix",
-    "Kindred",
-    "Kled",
-    "Kog'Maw",
-    "LeBlanc",
-    "LeeSin",
-    "Leona",
-    "Lillia",
-    "Lissandra",
-    "Lucian",
-    "Lulu",
-    "Lux",
-    "Malphite",
-    "Malzahar",
-    "Maokai",
-    "Master Yi",
-    "MissFortune",
-    "Mordekaiser",
-    "Morgana",
-    "Nami",
-    "Nasus",
-    "Nautilus",
-    "Neeko",
-    "Nidalee",
-    "Nocturne",
-    "NunuandWillump",
-    "Olaf",
-    "Orianna",
-    "Ornn",
-    "Pantheon",
-    "Poppy",
-    "Pyke",
-    "Qiyana",
-    "Quinn",
-    "Rakan",
-    "Rammus",
-    "Rek'Sai",
-    "Rell",
-    "Renekton",
-    "Rengar",
-    "Riven",
-    "Rumble",
-    "Ryze",
-    "Samira",
-    "Sejuani",
-    "Senna",
-    "Seraphine",
-    "Sett",
-    "Shaco",
-    "Shen",
-    "Shyvana",
-    "Singed",
-    "Sion",
-    "Sivir",
-    "Skarner",
-    "Sona",
-    "Soraka",
-    "Swain",
-    "Sylas",
-    "Syndra",
-    "TahmKench",
-    "Taliyah",
-    "Talon",
-    "Taric",
-    "Teemo",
-    "Thresh",
-    "Tristana",
-    "Trundle",
-    "Tryndamere",
-    "TwistedFate",
-    "Twitch",
-    "Udyr",
-    "Urgot",
-    "Varus",
-    "Vayne",
-    "Veigar",
-    "Vel'Koz",
-    "Vi",
-    "Viktor",
-    "Vladimir",
-    "Volibear",
-    "Warwick",
-    "Wukong",
-    "Xayah",
-    "Xerath",
-    "Xin Zhao",
-    "Yasuo",
-    "Yone",
-    "Yorick",
-    "Yuumi",
-    "Zac",
-    "Zed",
-    "Ziggs",
-    "Zilean",
-    "Zoe",
-    "Zyra",
-    "Viego",
-    "Gwen",
-    "Akshan",
-    "Vex",
-    "Zeri",
-    "RenataGlasc"
-]
-
-for champion in CHAMPS:
+def file_hash(path):
+    """
+    Returns the sha256 of the file at path, or None if there is no such file
+    """
     try:
-        r = requests.get(URL + champion.replace(" ", "") + ".png")
-        open(f"modules/overlay/res/{champion}.png", "wb").write(r.content)
-    except:
-        pass
+        with open(path, "rb") as icon_file:
+            return hashlib.sha256(icon_file.read()).hexdigest()
+    except OSError:
+        return None
+
+def sync_icon(session, url, path, entry=None):
+    """
+    Brings the icon at path up to date with the icon at url.
+    entry is the manifest entry of the icon from the last sync. The file is
+    trusted as long as it still has the hash recorded in the entry. Returns
+    the new entry and whether the file was written.
+    Raises SyncError or a requests.RequestException if the icon can not be synced.
+    """
+    local_hash = file_hash(path)
+    headers = {}
+    if (entry is not None and local_hash == entry.get("sha256")):
+        # urls contain the version, so the icon behind one never changes
+        if (entry.get("url") == url):
+            return entry, False
+        if (entry.get("etag")):
+            headers["If-None-Match"] = entry["etag"]
+        if (entry.get("last_modified")):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    response = session.get(url, headers=headers, timeout=TIMEOUT)
+    if (response.status_code == 304 and headers):
+        return dict(entry, url=url), False
+    if (response.status_code != 200):
+        raise SyncError(f"HTTP {response.status_code}")
+    content = response.content
+    if not (content.startswith(PNG_SIGNATURE)):
+        raise SyncError("response is not a png")
+
+    content_hash = hashlib.sha256(content).hexdigest()
+    written = content_hash != local_hash
+    if (written):
+        write_file(path, content)
+    return {"url": url, "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "sha256": content_hash}, written
+
+def sync_icons(res_path=RES_PATH, version=None, cdn_url=CDN_URL, workers=DEFAULT_WORKERS,
+               force=False):
+    """
+    Syncs the icon of every champion of the Data Dragon version, the newest
+    if not given, into res_path and updates the manifest there.
+    force ignores the manifest and requests every icon again.
+    Returns a SyncResult.
+    """
+    session = create_session(workers)
+    if (version is None):
+        version = latest_version(session, cdn_url)
+    icons = champion_icons(session, version, cdn_url)
+
+    os.makedirs(res_path, exist_ok=True)
+    manifest_path = os.path.join(res_path, MANIFEST_NAME)
+    entries = {} if force else load_manifest(manifest_path)["icons"]
+
+    result = SyncResult(version)
+    synced = {}
+    with ThreadPoolExecutor(workers) as pool:
+        futures = {champion: pool.submit(sync_icon, session, url,
+                                         os.path.join(res_path, icon_filename(champion)),
+                                         entries.get(champion))
+                   for champion, url in icons.items()}
+        for champion, future in sorted(futures.items()):
+            try:
+                entry, written = future.result()
+            except (SyncError, requests.RequestException) as e:
+                result.failures[champion] = str(e)
+                # the old entry makes the next run try again
+                if (champion in entries):
+                    synced[champion] = entries[champion]
+                continue
+            synced[champion] = entry
+            (result.downloaded if written else result.unchanged).append(champion)
+
+    manifest = {"version": version, "icons": synced}
+    write_file(manifest_path, json.dumps(manifest, indent=1, sort_keys=True), "w")
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Syncs the champion icons with Data Dragon")
+    parser.add_argument('--version', type=str, default=None,
+                        help="Data Dragon version to sync, the newest if not given")
+    parser.add_argument('--res-path', type=str, default=RES_PATH,
+                        help="Folder the icons are saved in")
+    parser.add_argument('--cdn-url', type=str, default=CDN_URL,
+                        help="Base url of Data Dragon, e.g. a local mirror")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help="Number of icons downloaded at once")
+    parser.add_argument('--force', action='store_true',
+                        help="Ignore the manifest and request every icon again")
+    parser.add_argument('--build-atlas', action='store_true',
+                        help="Rebuild the sprite atlas of the overlay when icons changed")
+    arguments = parser.parse_args()
+
+    try:
+        result = sync_icons(arguments.res_path, arguments.version, arguments.cdn_url,
+                            arguments.workers, arguments.force)
+    except (requests.RequestException, ValueError, KeyError) as e:
+        raise SystemExit(f"could not read the champion data: {e}")
+
+    print(result)
+    for champion, reason in sorted(result.failures.items()):
+        print(f"  failed {champion}: {reason}")
+
+    if (arguments.build_atlas):
+        # imported here, as only the atlas needs the imaging libraries
+        from modules.overlay.icons import ATLAS_PATH, ATLAS_INDEX_PATH, build_atlas
+        atlas_path = os.path.join(arguments.res_path, os.path.basename(ATLAS_PATH))
+        index_path = os.path.join(arguments.res_path, os.path.basename(ATLAS_INDEX_PATH))
+        if (result.downloaded or not os.path.exists(atlas_path)):
+            print(f"Packed {build_atlas(arguments.res_path, atlas_path, index_path)} icons "
+                  f"into {atlas_path}")
+
+    if (result.failures):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -12,87 +12,216 @@ multiple clients in Leauge of Legends.
 # =================================================================
 # Imports
 # =================================================================
-import time
-import os
+import asyncio
+import argparse
 import modules.game.api as api
-from modules.connection.server_connection import Server
+from modules.game.flash_sync import FlashSync
+from modules.connection.server_connection import ConnectionState
+from modules.connection.async_connection import AsyncServer
 from modules.overlay.overlay import Overlay
+from modules.overlay.scheduler import Scheduler
+
+# =================================================================
+# Settings
+# =================================================================
+parser = argparse.ArgumentParser()
+parser.add_argument('--server-host', type=str, default="35.228.34.91",
+                    help="Address of the master server")
+parser.add_argument('--server-port', type=int, default=3389,
+                    help="Port of the master server")
+parser.add_argument('--api-url', type=str, default=api.BASE_URL,
+                    help="Base url of the live game API, e.g. a local replay server")
+parser.add_argument('--fps', type=float, default=30,
+                    help="How many times per second the overlay is refreshed")
+parser.add_argument('--poll-interval', type=float, default=api.POLL_INTERVAL,
+                    help="Seconds between polls of the game API while waiting for a game")
+parser.add_argument('--max-backoff', type=float, default=api.MAX_BACKOFF,
+                    help="Longest delay in seconds between polls while no game is running")
+parser.add_argument('--stats', action='store_true',
+                    help="Periodically print timing statistics of the main loop")
+parser.add_argument('--clock-sync-interval', type=float, default=10,
+                    help="Seconds between syncs of the game clock with the game API")
+arguments = parser.parse_args()
+
+# seconds until a failed sync of the game clock is tried again, instead of
+# waiting for the next regular sync
+CLOCK_RETRY_DELAY = 1
+
+api.client.base_url = arguments.api_url
+api.client.poll_interval = arguments.poll_interval
+api.client.max_backoff = arguments.max_backoff
 
 # =================================================================
 # callbacks
 # =================================================================
 overlay = Overlay(1.5, 1, 50, 50)
-all_enemies = []
-
-
-def on_message(message):
-    for enemy in all_enemies:
-        if enemy.champion == message:
-            enemy.flash_cooldown = 300
-
-# create a connection to the master server and start listening for messages
-server = Server("35.228.34.91", 3389)
-server.start_listening(on_message)
-
-#server.wait_for_server_response("join_lobby test_lobby")
-# wait for the server to connect
-while not server.connected:
-    pass
-print("Connected to master server!")
-
-# wait for a league game to be active
-while not api.live_game_active():
-    pass
-print("In a game")
-
-# attempt to create a new lobby with all summoner names as id
-lobby_id = ""
-for player in api.get_all_players():
-    lobby_id += player.replace(" ", "").replace("|", "")
-
-create_success = server.wait_for_server_response(f"create_lobby {lobby_id}")
-
-# if creation failed, someone else with the application already loaded into game
-# join that lobby instead
-if not (create_success):
-    join = server.wait_for_server_response(f"join_lobby {lobby_id}")
-    if (join):
-        print("joined game lobby")
-else:
-    print("created new game lobby")
-
-
-class Enemy:
-    def __init__(self, champion):
-        self.flash_cooldown = 0
-        self.champion = champion
+# the overlay and the connection to the master server share one asyncio loop
+# on the main thread, so messages are handled without locks
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
+scheduler = Scheduler(overlay.root, loop)
+# cooldowns are kept in game time, which is the same for every client in the
+# game, so flashes sent by teammates expire at the same time for everyone
+flashes = FlashSync()
+
+def on_connection_state(state):
+    """
+    Called when the connection to the master server is lost or comes back.
+    The connection reconnects and returns to the lobby on its own, and
+    flashes clicked in the meantime are sent once it is back
+    """
+    if (state == ConnectionState.CONNECTED):
+        print("Connected to master server!")
+    elif (state == ConnectionState.DISCONNECTED):
+        print("Lost connection to master server, reconnecting")
+
+# create a connection to the master server, which connects once the loop runs
+server = AsyncServer(arguments.server_host, arguments.server_port, flashes.on_message,
+                     on_connection_state, loop=loop)
+flashes.server = server
+server.start()
+
+def in_background(function, on_done):
+    """
+    Calls the blocking function on a worker thread, so the overlay and the
+    connection keep running while it waits for the game API. on_done is
+    called with the finished future on the loop thread, where it can touch
+    the overlay and the cooldowns
+    """
+    loop.run_in_executor(None, function).add_done_callback(on_done)
+
+# called when the server has answered a broadcast
+def on_broadcast_ack(future):
+    if (future.exception() is not None or not future.result()):
+        print("failed to broadcast flash to lobby")
 
 def on_click(event, arg):
-    server.wait_for_server_response(f"lobby_broadcast {arg}")
-    for enemy in all_enemies:
-        if enemy.champion == arg:
-            enemy.flash_cooldown = 300
-
-
-for enemy in api.get_all_enemies():
-    overlay.add_player(enemy["championName"], on_click)
-    all_enemies.append(Enemy(enemy["championName"]))
-
+    # broadcasts are queued and sent in the background, so the overlay keeps
+    # rendering while waiting for the server
+    future = flashes.flash(arg)
+    if (future is not None):
+        future.add_done_callback(on_broadcast_ack)
+
+def join_game_lobby(snapshot):
+    """
+    Attempt to create a new lobby with all summoner names as id
+    """
+    lobby_id = ""
+    for player in snapshot.players:
+        lobby_id += player.replace(" ", "").replace("|", "")
+
+    # the answers are handled when they arrive, so the overlay starts without
+    # waiting for the server, which may be unreachable for a while
+    def on_join(future):
+        if (future.exception() is None and future.result()):
+            print("joined game lobby")
+
+    def on_create(future):
+        if (future.exception() is not None):
+            return
+        # if creation failed, someone else with the application already loaded
+        # into game, join that lobby instead
+        if not (future.result()):
+            server.join_lobby(lobby_id).add_done_callback(on_join)
+        else:
+            print("created new game lobby")
+
+    server.create_lobby(lobby_id).add_done_callback(on_create)
+
+def on_game_start(future):
+    """
+    Called with the snapshot of the game once a game has been found
+    """
+    # the game may have ended between finding it and fetching the snapshot
+    if (future.exception() is not None):
+        scheduler.after(api.client.poll_delay(), wait_for_game)
+        return
+    snapshot = future.result()
+
+    print("In a game")
+    join_game_lobby(snapshot)
+
+    for champion in flashes.add_enemies(snapshot):
+        overlay.add_player(champion, on_click)
+
+    scheduler.at_rate(arguments.fps, refresh_overlay)
+    scheduler.every(arguments.clock_sync_interval, sync_game_clock, "sync_game_clock")
+
+    # follow the event log of the game to know when it is over
+    loop.create_task(follow_events(api.client.events()))
+
+# the retry of a failed sync of the game clock that is waiting to run
+clock_retry = None
+
+def sync_game_clock():
+    """
+    Sets the game clock to the game time reported by the game API. The clock
+    keeps running on its own between syncs. The summoner spell haste of the
+    enemies is updated along with it, as they buy items during the game
+    """
+    global clock_retry
+    clock_retry = None
+    in_background(api.client.game_stats, on_game_stats)
+    in_background(api.client.player_list, on_player_list)
+
+def on_game_stats(future):
+    global clock_retry
+    try:
+        flashes.game_clock.sync(future.result()["gameTime"])
+    except Exception as e:
+        print(f"failed to sync game clock: {e!r}")
+        # only one retry waits at a time, however many syncs fail meanwhile
+        if (clock_retry is None):
+            clock_retry = scheduler.after(CLOCK_RETRY_DELAY, sync_game_clock)
+
+def on_player_list(future):
+    if (future.exception() is None):
+        flashes.update_haste(future.result())
+
+async def follow_events(events):
+    """
+    Handles the events of the game as they happen. The event log is polled
+    on a worker thread, and the events are handled on the loop thread
+    """
+    async for event in events:
+        if (event["EventName"] == "GameEnd"):
+            print("Game ended")
+            overlay.root.destroy()
+            return
+
+def refresh_overlay():
+    """
+    Calculates the remaining cooldowns from their expiry time. Players only
+    repaint when the displayed number has changed
+    """
+    now = flashes.cooldowns.clock()
+    for player in overlay.players:
+        player.set_text(flashes.cooldowns.remaining_seconds(player.champion, now))
+
+def wait_for_game():
+    """
+    Polls the game API until a game is active. The delay between polls backs
+    off while no game is running
+    """
+    in_background(api.live_game_active, on_game_probe)
+
+def on_game_probe(future):
+    if (future.result()):
+        in_background(api.client.snapshot, on_game_start)
+    else:
+        scheduler.after(api.client.poll_delay(), wait_for_game)
+
+def print_stats():
+    for name, stats in scheduler.stats().items():
+        print(f"{name}: {stats}")
+    print(f"game api: {api.client.stats}")
 
 # main loop
-while True:
-    start_time = time.time()
-    overlay.root.update()
-
-    # updating enemy
-    for player in overlay.players:
-        for enemy in all_enemies:
-            if (enemy.champion == player.champion):
-                player.set_text(int(enemy.flash_cooldown))
-
-    # update flash cooldowns
-    delta = time.time() - start_time
-    for enemy in all_enemies:
-        enemy.flash_cooldown -= delta
-        if (enemy.flash_cooldown < 0):
-            enemy.flash_cooldown = 0
+# the event loop runs all scheduled tasks, the overlay and the connection to
+# the master server. it waits for a league game to be active, polling the
+# game API at its own rate, without blocking any of them
+wait_for_game()
+if (arguments.stats):
+    scheduler.every(10, print_stats)
+scheduler.run()
+loop.run_until_complete(server.close())
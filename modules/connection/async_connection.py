@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+asyncio implementation of the connection to the master server.
+Reading, writing, heartbeats and reconnecting all run as callbacks and tasks
+on a single event loop, normally the one that also drives the overlay, so
+messages are handled on the UI thread without any locks, and nothing runs
+while there is nothing to read or send.
+"""
+# =================================================================
+# Imports
+# =================================================================
+import random
+import asyncio
+import itertools
+from collections import deque
+from server.server_utils import MessageType
+from server.protocol import (HANDSHAKE, NO_REQUEST, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT,
+                             FrameDecoder, FrameType, encode_frame)
+from modules.connection.server_connection import (CONNECT_TIMEOUT, HANDSHAKE_TIMEOUT,
+                                                  RECONNECT_DELAY, MAX_RECONNECT_DELAY,
+                                                  MAX_QUEUED_REQUESTS, COALESCE_WINDOW,
+                                                  MAX_BATCH_SIZE, HEARTBEAT, MESSAGE_TYPES,
+                                                  ConnectionState, Event, expand_events,
+                                                  parse_legacy_message)
+
+class AsyncServer:
+    """
+    Connection to the master server running on an asyncio event loop.
+    Speaks the same protocol as server_connection.Server and has the same
+    lobby requests, which return asyncio futures to be awaited or given
+    callbacks. Sessions are resumed automatically after reconnecting.
+    message_callback and state_callback are called on the loop, so they may
+    touch the overlay directly. Requests must be made from the loop thread.
+    Call start() to connect. The connection reconnects in the background
+    when it is lost and returns to its lobby before sending queued requests.
+    """
+    def __init__(self, host, port, message_callback, state_callback=None, reconnect=True,
+                 max_queued_requests=MAX_QUEUED_REQUESTS, loop=None):
+        self.host = host
+        self.port = port
+        self.message_callback = message_callback
+        self.state_callback = state_callback
+        self.reconnect = reconnect
+        self.max_queued_requests = max_queued_requests
+        self.loop = loop or asyncio.get_event_loop()
+        self.state = ConnectionState.DISCONNECTED
+        self.connected = False
+        self.closing = False
+        self.framed = False
+        # true while queued requests can be written
+        self.link_up = False
+        self.resumed = False
+        self.heartbeats = False
+        self.session_token = None
+        self.lobby_id = None
+        self.reader = None
+        self.writer = None
+        self.decoder = FrameDecoder()
+        self.pending_data = b""
+
+        # requests waiting for a response. framed servers echo the request id,
+        # legacy servers answer in the order the requests were sent.
+        self.pending_requests = {}
+        self.pending_order = deque()
+        self.request_ids = itertools.count()
+
+        # requests waiting to be written, sent together after COALESCE_WINDOW
+        self.outbound = deque()
+        self._flush_handle = None
+        self._heartbeat_handle = None
+        self._sent_since_heartbeat = False
+        self._task = None
+        self._receiving = None
+
+    def start(self):
+        """
+        Starts connecting to the server, in the background once the loop runs
+        """
+        if (self._task is None):
+            self._task = self.loop.create_task(self._run())
+        return self._task
+
+    async def close(self):
+        """
+        Closes the connection for good, without reconnecting
+        """
+        self.closing = True
+        tasks = [task for task in (self._task, self._receiving) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # connects and reads until the connection is lost, then reconnects with
+    # the same backoff as the threaded client
+    async def _run(self):
+        attempt = 0
+        while not (self.closing):
+            self._set_state(ConnectionState.CONNECTING)
+            try:
+                await self._connect()
+            except (OSError, asyncio.TimeoutError):
+                if not (self.reconnect):
+                    self._set_state(ConnectionState.DISCONNECTED)
+                    return
+                delay = min(RECONNECT_DELAY * 2 ** attempt, MAX_RECONNECT_DELAY)
+                attempt += 1
+                await asyncio.sleep(random.uniform(delay / 2, delay))
+                continue
+            attempt = 0
+
+            self._receiving = self.loop.create_task(self._receive())
+            try:
+                await self._restore_lobby()
+            except ConnectionError:
+                pass
+            else:
+                self._on_link_up()
+            try:
+                await self._receiving
+            except Exception as e:
+                print(f"lost connection to master server: {e!r}")
+            if not (self.reconnect):
+                return
+
+    # opens a connection and negotiates the protocol.
+    # a server that supports the framed protocol echoes the handshake back,
+    # while an old server answers with a single "unknown_command" response.
+    async def _connect(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                                CONNECT_TIMEOUT)
+        try:
+            writer.write(HANDSHAKE)
+            reply = b""
+            while len(reply) < len(HANDSHAKE) and HANDSHAKE.startswith(reply):
+                data = await asyncio.wait_for(reader.read(1024), HANDSHAKE_TIMEOUT)
+                if not data:
+                    raise ConnectionRefusedError("server closed connection")
+                reply += data
+        except BaseException:
+            writer.close()
+            raise
+
+        self.reader = reader
+        self.writer = writer
+        self.framed = reply.startswith(HANDSHAKE)
+        self.decoder = FrameDecoder()
+        # anything after the handshake already belongs to the frame stream
+        self.pending_data = reply[len(HANDSHAKE):] if self.framed else b""
+        self.heartbeats = False
+        self.connected = True
+
+    # reads from the connection as data arrives until it is lost.
+    # once the server answers heartbeats, a server that has been silent for
+    # longer than HEARTBEAT_TIMEOUT is treated as gone.
+    async def _receive(self):
+        data = self.pending_data
+        try:
+            while True:
+                if (data):
+                    for message in self._read_messages(data):
+                        self._handle_message(*message)
+                timeout = HEARTBEAT_TIMEOUT if self.heartbeats else None
+                data = await asyncio.wait_for(self.reader.read(4096), timeout)
+                # an empty read means the server closed the connection
+                if not (data):
+                    return
+        except (OSError, asyncio.TimeoutError, ValueError, IndexError):
+            # data that can not be decoded leaves the stream out of sync, so
+            # it is treated like a lost connection. ValueError covers ProtocolError
+            return
+        finally:
+            self._on_connection_lost()
+
+    # returns a list of (message_type, request_id, message_body) for the data read
+    def _read_messages(self, data):
+        if (self.framed):
+            return [(MESSAGE_TYPES.get(frame_type), request_id, content)
+                    for frame_type, request_id, content in self.decoder.feed(data)]
+        return [parse_legacy_message(data)]
+
+    def _handle_message(self, message_type, request_id, message_body):
+        if (message_type == MessageType.RESPONSE):
+            future = self._pop_request(request_id)
+            if (future is not None and not future.done()):
+                future.set_result(message_body)
+
+        elif (message_type == MessageType.MESSAGE):
+            # an error in the callback must not take the connection down
+            try:
+                self.message_callback(message_body)
+            except Exception as e:
+                print(f"error handling message from master server: {e!r}")
+
+        elif (message_type == HEARTBEAT):
+            self.heartbeats = True
+
+    # removes a pending request and returns its future.
+    # legacy responses always belong to the oldest request.
+    def _pop_request(self, request_id):
+        if (request_id != NO_REQUEST):
+            return self.pending_requests.pop(request_id, None)
+        if (self.pending_order):
+            return self.pending_order.popleft()
+        return None
+
+    # puts a new connection back in the lobby before queued requests are sent.
+    # the session is resumed if the server still has it, otherwise the lobby
+    # is created or joined again, e.g. after the server restarted.
+    async def _restore_lobby(self):
+        self.resumed = False
+        if (self.framed and self.session_token):
+            self.resumed = await self._send_now(f"resume {self.session_token}") is True
+            if not (self.resumed):
+                self.session_token = None
+
+        if (not self.resumed and self.lobby_id is not None):
+            # the lobby is gone if the server restarted, otherwise teammates kept it
+            if (await self._send_now(f"create_lobby {self.lobby_id}") is not True):
+                await self._send_now(f"join_lobby {self.lobby_id}")
+            if (self.framed):
+                self._send_now("resume_token").add_done_callback(self._on_session_token)
+
+    def _on_link_up(self):
+        self.link_up = True
+        self._heartbeat_handle = self.loop.call_later(HEARTBEAT_INTERVAL, self._heartbeat)
+        self._set_state(ConnectionState.CONNECTED)
+        self._flush()
+
+    def _on_connection_lost(self):
+        self.connected = False
+        self.link_up = False
+        for handle in (self._flush_handle, self._heartbeat_handle):
+            if (handle is not None):
+                handle.cancel()
+        self._flush_handle = None
+        self._heartbeat_handle = None
+        self.writer.close()
+
+        # fail every request still waiting for a response
+        futures = list(self.pending_requests.values()) + list(self.pending_order)
+        self.pending_requests.clear()
+        self.pending_order.clear()
+        for future in futures:
+            if not (future.done()):
+                future.set_exception(ConnectionError("lost connection to master server"))
+        self._set_state(ConnectionState.DISCONNECTED)
+
+    def _set_state(self, state):
+        if (state != self.state):
+            self.state = state
+            if (self.state_callback is not None):
+                self.state_callback(state)
+
+    # returns the id of the next request.
+    # ids wrap around within the 4 bytes of the frame header
+    def _next_request_id(self):
+        return next(self.request_ids) % 0xFFFFFFFF + 1
+
+    # writes a command straight away, ahead of the queued requests
+    def _send_now(self, message):
+        future = self.loop.create_future()
+        if (self.framed):
+            request_id = self._next_request_id()
+            self.pending_requests[request_id] = future
+            self._write(encode_frame(FrameType.COMMAND, message, request_id))
+        else:
+            self.pending_order.append(future)
+            self._write(str.encode(message))
+        return future
+
+    def _write(self, data):
+        self.writer.write(data)
+        self._sent_since_heartbeat = True
+
+    # sends a heartbeat to framed servers when nothing else has been sent
+    # for HEARTBEAT_INTERVAL
+    def _heartbeat(self):
+        if (self.framed and not self._sent_since_heartbeat):
+            self._write(encode_frame(FrameType.PING, None))
+        self._sent_since_heartbeat = False
+        self._heartbeat_handle = self.loop.call_later(HEARTBEAT_INTERVAL, self._heartbeat)
+
+    def request(self, message):
+        """
+        Queues a message for the master server and returns a future that will
+        hold the server response once it arrives. Requests made within
+        COALESCE_WINDOW of each other are sent together, and while the server
+        can not be reached they wait in the queue. When it is full, the oldest
+        request is failed to make room.
+        """
+        future = self.loop.create_future()
+        if (len(self.outbound) >= self.max_queued_requests):
+            dropped_message, dropped = self.outbound.popleft()
+            if not (dropped.done()):
+                dropped.set_exception(ConnectionError("dropped from the full outbound queue"))
+        self.outbound.append((message, future))
+        if (self.link_up and self._flush_handle is None):
+            self._flush_handle = self.loop.call_later(COALESCE_WINDOW, self._flush)
+        return future
+
+    # writes every queued request, in batches of at most MAX_BATCH_SIZE
+    def _flush(self):
+        self._flush_handle = None
+        while self.outbound and self.link_up:
+            requests = []
+            while self.outbound and len(requests) < MAX_BATCH_SIZE:
+                message, future = self.outbound.popleft()
+                # requests cancelled while they were queued are never sent
+                if not (future.done()):
+                    requests.append((message, future))
+            if (requests):
+                self._send_requests(requests)
+
+    # registers the requests as pending and writes them in one write.
+    # legacy servers get the requests one by one in the order they were made.
+    # events can not be part of a batch, so requests queued together with an
+    # event are sent as one frame each.
+    def _send_requests(self, requests):
+        requests = expand_events(requests, self.framed, self.loop.create_future)
+        if not (self.framed):
+            for message, future in requests:
+                if (isinstance(message, bytes)):
+                    future.set_exception(ConnectionError("server does not support events"))
+                    continue
+                self.pending_order.append(future)
+                self._write(str.encode(message))
+            return
+
+        frames = []
+        if (len(requests) == 1 or any(isinstance(message, bytes) for message, future in requests)):
+            for message, future in requests:
+                request_id = self._next_request_id()
+                frame_type = FrameType.EVENT if isinstance(message, bytes) else FrameType.COMMAND
+                frames.append(encode_frame(frame_type, message, request_id))
+                self.pending_requests[request_id] = future
+        else:
+            request_id = self._next_request_id()
+            frames.append(encode_frame(FrameType.BATCH,
+                                       [message for message, future in requests], request_id))
+            self.pending_requests[request_id] = self._batch_future(
+                [future for message, future in requests])
+        self._write(b"".join(frames))
+
+    # returns a future for the response to a batch, which hands each result of
+    # the response to the future of the request it belongs to.
+    def _batch_future(self, futures):
+        def resolve(batch):
+            exception = batch.exception()
+            if (exception is None and (not isinstance(batch.result(), list)
+                                       or len(batch.result()) != len(futures))):
+                exception = ConnectionError("malformed batch response")
+            for index, future in enumerate(futures):
+                if (future.done()):
+                    continue
+                if (exception is not None):
+                    future.set_exception(exception)
+                else:
+                    future.set_result(batch.result()[index])
+
+        batch = self.loop.create_future()
+        batch.add_done_callback(resolve)
+        return batch
+
+    def get_lobby_list(self, page=0):
+        """
+        Returns a future holding a page of the list of lobby ids
+        """
+        return self.request(f"lobby_list {page}")
+
+    def create_lobby(self, lobby_id):
+        """
+        Attempts to create a new lobby, returns a future holding a boolean
+        value indicating success
+        """
+        return self._enter_lobby("create_lobby", lobby_id)
+
+    def join_lobby(self, lobby_id):
+        """
+        Attempts to join the lobby with the given id, returns a future holding
+        a boolean value indicating success
+        """
+        return self._enter_lobby("join_lobby", lobby_id)
+
+    # framed servers are asked for the session token right after entering
+    def _enter_lobby(self, command, lobby_id):
+        self.lobby_id = lobby_id
+        future = self.request(f"{command} {lobby_id}")
+        if (self.framed):
+            self.request("resume_token").add_done_callback(self._on_session_token)
+        return future
+
+    # stores the session token, ignoring answers from servers without sessions
+    def _on_session_token(self, future):
+        if (not future.cancelled() and future.exception() is None
+                and isinstance(future.result(), str) and future.result() != "unknown_command"):
+            self.session_token = future.result()
+
+    def broadcast(self, message):
+        """
+        Attempts to broadcast message to the lobby, returns a future holding a
+        boolean value indicating success
+        """
+        return self.request(f"lobby_broadcast {message}")
+
+    def send_event(self, data, fallback=None):
+        """
+        Attempts to send the bytes of an event to the lobby. Clients that can
+        not read events are sent the text of fallback instead if given: legacy
+        clients in the lobby of a framed server, and the whole lobby of a
+        legacy server. Without a fallback, events fail on legacy servers.
+        Returns a future holding a boolean value indicating success
+        """
+        return self.request(Event(data, fallback))
@@ -11,111 +11,621 @@ multiple clients and the creation and joining of new lobbies on the master serve
 # =================================================================
 # Imports
 # =================================================================
-import sys
 import socket
+import time
+import random
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import Future
+from queue import Queue, Empty, Full
 from threading import Thread
 from server.server_utils import MessageType
+from server.protocol import (HANDSHAKE, NO_REQUEST, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT,
+                             FrameDecoder, FrameType, encode_frame)
 
-# class for communicating with the master server
+# how long to wait for a connection to the server and for the server to
+# answer the protocol handshake
+CONNECT_TIMEOUT = 5
+HANDSHAKE_TIMEOUT = 2
+
+# delay before reconnecting after the connection is lost. the delay doubles
+# with every failed attempt up to MAX_RECONNECT_DELAY, and a random part of
+# it is used, so clients that lost the server together do not return together
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 30
+
+# most requests waiting to be sent, e.g. while the server can not be reached.
+# when full, the oldest request is dropped to make room for the newest one
+MAX_QUEUED_REQUESTS = 256
+
+# default amount of seconds to wait for the response to a request
+DEFAULT_TIMEOUT = 5
+
+# requests made within this many seconds of each other are sent as one batch
+COALESCE_WINDOW = 0.005
+MAX_BATCH_SIZE = 64
+
+# message type of the answer to a heartbeat, only seen by the client
+HEARTBEAT = "heartbeat"
+
+# message type of each frame type sent by the server
+MESSAGE_TYPES = {
+    FrameType.RESPONSE: MessageType.RESPONSE,
+    FrameType.MESSAGE: MessageType.MESSAGE,
+    FrameType.PONG: HEARTBEAT
+}
+
+# converts the message content into it's actual type specified by the
+# data type in message header.
+def _message_to_data(type, message):
+    if (type == "list"):
+        return message.strip("][").replace("'", "").split(', ')
+
+    elif (type == "str"):
+        return str(message)
+
+    elif (type == "bool"):
+        if (message == "True"):
+            return True
+        elif (message == "False"):
+            return False
+
+# returns (message_type, request_id, message_body) for a message read from a
+# server using the legacy protocol, which sends one message per read.
+def parse_legacy_message(data):
+    # split message into list of strings
+    message = data.decode('utf8').split("|")
+
+    # get info from message
+    message_type = message[0]
+    data_type = message[1]
+    content = message[2]
+
+    # create actual message body from data type and content
+    return (message_type, NO_REQUEST, _message_to_data(data_type, content))
+
+# states of the connection passed to the state callback of a Server
+class ConnectionState:
+    CONNECTING = "connecting"
+    CONNECTED = "connected"
+    DISCONNECTED = "disconnected"
+
+# an event queued for the lobby by send_event(). which protocol the server
+# speaks is only known once connected, so how the event is sent is decided
+# by expand_events() when it is written.
+class Event:
+    def __init__(self, data, fallback=None):
+        self.data = bytes(data)
+        self.fallback = fallback
+
+# returns the (message, future) requests with every Event replaced by the
+# requests it is sent as. framed servers get the bytes of the event, after a
+# legacy_broadcast of the fallback for legacy clients in the lobby. legacy
+# servers can not relay events and get a broadcast of the fallback instead.
+# new_future creates the future of the legacy_broadcast, which is not waited for.
+def expand_events(requests, framed, new_future):
+    expanded = []
+    for message, future in requests:
+        if not (isinstance(message, Event)):
+            expanded.append((message, future))
+        elif (message.fallback is None):
+            expanded.append((message.data, future))
+        elif (framed):
+            expanded.append((f"legacy_broadcast {message.fallback}", new_future()))
+            expanded.append((message.data, future))
+        else:
+            expanded.append((f"lobby_broadcast {message.fallback}", future))
+    return expanded
+
+# class for communicating with the master server.
+# every request returns a concurrent.futures.Future that is resolved by the
+# listener thread when the response arrives, so any number of requests can be
+# in flight at once. wrap them with asyncio.wrap_future to await them.
+# when the connection is lost, the listener thread reconnects in the
+# background and resumes the session in the current lobby. requests made in
+# the meantime are queued and sent once the connection is back.
+# state_callback is called with a ConnectionState whenever the state changes,
+# from a background thread.
 class Server:
-    def __init__(self, host, port):
+    def __init__(self, host, port, state_callback=None, reconnect=True,
+                 max_queued_requests=MAX_QUEUED_REQUESTS):
+        self.host = host
+        self.port = port
+        self.state_callback = state_callback
+        self.reconnect = reconnect
+        self.socket = None
         self.connected = False
+        self.closing = False
+        self.framed = False
+        # set while requests can be written. cleared while reconnecting, until
+        # the session has been resumed, so queued requests reach the lobby
+        self.link_up = threading.Event()
+        # true if the session was resumed on the last reconnect, false if the
+        # lobby had to be entered again
+        self.resumed = False
+        # id of the lobby this client is in, entered again after a reconnect
+        # when the session can not be resumed
+        self.lobby_id = None
+        # true once the server has answered a heartbeat. from then on the
+        # server is considered gone when it has been silent for HEARTBEAT_TIMEOUT
+        self.heartbeats = False
+        # token of the session in the current lobby, used to resume it on a
+        # new connection with resume(). None until a lobby has been entered
+        self.session_token = None
+        self.decoder = FrameDecoder()
+        self.pending_data = b""
+
+        # requests waiting for a response. framed servers echo the request id,
+        # legacy servers answer in the order the requests were sent.
+        self.pending_requests = {}
+        self.pending_order = deque()
+        self.request_lock = threading.Lock()
+        self.request_ids = itertools.count()
+
+        # requests waiting to be written by the writer thread
+        self.outbound = Queue(max_queued_requests)
+        Thread(target=self._write_loop, daemon=True).start()
+
+        try:
+            self._connect()
+            self._on_link_up()
+        except OSError as e:
+            print(f"could not connect to master server: {e}")
+            self._set_state(ConnectionState.DISCONNECTED)
+
+    # opens a new connection to the server and negotiates the protocol
+    def _connect(self):
+        connection = socket.create_connection((self.host, self.port), CONNECT_TIMEOUT)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket = connection
+        self.decoder = FrameDecoder()
+        self.pending_data = b""
+        self.heartbeats = False
+        try:
+            self._negotiate()
+        except OSError:
+            connection.close()
+            raise
+        # the listener thread blocks in recv until data arrives
+        self.socket.settimeout(None)
+        self.connected = True
+
+    # reconnects to the server, waiting longer after every failed attempt.
+    # returns False if the server was closed while reconnecting
+    def _reconnect(self):
+        self._set_state(ConnectionState.CONNECTING)
+        attempt = 0
+        while not (self.closing):
+            delay = min(RECONNECT_DELAY * 2 ** attempt, MAX_RECONNECT_DELAY)
+            time.sleep(random.uniform(delay / 2, delay))
+            try:
+                self._connect()
+            except OSError:
+                attempt += 1
+                continue
+            self._restore_lobby()
+            return True
+        return False
+
+    # puts the new connection back in the lobby before the queued requests are
+    # sent, so they reach the lobby. the session is resumed if the server still
+    # has it, otherwise the lobby is created or joined again, e.g. after the
+    # server restarted. the queued requests are held back until this is done.
+    def _restore_lobby(self):
+        self.resumed = False
+        if (self.framed and self.session_token):
+            self._send_now(f"resume {self.session_token}").add_done_callback(self._on_session_resumed)
+        elif (self.lobby_id is not None):
+            self._reenter_lobby()
+        else:
+            self._on_link_up()
+
+    def _on_session_resumed(self, future):
+        # the connection was lost again, the next reconnect starts over
+        if (future.exception() is not None):
+            return
+        if (future.result() is True):
+            self.resumed = True
+            self._on_link_up()
+        else:
+            self.session_token = None
+            self._reenter_lobby()
+
+    def _reenter_lobby(self):
+        lobby_id = self.lobby_id
+
+        def on_entered(future):
+            if (future.exception() is not None):
+                return
+            if (self.framed):
+                self._send_now("resume_token").add_done_callback(self._on_session_token)
+            self._on_link_up()
+
+        # the lobby is gone if the server restarted, otherwise teammates kept it
+        def on_created(future):
+            if (future.exception() is not None):
+                return
+            if (future.result() is True):
+                on_entered(future)
+            else:
+                self._send_now(f"join_lobby {lobby_id}").add_done_callback(on_entered)
+
+        self._send_now(f"create_lobby {lobby_id}").add_done_callback(on_created)
+
+    # writes a command from the listener thread straight away, while the
+    # writer thread is held back, and returns a future for the response
+    def _send_now(self, message):
+        future = Future()
+        future.set_running_or_notify_cancel()
+        with self.request_lock:
+            if (self.framed):
+                request_id = self._next_request_id()
+                self.pending_requests[request_id] = future
+                data = encode_frame(FrameType.COMMAND, message, request_id)
+            else:
+                self.pending_order.append(future)
+                data = str.encode(message)
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((host, port))
-            self.socket.setblocking(0)
-            self.connected = True
-        except ConnectionRefusedError:
-            print("connection timed out")
+            self.socket.sendall(data)
+        except OSError:
+            # the listener finds the connection gone and fails the request
+            pass
+        return future
+
+    # lets the writer thread send the queued requests
+    def _on_link_up(self):
+        self.link_up.set()
+        self._set_state(ConnectionState.CONNECTED)
+
+    # called by the listener thread when the connection is lost
+    def _on_connection_lost(self):
+        self.connected = False
+        self.link_up.clear()
+        self._shutdown()
+        self._fail_requests(ConnectionError("lost connection to master server"))
+        self._set_state(ConnectionState.DISCONNECTED)
+
+    def _set_state(self, state):
+        if (self.state_callback is not None):
+            self.state_callback(state)
 
-        self.server_response = None
+    # closes the connection for good, without reconnecting
+    def close(self):
+        self.closing = True
+        if (self.socket is not None):
+            self._shutdown()
+
+    # asks the server to use the framed protocol.
+    # a server that supports it echoes the handshake back, while an old server
+    # answers with a single "unknown_command" response, which is discarded
+    # before falling back to the legacy protocol.
+    def _negotiate(self):
+        self.socket.settimeout(HANDSHAKE_TIMEOUT)
+        self.socket.sendall(HANDSHAKE)
+        reply = b""
+        while len(reply) < len(HANDSHAKE) and HANDSHAKE.startswith(reply):
+            data = self.socket.recv(1024)
+            if not data:
+                raise ConnectionRefusedError("server closed connection")
+            reply += data
+
+        self.framed = reply.startswith(HANDSHAKE)
+        if (self.framed):
+            # anything after the handshake already belongs to the frame stream
+            self.pending_data = reply[len(HANDSHAKE):]
 
     # takes a string and converts it into bytes and sends to master server
+    # using the legacy protocol.
     def _send_message(self, message):
-        self.socket.send(str.encode(message))
+        self.socket.sendall(str.encode(message))
+
+    # returns a list of (message_type, request_id, message_body) for the data
+    # read from the master server. framed data can hold any number of messages,
+    # while the legacy protocol expects exactly one message per read.
+    def _read_messages(self, data):
+        if (self.framed):
+            return [(MESSAGE_TYPES.get(frame_type), request_id, content)
+                    for frame_type, request_id, content in self.decoder.feed(data)]
 
-    # converts the message content into it's actual type specified by the
-    # data type in message header.
-    def _message_to_data(self, type, message):
-        if (type == "list"):
-            return message.strip("][").replace("'", "").split(', ')
+        return [parse_legacy_message(data)]
 
-        elif (type == "str"):
-            return str(message)
+    # handle data based on message type
+    def _handle_message(self, message_type, request_id, message_body, message_callback):
+        if (message_type == MessageType.RESPONSE):
+            future = self._pop_request(request_id)
+            if (future is not None and not future.done()):
+                future.set_result(message_body)
+
+        elif (message_type == MessageType.MESSAGE):
+            # an error in the callback must not stop the listener thread
+            try:
+                message_callback(message_body)
+            except Exception as e:
+                print(f"error handling message from master server: {e!r}")
 
-        elif (type == "bool"):
-            if (message == "True"):
-                return True
-            elif (message == "False"):
-                return False
+        elif (message_type == HEARTBEAT and not self.heartbeats):
+            self.heartbeats = True
+            self.socket.settimeout(HEARTBEAT_TIMEOUT)
 
-    # constantly listen for messages from the master server
+    # listen for messages from the master server, reconnecting whenever the
+    # connection is lost, until the server is closed.
     def _listen(self, message_callback):
+        while not (self.closing):
+            if not (self.connected):
+                if not (self.reconnect and self._reconnect()):
+                    return
+            self._receive(message_callback)
+            self._on_connection_lost()
+
+    # reads messages from the current connection until it closes.
+    # recv blocks, so the thread sleeps while there is nothing to read.
+    # once the server answers heartbeats, a server that has been silent for
+    # longer than HEARTBEAT_TIMEOUT times out the read and is treated as gone.
+    # data that can not be decoded leaves the stream out of sync, so it is
+    # treated like a lost connection.
+    def _receive(self, message_callback):
+        # frames that arrived together with the handshake reply
+        data = self.pending_data
         while True:
+            if (data):
+                try:
+                    messages = self._read_messages(data)
+                except (ValueError, IndexError):
+                    return
+                for message in messages:
+                    self._handle_message(*message, message_callback)
+
             try:
-                # only proceed if there is data sent
-                message = self.socket.recv(1024).decode('utf8')
-                if not message: continue
+                data = self.socket.recv(4096)
+            except OSError:
+                data = b""
 
-                # split message into list of strings
-                message = message.split("|")
+            # an empty read means the server closed the connection
+            if not data:
+                return
 
-                # get info from message
-                message_type = message[0]
-                data_type = message[1]
-                content = message[2]
+    # start a thread for listening for incoming messages
+    def start_listening(self, message_callback):
+        Thread(target=self._listen, args=(message_callback,), daemon=True).start()
 
-                # create actual message body from data type and content
-                message_body = self._message_to_data(data_type, content)
+    # queues a message for the master server and returns a future that will
+    # hold the server response once it arrives. never blocks the caller.
+    # while the server can not be reached, requests wait in the queue.
+    def request(self, message):
+        future = Future()
+        while True:
+            try:
+                self.outbound.put_nowait((message, future))
+                return future
+            except Full:
+                self._drop_oldest_request()
 
-                # handle data based on message type
-                if (message_type == MessageType.RESPONSE):
-                    self.server_response = message_body
+    # fails the oldest queued request to make room in a full queue
+    def _drop_oldest_request(self):
+        try:
+            message, future = self.outbound.get_nowait()
+        except Empty:
+            return
+        if (future.set_running_or_notify_cancel()):
+            future.set_exception(ConnectionError("dropped from the full outbound queue"))
 
-                elif (message_type == MessageType.MESSAGE):
-                    message_callback(message_body)
+    # closes both directions of the connection, so the server and the other
+    # thread notice that it is gone
+    def _shutdown(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
-            except BlockingIOError:
-                pass
+    # sends queued requests to the master server from a background thread.
+    # requests queued within COALESCE_WINDOW of the first one are sent together
+    # as a single batch frame, so a burst of clicks becomes one packet.
+    # when nothing has been sent for HEARTBEAT_INTERVAL, a heartbeat is sent
+    # to framed servers instead.
+    # while the connection is down, the requests wait here until it is back.
+    def _write_loop(self):
+        while True:
+            try:
+                requests = [self.outbound.get(timeout=HEARTBEAT_INTERVAL)]
+            except Empty:
+                self._send_heartbeat()
+                continue
+            deadline = time.monotonic() + COALESCE_WINDOW
+            while len(requests) < MAX_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if (remaining <= 0):
+                    break
+                try:
+                    requests.append(self.outbound.get(timeout=remaining))
+                except Empty:
+                    break
+            self.link_up.wait()
 
-    # start a thread for listening for incoming messages
-    def start_listening(self, message_callback):
-        Thread(target=self._listen, args=(message_callback,)).start()
+            # requests cancelled while they were queued are never sent
+            requests = [(message, future) for message, future in requests
+                        if future.set_running_or_notify_cancel()]
+            if (requests):
+                self._send_requests(requests)
 
-    # sends a message to master server and only proceed when it recieves
-    # a server response.
-    def wait_for_server_response(self, message):
-        self._send_message(message)
+    # registers the requests as pending and writes them to the socket.
+    # legacy servers only understand one command per write, so they get the
+    # requests one by one in the order they were made.
+    # events (requests of bytes) can not be part of a batch, so requests queued
+    # together with an event are sent as one frame each, in the same write.
+    def _send_requests(self, requests):
+        requests = expand_events(requests, self.framed, Future)
+        if not (self.framed):
+            for message, future in requests:
+                if (isinstance(message, bytes)):
+                    future.set_exception(ConnectionError("server does not support events"))
+                    continue
+                with self.request_lock:
+                    self.pending_order.append(future)
+                try:
+                    self._send_message(message)
+                except OSError as e:
+                    with self.request_lock:
+                        if (future in self.pending_order):
+                            self.pending_order.remove(future)
+                    if not (future.done()):
+                        future.set_exception(ConnectionError(e))
+                    self._shutdown()
+            return
+
+        frames = []
+        sent = [] # (request_id, future) of every frame
+        with self.request_lock:
+            if (len(requests) == 1 or any(isinstance(message, bytes) for message, future in requests)):
+                for message, future in requests:
+                    request_id = self._next_request_id()
+                    frame_type = FrameType.EVENT if isinstance(message, bytes) else FrameType.COMMAND
+                    frames.append(encode_frame(frame_type, message, request_id))
+                    sent.append((request_id, future))
+            else:
+                request_id = self._next_request_id()
+                future = self._batch_future([future for message, future in requests])
+                frames.append(encode_frame(FrameType.BATCH,
+                                           [message for message, future in requests], request_id))
+                sent.append((request_id, future))
+
+            for request_id, future in sent:
+                self.pending_requests[request_id] = future
+
+        try:
+            self.socket.sendall(b"".join(frames))
+        except OSError as e:
+            for request_id, future in sent:
+                self._pop_request(request_id)
+                if not (future.done()):
+                    future.set_exception(ConnectionError(e))
+            # make the listener notice the connection is gone
+            self._shutdown()
 
-        # create a while loop that will keep looping until self.server_response
-        # has a value.
-        while self.server_response is None:
+    # sends a ping, which the server answers with a pong
+    def _send_heartbeat(self):
+        if not (self.framed and self.link_up.is_set()):
+            return
+        try:
+            self.socket.sendall(encode_frame(FrameType.PING, None))
+        except OSError:
             pass
 
-        # return the response and clear response variable
-        response = self.server_response
-        self.server_response = None
-        return response
+    # returns the id of the next request.
+    # ids wrap around within the 4 bytes of the frame header
+    def _next_request_id(self):
+        return next(self.request_ids) % 0xFFFFFFFF + 1
+
+    # returns a future for the response to a batch, which hands each result of
+    # the response to the future of the request it belongs to.
+    def _batch_future(self, futures):
+        def resolve(batch):
+            exception = batch.exception()
+            if (exception is None and (not isinstance(batch.result(), list)
+                                       or len(batch.result()) != len(futures))):
+                exception = ConnectionError("malformed batch response")
+            if (exception is not None):
+                for future in futures:
+                    future.set_exception(exception)
+                return
+            for future, result in zip(futures, batch.result()):
+                future.set_result(result)
+
+        batch = Future()
+        batch.add_done_callback(resolve)
+        return batch
+
+    # removes a pending request and returns its future.
+    # legacy responses always belong to the oldest request.
+    def _pop_request(self, request_id):
+        with self.request_lock:
+            if (request_id != NO_REQUEST):
+                return self.pending_requests.pop(request_id, None)
+            if (self.pending_order):
+                return self.pending_order.popleft()
+            return None
 
-    # attempts to get the list of all lobbies from master server
-    def get_lobby_list(self):
-        response = self.wait_for_server_response("lobby_list")
-        return response
+    # fails every request still waiting for a response
+    def _fail_requests(self, exception):
+        with self.request_lock:
+            futures = list(self.pending_requests.values()) + list(self.pending_order)
+            self.pending_requests.clear()
+            self.pending_order.clear()
+        for future in futures:
+            if not (future.done()):
+                future.set_exception(exception)
+
+    # sends a message to master server and only proceed when it recieves
+    # a server response. raises TimeoutError if it takes longer than timeout.
+    def wait_for_server_response(self, message, timeout=DEFAULT_TIMEOUT):
+        future = self.request(message)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            # only succeeds if the request is still waiting to be sent
+            future.cancel()
+            raise
+
+    # attempts to get a page of the list of all lobbies from master server.
+    # returns a future holding the list of lobby ids
+    def get_lobby_list(self, page=0):
+        return self.request(f"lobby_list {page}")
 
     # attempts to create a new lobby on the master server.
-    # expects a boolean value indicating success
+    # returns a future holding a boolean value indicating success
     def create_lobby(self, lobby_id):
-        success = self.wait_for_server_response(f"create_lobby {lobby_id}")
-        return success
+        return self._enter_lobby("create_lobby", lobby_id)
 
     # attempts to join a lobby with the given id
-    # returns a boolean value indicating success
+    # returns a future holding a boolean value indicating success
     def join_lobby(self, lobby_id):
-        success = self.wait_for_server_response(f"join_lobby {lobby_id}")
-        return success
+        return self._enter_lobby("join_lobby", lobby_id)
+
+    # sends a command entering a lobby. framed servers are asked for the
+    # session token right after, so both go out in the same batch.
+    # the lobby is remembered straight away, so a request lost with the
+    # connection still ends up in the lobby after reconnecting.
+    def _enter_lobby(self, command, lobby_id):
+        self.lobby_id = lobby_id
+        future = self.request(f"{command} {lobby_id}")
+        if (self.framed):
+            self.request("resume_token").add_done_callback(self._on_session_token)
+        return future
+
+    # stores the session token, ignoring answers from servers without sessions
+    def _on_session_token(self, future):
+        if (future.exception() is None and isinstance(future.result(), str)
+                and future.result() != "unknown_command"):
+            self.session_token = future.result()
+
+    # attempts to resume the session with the given token, which defaults to
+    # the token of this connection, on this connection. the lobby sends
+    # everything broadcast while the session was away before answering.
+    # returns a future holding a boolean value indicating success
+    def resume(self, token=None):
+        token = token or self.session_token
+        if (token is None):
+            future = Future()
+            future.set_result(False)
+            return future
+        future = self.request(f"resume {token}")
+        future.add_done_callback(lambda future: self._on_resumed(future, token))
+        return future
+
+    def _on_resumed(self, future, token):
+        if (future.exception() is None and future.result() is True):
+            self.session_token = token
 
     # attempts to broadcast message to lobby
-    # returns a boolean value indicating success
+    # returns a future holding a boolean value indicating success
     def broadcast(self, message):
-        success = self.wait_for_server_response(f"lobby_broadcast {message}")
-        return success
+        return self.request(f"lobby_broadcast {message}")
+
+    # attempts to send the bytes of an event to the lobby, which receives them
+    # as a message holding the same bytes. clients that can not read events
+    # are sent the text of fallback instead if given: legacy clients in the
+    # lobby of a framed server, and the whole lobby of a legacy server. without
+    # a fallback, events fail on legacy servers.
+    # returns a future holding a boolean value indicating success
+    def send_event(self, data, fallback=None):
+        return self.request(Event(data, fallback))
@@ -10,80 +10,348 @@ This module interfaces with the League of Legends live game API.
 # =================================================================
 # Imports
 # =================================================================
+import time
+import asyncio
 import requests
+from functools import cached_property
 import urllib3
+from requests.adapters import HTTPAdapter
 
 # =================================================================
 # Constants
 # =================================================================
-API_URL = "https://127.0.0.1:2999/liveclientdata/allgamedata"
+BASE_URL = "https://127.0.0.1:2999"
+ALL_GAME_DATA_PATH = "/liveclientdata/allgamedata"
+EVENT_DATA_PATH = "/liveclientdata/eventdata"
+GAME_STATS_PATH = "/liveclientdata/gamestats"
+PLAYER_LIST_PATH = "/liveclientdata/playerlist"
+ACTIVE_PLAYER_NAME_PATH = "/liveclientdata/activeplayername"
+API_URL = BASE_URL + ALL_GAME_DATA_PATH
 ICON_URL = "http://ddragon.leagueoflegends.com/cdn/12.10.1/img/champion/"
 DEFAULT_TIMEOUT = 2
+PROBE_TIMEOUT = 0.1
+EVENT_TIMEOUT = 0.5
+POLL_INTERVAL = 1
+MAX_BACKOFF = 8
+SNAPSHOT_TTL = 1
 
 # =================================================================
-# Public methods
+# Classes
 # =================================================================
-def live_game_active():
+class ClientStats:
     """
-    Makes an api request and look for the "GameStart" event in response.
-    If the request times out or the event does not exist, return false.
-    If event exists, return true
+    Latency and error counters of the requests made by a LiveClient.
+    Latencies are in seconds.
     """
-    try:
-        response = call_api(0.1)
-        if (response.json()["events"]["Events"][0]["EventName"] == "GameStart"):
-            return True
-        else:
-            return False
-    except Exception as e:
-        return False
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
 
-def get_all_game_data():
+    def record(self, latency, error=False):
+        self.requests += 1
+        self.total_latency += latency
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        if (error):
+            self.errors += 1
+
+    def mean_latency(self):
+        if (self.requests == 0):
+            return 0.0
+        return self.total_latency / self.requests
+
+    def __str__(self):
+        return (f"{self.requests} requests, {self.errors} errors, "
+                f"mean {self.mean_latency() * 1000:.2f}ms, max {self.max_latency * 1000:.2f}ms")
+
+class GameSnapshot:
     """
-    Returns all the live data from the api in the json format.
-    Live_game_active() should be called to verify that there is a game before using
-    this method.
+    A single parsed response of allgamedata.
+    Every view of the game is served from the same parse, and derived views
+    such as the teams are only computed once per snapshot.
     """
-    response = call_api()
-    return response.json()
+    def __init__(self, data, fetched_at=None):
+        self.data = data
+        self.fetched_at = time.monotonic() if fetched_at is None else fetched_at
 
-def get_all_players():
+    def age(self):
+        return time.monotonic() - self.fetched_at
+
+    @property
+    def all_players(self):
+        return self.data["allPlayers"]
+
+    @property
+    def active_player(self):
+        return self.data["activePlayer"]
+
+    @property
+    def events(self):
+        return self.data["events"]["Events"]
+
+    @cached_property
+    def players(self):
+        """
+        Summoner names of all the players in the game
+        """
+        return [player["summonerName"] for player in self.all_players]
+
+    @cached_property
+    def teams(self):
+        """
+        Returns the players of the game split into (blue_team, red_team)
+        """
+        return split_teams(self.all_players)
+
+    @cached_property
+    def enemies(self):
+        """
+        Players on the other team of the local player, None if the local
+        player is not on either team
+        """
+        return find_enemies(self.teams, self.active_player["summonerName"])
+
+    def game_started(self):
+        """
+        Returns true if the first event of the game is "GameStart"
+        """
+        try:
+            return self.events[0]["EventName"] == "GameStart"
+        except (KeyError, IndexError, TypeError):
+            return False
+
+class EventStream:
     """
-    Returns all the players that is in the same live game as client
+    Reads the event log of the game incrementally.
+    A cursor of the next event id is kept, and only events from the cursor and
+    on are requested from the API, so the cost of a poll does not grow with the
+    length of the game. New events are passed to every subscriber, and the
+    stream can also be iterated, either as a generator or an async iterator.
     """
-    response = call_api().json()
-    players = response["allPlayers"]
-    player_list = []
-    for player in players:
-        player_list.append(player["summonerName"])
-    return player_list
+    def __init__(self, client, start_id=0):
+        self.client = client
+        self.next_id = start_id
+        self._subscribers = []
 
-def get_all_enemies():
+    def subscribe(self, callback):
+        """
+        Calls callback with every new event
+        """
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    def poll(self, timeout=EVENT_TIMEOUT):
+        """
+        Fetches the events since the last poll, passes them to the subscribers
+        and returns them. Returns an empty list if the API can not be reached.
+        """
+        try:
+            response = self.client.get(f"{EVENT_DATA_PATH}?eventID={self.next_id}", timeout)
+            events = response.json()["Events"]
+        except Exception as e:
+            return []
+
+        # the cursor is inclusive, so skip anything that has already been seen
+        events = [event for event in events if event["EventID"] >= self.next_id]
+        if (events):
+            self.next_id = events[-1]["EventID"] + 1
+
+        for event in events:
+            for callback in self._subscribers:
+                callback(event)
+        return events
+
+    def __iter__(self):
+        """
+        Yields events as they happen, polling every poll_interval seconds
+        """
+        while True:
+            yield from self.poll()
+            time.sleep(self.client.poll_interval)
+
+    async def __aiter__(self):
+        """
+        Yields events as they happen without blocking the event loop
+        """
+        while True:
+            for event in await asyncio.to_thread(self.poll):
+                yield event
+            await asyncio.sleep(self.client.poll_interval)
+
+class LiveClient:
     """
-    Returns all the players that is on the other team of the local player
+    Keep-alive client for the live game API.
+    All requests share one pooled session, so the TLS connection to the game is
+    made once and reused instead of being set up again for every request.
+    While no game is running, the delay between polls backs off exponentially
+    from poll_interval up to max_backoff.
     """
-    response = call_api().json()
-    summonerName = response["activePlayer"]["summonerName"]
+    def __init__(self, base_url=BASE_URL, poll_interval=POLL_INTERVAL,
+                 max_backoff=MAX_BACKOFF, timeout=DEFAULT_TIMEOUT):
+        self.base_url = base_url
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.stats = ClientStats()
+        self._backoff = poll_interval
+        self._snapshot = None
+
+        # the game serves a self signed certificate on localhost
+        self.session = requests.Session()
+        self.session.verify = False
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, path, timeout=None):
+        """
+        Makes a request to the given path of the API and returns the raw response.
+        Raises on connection errors and error status codes.
+        """
+        start = time.perf_counter()
+        try:
+            response = self.session.get(self.base_url + path, timeout=timeout or self.timeout)
+            response.raise_for_status()
+        except requests.RequestException:
+            self.stats.record(time.perf_counter() - start, error=True)
+            raise
+        self.stats.record(time.perf_counter() - start)
+        return response
 
-    # load all teams
+    def call_api(self, timeout=None):
+        return self.get(ALL_GAME_DATA_PATH, timeout)
+
+    def snapshot(self, max_age=SNAPSHOT_TTL, timeout=None):
+        """
+        Returns a snapshot of all the game data, only fetching and parsing it
+        again if the last snapshot is older than max_age seconds
+        """
+        if (self._snapshot is None or self._snapshot.age() > max_age):
+            data = self.call_api(timeout).json()
+            self._snapshot = GameSnapshot(data)
+        return self._snapshot
+
+    def live_game_active(self):
+        """
+        Asks the api for the stats of the current game, which it only has
+        while a game is running. Only the small gamestats document is fetched
+        and parsed, not all the game data.
+        If the request times out or there are no stats, return false.
+        Updates the delay returned by poll_delay()
+        """
+        try:
+            active = "gameTime" in self.game_stats(PROBE_TIMEOUT)
+        except Exception as e:
+            active = False
+
+        if (active):
+            self._backoff = self.poll_interval
+        else:
+            self._backoff = min(self._backoff * 2, self.max_backoff)
+        return active
+
+    def game_stats(self, timeout=None):
+        """
+        Returns the stats of the current game, such as the game time
+        """
+        return self.get(GAME_STATS_PATH, timeout).json()
+
+    def player_names(self, timeout=None):
+        """
+        Returns the summoner names of all the players from the player list,
+        without fetching the rest of the game data
+        """
+        return [player["summonerName"] for player in self.player_list(timeout)]
+
+    def player_list(self, timeout=None):
+        return self.get(PLAYER_LIST_PATH, timeout).json()
+
+    def teams(self, timeout=None):
+        """
+        Returns (players, enemies) from the player list and the name of the
+        local player, without fetching the rest of the game data
+        """
+        players = self.player_list(timeout)
+        active_player_name = self.get(ACTIVE_PLAYER_NAME_PATH, timeout).json()
+        return players, find_enemies(split_teams(players), active_player_name)
+
+    def events(self, start_id=0):
+        """
+        Returns a stream of the events of the game, starting at start_id
+        """
+        return EventStream(self, start_id)
+
+    def poll_delay(self):
+        """
+        Returns how many seconds to wait before polling for a game again
+        """
+        return self._backoff
+
+# the client used by the module level methods
+client = LiveClient()
+
+# =================================================================
+# Public methods
+# =================================================================
+def split_teams(players):
+    """
+    Returns the players split into (blue_team, red_team)
+    """
     blue_team = []
     red_team = []
-    local_player = None
-    for player in response["allPlayers"]:
+    for player in players:
         if (player["team"] == "ORDER"):
             blue_team.append(player)
         elif (player["team"] == "CHAOS"):
             red_team.append(player)
+    return blue_team, red_team
 
-        if (player["summonerName"] == summonerName):
-            local_player = player
+def find_enemies(teams, summoner_name):
+    """
+    Returns the team of (blue_team, red_team) that the player with the given
+    summoner name is not on, None if the player is on neither team
+    """
+    blue_team, red_team = teams
 
     # determine enemy team based on what team has local player
-    if (local_player in blue_team):
+    if any(player["summonerName"] == summoner_name for player in blue_team):
         return red_team
-    elif (local_player in red_team):
+    elif any(player["summonerName"] == summoner_name for player in red_team):
         return blue_team
 
+def live_game_active():
+    """
+    Makes an api request for the stats of the current game.
+    If the request times out or there are no stats, return false.
+    If there is a game, return true
+    """
+    return client.live_game_active()
+
+def get_all_game_data():
+    """
+    Returns all the live data from the api in the json format.
+    Live_game_active() should be called to verify that there is a game before using
+    this method.
+    """
+    return client.snapshot().data
+
+def get_all_players():
+    """
+    Returns all the players that is in the same live game as client
+    """
+    return client.snapshot().players
+
+def get_all_enemies():
+    """
+    Returns all the players that is on the other team of the local player
+    """
+    return client.snapshot().enemies
+
 
 # =================================================================
 # Private methods
@@ -93,8 +361,7 @@ def call_api(timeout=DEFAULT_TIMEOUT):
     Makes a request to the API and return the result as raw result.
     Return value should be converted into json by method calling this
     """
-    response = requests.get(API_URL, verify=False, timeout=timeout)
-    return response
+    return client.call_api(timeout)
 
 # disable insecure warnings when calling the api without a certificate
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
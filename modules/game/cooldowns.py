@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Keeps track of summoner spell cooldowns as absolute expiry timestamps.
+Nothing is counted down per frame, the remaining time is calculated from the
+clock only when it is asked for.
+"""
+# =================================================================
+# Imports
+# =================================================================
+import time
+
+# =================================================================
+# Constants
+# =================================================================
+FLASH_COOLDOWN = 300
+
+# summoner spell ids, as used by the game data
+FLASH = 4
+
+# base cooldown in seconds of each summoner spell by id
+SPELL_COOLDOWNS = {
+    FLASH: FLASH_COOLDOWN
+}
+
+# item ids, as used by the game data
+IONIAN_BOOTS = 3158
+
+# summoner spell haste granted by each item by id
+ITEM_SUMMONER_HASTE = {
+    IONIAN_BOOTS: 12
+}
+
+def summoner_haste(player):
+    """
+    Returns the summoner spell haste a player of the game data has from the
+    items they hold
+    """
+    return sum(ITEM_SUMMONER_HASTE.get(item["itemID"], 0) for item in player.get("items", ()))
+
+def spell_cooldown(spell_id, haste=0):
+    """
+    Returns the cooldown in seconds of the summoner spell with the given id
+    for a champion with the given summoner spell haste
+    """
+    return SPELL_COOLDOWNS[spell_id] * 100 / (100 + haste)
+
+class GameClock:
+    """
+    The game time of the running game, in seconds.
+    The game time is the same for every client in the game, so timestamps
+    taken from it can be shared between clients. Asking the API for the game
+    time on every read would be too slow, so the clock is synced with the
+    game time now and then and runs on a monotonic clock in between.
+    Call the clock to read it.
+    """
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._offset = -clock() # game time = clock() + offset
+
+    def sync(self, game_time, at=None):
+        """
+        Sets the game time, as it was at the time at of the underlying clock
+        """
+        if (at is None):
+            at = self.clock()
+        self._offset = game_time - at
+
+    def __call__(self):
+        return self.clock() + self._offset
+
+class CooldownStore:
+    """
+    Stores the time each champion's cooldown expires, keyed by champion name.
+    By default times are taken from a monotonic clock, but any clock can be
+    used as long as every timestamp given to the store comes from the same
+    clock, e.g. the game time reported by the live client API, which is the
+    same for every client in a game.
+    """
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._expiry = {}
+
+    def start(self, champion, duration=FLASH_COOLDOWN, started_at=None):
+        """
+        Starts a cooldown of duration seconds for the champion.
+        started_at is the time the spell was cast, defaulting to now.
+        """
+        if (started_at is None):
+            started_at = self.clock()
+        self._expiry[champion] = started_at + duration
+
+    def set_expiry(self, champion, expiry):
+        """
+        Sets the time the cooldown of the champion expires directly
+        """
+        self._expiry[champion] = expiry
+
+    def expiry(self, champion):
+        """
+        Returns the time the cooldown of the champion expires, or None if the
+        champion has no cooldown running
+        """
+        return self._expiry.get(champion)
+
+    def clear(self, champion):
+        self._expiry.pop(champion, None)
+
+    def remaining(self, champion, now=None):
+        """
+        Returns the remaining cooldown of the champion in seconds
+        """
+        expiry = self._expiry.get(champion)
+        if (expiry is None):
+            return 0.0
+        if (now is None):
+            now = self.clock()
+        return max(expiry - now, 0.0)
+
+    def remaining_seconds(self, champion, now=None):
+        """
+        Returns the remaining cooldown of the champion in whole seconds, as it
+        is displayed in the overlay
+        """
+        return int(self.remaining(champion, now))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact binary encoding of a summoner spell being cast, shared between the
+clients of a lobby.
+The event carries the game time the spell was cast at instead of relying on
+when the message arrives, so every client computes the same expiry no matter
+how long the message took to reach it.
+"""
+# =================================================================
+# Imports
+# =================================================================
+import struct
+from modules.game.cooldowns import FLASH, SPELL_COOLDOWNS, spell_cooldown
+
+# =================================================================
+# Constants
+# =================================================================
+VERSION = 1
+
+# version, enemy slot, spell id, summoner spell haste, cast time in game milliseconds
+EVENT_FORMAT = struct.Struct("!BBBBI")
+
+class FlashEvent:
+    """
+    A summoner spell cast by an enemy.
+    slot is the index of the enemy in the player list of the game, which is
+    in the same order for every client in the game. cast_time is the game time
+    of the cast in seconds and haste the summoner spell haste of the enemy as
+    known to the sender.
+    """
+    __slots__ = ("slot", "spell_id", "cast_time", "haste")
+
+    def __init__(self, slot, cast_time, spell_id=FLASH, haste=0):
+        self.slot = slot
+        self.spell_id = spell_id
+        self.cast_time = cast_time
+        self.haste = haste
+
+    def cooldown(self):
+        return spell_cooldown(self.spell_id, self.haste)
+
+    def expiry(self):
+        """
+        Returns the game time the spell is available again
+        """
+        return self.cast_time + self.cooldown()
+
+    def encode(self):
+        return EVENT_FORMAT.pack(VERSION, self.slot, self.spell_id,
+                                 min(max(int(self.haste), 0), 255),
+                                 max(int(self.cast_time * 1000), 0))
+
+    @classmethod
+    def decode(cls, data):
+        """
+        Returns the event encoded in data.
+        Raises ValueError if data is not an event this version understands.
+        """
+        if (len(data) != EVENT_FORMAT.size):
+            raise ValueError(f"flash event must be {EVENT_FORMAT.size} bytes, got {len(data)}")
+        version, slot, spell_id, haste, cast_time = EVENT_FORMAT.unpack(data)
+        if (version != VERSION):
+            raise ValueError(f"unsupported flash event version {version}")
+        # newer clients may send spells this one has no cooldown for
+        if (spell_id not in SPELL_COOLDOWNS):
+            raise ValueError(f"unknown summoner spell {spell_id}")
+        return cls(slot, cast_time / 1000, spell_id, haste)
+
+    def __repr__(self):
+        return (f"FlashEvent(slot={self.slot}, cast_time={self.cast_time}, "
+                f"spell_id={self.spell_id}, haste={self.haste})")
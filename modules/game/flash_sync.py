@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Keeps the flash cooldowns of the enemies in a game in sync with the rest of
+the lobby.
+Flashes clicked locally and flashes sent by teammates are both stored in game
+time, so every client in the game agrees on when they expire. Used by main.py
+and by the client benchmark, which drives the same code without a game.
+"""
+# =================================================================
+# Imports
+# =================================================================
+from modules.game.cooldowns import FLASH, CooldownStore, GameClock, spell_cooldown, summoner_haste
+from modules.game.flash_event import FlashEvent
+
+class FlashSync:
+    """
+    Flash cooldowns of the enemies in the current game.
+    server is the connection to the master server flashes are sent over, a
+    server_connection.Server or an async_connection.AsyncServer. It can be
+    set after creation, as the connection is created with on_message as its
+    message callback.
+    """
+    def __init__(self, server=None):
+        self.server = server
+        self.game_clock = GameClock()
+        self.cooldowns = CooldownStore(self.game_clock)
+        self.enemies = set()
+        self.enemy_slots = {} # champion name -> index in the player list of the game
+        self.slot_champions = {} # index in the player list of the game -> champion name
+        self.haste = {} # champion name -> summoner spell haste
+
+    def add_enemies(self, snapshot):
+        """
+        Registers the enemies in the api.GameSnapshot of the game and returns
+        their champion names
+        """
+        enemies = snapshot.enemies
+        enemy_names = {enemy["summonerName"] for enemy in enemies}
+        for slot, player in enumerate(snapshot.all_players):
+            if (player["summonerName"] in enemy_names):
+                self.enemy_slots[player["championName"]] = slot
+                self.slot_champions[slot] = player["championName"]
+
+        champions = [enemy["championName"] for enemy in enemies]
+        self.enemies.update(champions)
+        self.update_haste(snapshot.all_players)
+        return champions
+
+    def update_haste(self, players):
+        """
+        Updates the summoner spell haste of the enemies from the items in the
+        player list of the game. To be called now and then, e.g. when the
+        game clock is synced, as the enemies buy items during the game
+        """
+        for player in players:
+            if (player["championName"] in self.enemy_slots):
+                self.haste[player["championName"]] = summoner_haste(player)
+
+    def on_message(self, message):
+        """
+        Stores a flash sent by a teammate. To be used as the message callback
+        of the connection to the master server
+        """
+        # flash events from up to date clients carry the time of the flash
+        if (isinstance(message, bytes)):
+            try:
+                event = FlashEvent.decode(message)
+            except ValueError:
+                return
+            champion = self.slot_champions.get(event.slot)
+            if (champion is not None):
+                self.cooldowns.set_expiry(champion, event.expiry())
+
+        # older clients only send the champion name, so the flash is assumed to
+        # have happened when the message arrived
+        elif (message in self.enemies):
+            self.cooldowns.start(message, spell_cooldown(FLASH, self.haste.get(message, 0)))
+
+    def flash(self, champion):
+        """
+        Starts the flash cooldown of the enemy champion and sends it to the
+        lobby. Returns a future holding the answer of the server, or None if
+        the champion is not an enemy
+        """
+        if (champion not in self.enemies):
+            return None
+        flash = FlashEvent(self.enemy_slots[champion], self.game_clock(),
+                           haste=self.haste.get(champion, 0))
+        self.cooldowns.set_expiry(champion, flash.expiry())
+
+        # teammates on older clients, or behind an older server, get the
+        # champion name instead of the event
+        return self.server.send_event(flash.encode(), fallback=champion)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Process wide cache of champion icons for the overlay.
+Icons are decoded once, either from a prebuilt sprite atlas or from the single
+files in the resource folder, and every scaled tkinter image is cached by
+champion and size, so creating players or changing layout does no disk or
+decode work once an icon has been used.
+
+Run this module to build the sprite atlas from the resource folder:
+    python -m modules.overlay.icons
+"""
+# =================================================================
+# Imports
+# =================================================================
+import os
+import json
+import math
+from collections import OrderedDict
+from PIL import ImageTk, Image
+
+# =================================================================
+# Constants
+# =================================================================
+RES_PATH = "modules/overlay/res"
+ATLAS_PATH = f"{RES_PATH}/atlas.png"
+ATLAS_INDEX_PATH = f"{RES_PATH}/atlas.json"
+ATLAS_TILE_SIZE = 120
+DEFAULT_CACHE_SIZE = 64
+
+class LRUCache:
+    """
+    Dictionary that holds at most max_size items, evicting the least
+    recently used item when full
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+
+    def get(self, key):
+        item = self._items.get(key)
+        if (item is not None):
+            self._items.move_to_end(key)
+        return item
+
+    def put(self, key, item):
+        self._items[key] = item
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+class IconCache:
+    """
+    Caches decoded champion images and the scaled tkinter images made from
+    them. Decoded images are looked up in the atlas when one is loaded, and
+    read from the resource folder otherwise.
+    """
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, res_path=RES_PATH):
+        self.res_path = res_path
+        self._sources = LRUCache(max_size)
+        self._images = LRUCache(max_size)
+        self._atlas = None
+        self._atlas_index = {}
+
+    def load_atlas(self, atlas_path=ATLAS_PATH, index_path=ATLAS_INDEX_PATH):
+        """
+        Loads a sprite atlas built by build_atlas(). Returns false if there
+        is no atlas at the given path.
+        """
+        if not (os.path.exists(atlas_path) and os.path.exists(index_path)):
+            return False
+
+        with open(index_path) as index_file:
+            index = json.load(index_file)
+        atlas = Image.open(atlas_path)
+        atlas.load()
+
+        self._atlas = atlas
+        self._atlas_index = {name.lower(): tuple(box) for name, box in index.items()}
+        self._sources.clear()
+        return True
+
+    def get_source(self, champion):
+        """
+        Returns the decoded, unscaled image of the champion
+        """
+        key = _champion_key(champion)
+        source = self._sources.get(key)
+        if (source is not None):
+            return source
+
+        box = self._atlas_index.get(key)
+        if (box is not None):
+            source = self._atlas.crop(box)
+        else:
+            source = Image.open(f"{self.res_path}/{champion.capitalize()}.png")
+            source.load()
+
+        self._sources.put(key, source)
+        return source
+
+    def get_image(self, champion, width, height):
+        """
+        Returns the image of the champion scaled to the given size as usable
+        image for tkinter
+        """
+        key = (_champion_key(champion), int(width), int(height))
+        image = self._images.get(key)
+        if (image is None):
+            scaled_image = self.get_source(champion).resize((int(width), int(height)))
+            image = ImageTk.PhotoImage(scaled_image)
+            self._images.put(key, image)
+        return image
+
+def build_atlas(res_path=RES_PATH, atlas_path=ATLAS_PATH, index_path=ATLAS_INDEX_PATH,
+                tile_size=ATLAS_TILE_SIZE):
+    """
+    Packs every champion icon in the resource folder into a single image in a
+    square grid, and writes an index of where each champion is in the atlas.
+    Returns the number of icons packed.
+    """
+    files = sorted(name for name in os.listdir(res_path)
+                   if name.endswith(".png") and name != os.path.basename(atlas_path))
+    columns = max(math.ceil(math.sqrt(len(files))), 1)
+    rows = max(math.ceil(len(files) / columns), 1)
+
+    atlas = Image.new("RGBA", (columns * tile_size, rows * tile_size))
+    index = {}
+    for i, name in enumerate(files):
+        x = (i % columns) * tile_size
+        y = (i // columns) * tile_size
+        with Image.open(os.path.join(res_path, name)) as icon:
+            atlas.paste(icon.convert("RGBA").resize((tile_size, tile_size)), (x, y))
+        index[os.path.splitext(name)[0]] = [x, y, x + tile_size, y + tile_size]
+
+    atlas.save(atlas_path)
+    with open(index_path, "w") as index_file:
+        json.dump(index, index_file, indent=1, sort_keys=True)
+    return len(files)
+
+def _champion_key(champion):
+    return champion.lower()
+
+# the cache shared by every overlay in the process
+icon_cache = IconCache()
+
+if __name__ == "__main__":
+    print(f"Packed {build_atlas()} icons into {ATLAS_PATH}")
@@ -13,21 +13,15 @@ Create a window overlay to display information inside the game
 import tkinter as tk
 import modules.overlay.screens as screens
 #import screens
-from PIL import ImageTk, Image
+from modules.overlay.icons import icon_cache
 
 def create_champion_image(champion, width, height):
     """
-    Loads the correct image from resource folder based on champion name.
-    Resizes it to the specified size and returns it as usable image for tkinter
+    Returns the image of the champion resized to the specified size as usable
+    image for tkinter. Images are shared through the process wide icon cache,
+    so only the first request for a champion and size does any work
     """
-    # load image based on champion name
-    champion = champion.capitalize()
-    raw_image = Image.open(f"modules/overlay/res/{champion}.png")
-    scaled_image = raw_image.resize((int(width), int(height)))
-
-    # convert to tkinter format and return it
-    image = ImageTk.PhotoImage(scaled_image)
-    return image
+    return icon_cache.get_image(champion, width, height)
 
 class Overlay:
     """
@@ -38,6 +32,9 @@ class Overlay:
         # create main window
         self.root = tk.Tk()
 
+        # decode all champion icons at once if a sprite atlas has been built
+        icon_cache.load_atlas()
+
         # calculate size of window based on screen size
         self.width = screens.width_unit() * width
         self.height = screens.height_unit() * height
@@ -69,6 +66,11 @@ class Overlay:
         # initialize empty list of players to be added via main script
         self.players = []
 
+        # players with changes that have not been drawn yet. they are all
+        # drawn together once tkinter is idle
+        self._dirty_players = {}
+        self._flush_scheduled = False
+
     def start(self):
         self.root.mainloop()
 
@@ -92,7 +94,25 @@ class Overlay:
 
         self.players.append(Player(self.root, desired_width, desired_height,
                                    desired_position[0], desired_position[1],
-                                   champion, on_click))
+                                   champion, on_click, self._mark_dirty))
+
+    def flush(self):
+        """
+        Draws every pending player change in one go.
+        Called automatically when tkinter is idle after a change was made.
+        """
+        self._flush_scheduled = False
+        dirty_players = self._dirty_players
+        self._dirty_players = {}
+        for player in dirty_players:
+            player.render()
+
+    def _mark_dirty(self, player):
+        "Called by a player when it has changes to draw"
+        self._dirty_players[player] = None
+        if not (self._flush_scheduled):
+            self._flush_scheduled = True
+            self.root.after_idle(self.flush)
 
     def __on_grip_start(self, event):
         "Called when the player presses mouse down on the main window"
@@ -116,8 +136,10 @@ class Player:
     """
     Canvas item to be added to the main overlay. Displays the champion icon
     with a number representing flash cooldown.
+    The text is retained: setting the same text again does nothing, and changes
+    are drawn when the overlay flushes instead of immediately.
     """
-    def __init__(self, window, width, height, x, y, champion, on_click):
+    def __init__(self, window, width, height, x, y, champion, on_click, on_dirty=None):
         # create the actual canvas
         self.canvas = tk.Canvas(window, width=width, height=height)
 
@@ -130,6 +152,11 @@ class Player:
 
         # create text label and set it to hidden by default
         self.cooldown = self.canvas.create_text(18, 19, text="0", fill="white", font=('Helvetica 15 bold'))
+        self.rendered_text = "0"
+        self.text = "0"
+
+        # called when the player has changes to draw, draws right away if not set
+        self.on_dirty = on_dirty
 
         # bind callback of clicking on icon
         self.canvas.bind("<Button-1>", lambda event, arg=champion: on_click(event, arg))
@@ -138,7 +165,23 @@ class Player:
         self.canvas.place(x=x, y=y)
 
     def set_text(self, time):
-        self.canvas.itemconfig(self.cooldown, text=str(time))
+        text = str(time)
+        if (text == self.text):
+            return
+        self.text = text
+
+        if (self.on_dirty is not None):
+            self.on_dirty(self)
+        else:
+            self.render()
+
+    def render(self):
+        """
+        Draws the current text if it differs from what is on the canvas
+        """
+        if (self.text != self.rendered_text):
+            self.canvas.itemconfig(self.cooldown, text=self.text)
+            self.rendered_text = self.text
 
 def click(event, arg):
     print(arg)
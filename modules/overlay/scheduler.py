@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runs recurring work on the tkinter event loop at fixed rates, so the overlay
+only wakes up when there is something to do instead of spinning on update().
+The tasks can also run on an asyncio event loop, which then drives tkinter as
+well, so network code on the same loop shares the UI thread with the overlay.
+"""
+# =================================================================
+# Imports
+# =================================================================
+import time
+import _tkinter
+from tkinter import TclError
+
+# seconds between runs of the tkinter event queue when an asyncio loop drives
+# the overlay. while tkinter has nothing to do the interval doubles up to
+# MAX_TK_PUMP_INTERVAL, and it drops back as soon as events arrive, e.g. the
+# mouse moving over the overlay ahead of a click
+TK_PUMP_INTERVAL = 0.02
+MAX_TK_PUMP_INTERVAL = 0.16
+
+class TickStats:
+    """
+    Timing statistics for a single scheduled task. All times are in seconds.
+    """
+    def __init__(self):
+        self.ticks = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.last_time = 0.0
+        self.late_ticks = 0
+
+    def record(self, duration, late):
+        self.ticks += 1
+        self.total_time += duration
+        self.last_time = duration
+        self.max_time = max(self.max_time, duration)
+        if (late):
+            self.late_ticks += 1
+
+    def mean_time(self):
+        if (self.ticks == 0):
+            return 0.0
+        return self.total_time / self.ticks
+
+    def __str__(self):
+        return (f"{self.ticks} ticks, mean {self.mean_time() * 1000:.2f}ms, "
+                f"max {self.max_time * 1000:.2f}ms, {self.late_ticks} late")
+
+class Task:
+    """
+    A callback that is called every interval seconds until cancelled.
+    Deadlines are kept on a fixed grid, so time spent in the callback or in
+    tkinter does not make the task drift.
+    """
+    def __init__(self, scheduler, name, interval, callback):
+        self.scheduler = scheduler
+        self.name = name
+        self.interval = interval
+        self.callback = callback
+        self.stats = TickStats()
+        self.cancelled = False
+        self.deadline = time.monotonic()
+        self._after_id = None
+
+    def cancel(self):
+        self.cancelled = True
+        if (self._after_id is not None):
+            self.scheduler.cancel(self._after_id)
+            self._after_id = None
+
+    def _schedule(self):
+        delay = max(0, self.deadline - time.monotonic())
+        self._after_id = self.scheduler.after(delay, self._run)
+
+    def _run(self):
+        self._after_id = None
+        if (self.cancelled):
+            return
+
+        start = time.monotonic()
+        late = start - self.deadline > self.interval
+        self.callback()
+        self.stats.record(time.monotonic() - start, late)
+        # repaint what the callback changed without waiting for the pump
+        if (self.scheduler.loop is not None):
+            self.scheduler._handle_tk_events()
+
+        # skip the ticks that were missed instead of running them back to back
+        self.deadline += self.interval
+        if (self.deadline < time.monotonic()):
+            self.deadline = time.monotonic() + self.interval
+
+        if not (self.cancelled):
+            self._schedule()
+
+class Scheduler:
+    """
+    Schedules tasks on the event loop of a tkinter root window.
+    Every callback runs on the tkinter thread, so they may touch widgets freely.
+    When an asyncio loop is given, the tasks are scheduled on it instead and
+    run() drives both from the same thread.
+    """
+    def __init__(self, root, loop=None):
+        self.root = root
+        self.loop = loop
+        self.tasks = {}
+
+    def every(self, interval, callback, name=None):
+        """
+        Calls callback every interval seconds, starting right away.
+        Returns the task, which can be cancelled.
+        """
+        task = Task(self, name or callback.__name__, interval, callback)
+        self.tasks[task.name] = task
+        task._schedule()
+        return task
+
+    def at_rate(self, rate, callback, name=None):
+        """
+        Calls callback rate times per second.
+        """
+        return self.every(1 / rate, callback, name)
+
+    def after(self, delay, callback):
+        """
+        Calls callback once after delay seconds.
+        Returns an id that can be given to cancel()
+        """
+        if (self.loop is not None):
+            return self.loop.call_later(delay, callback)
+        return self.root.after(int(delay * 1000), callback)
+
+    def cancel(self, after_id):
+        """
+        Cancels a callback scheduled with after()
+        """
+        if (self.loop is not None):
+            after_id.cancel()
+        else:
+            self.root.after_cancel(after_id)
+
+    def stats(self):
+        """
+        Returns the timing statistics of every task by name
+        """
+        return {name: task.stats for name, task in self.tasks.items()}
+
+    def run(self):
+        """
+        Runs the event loop, blocking until the window is closed or stop()
+        is called
+        """
+        if (self.loop is None):
+            self.root.mainloop()
+            return
+
+        # the asyncio loop sleeps until its next timer or socket is ready.
+        # tkinter has no file descriptor to wait on that works everywhere, so
+        # its queued events are handled every TK_PUMP_INTERVAL instead
+        self.loop.call_soon(self._pump, TK_PUMP_INTERVAL)
+        self.loop.run_forever()
+
+    def _pump(self, interval):
+        try:
+            if not (self.root.winfo_exists()):
+                raise TclError("window was destroyed")
+            busy = self._handle_tk_events()
+        except TclError:
+            self.loop.stop()
+            return
+        interval = TK_PUMP_INTERVAL if busy else min(interval * 2, MAX_TK_PUMP_INTERVAL)
+        self.loop.call_later(interval, self._pump, interval)
+
+    # handles every queued tkinter event without waiting for new ones.
+    # returns True if there were any
+    def _handle_tk_events(self):
+        handled = False
+        while self.root.tk.dooneevent(_tkinter.ALL_EVENTS | _tkinter.DONT_WAIT):
+            handled = True
+        return handled
+
+    def stop(self):
+        """
+        Makes run() return
+        """
+        if (self.loop is not None):
+            self.loop.stop()
+        else:
+            self.root.quit()
@@ -0,0 +1,168 @@
+# Low overhead metrics for the server.
+#
+# Metrics are plain counters kept in memory and only turned into text when
+# someone asks for them, so recording a value on the hot path is a single
+# addition. The text uses the Prometheus exposition format, so the endpoint
+# can be scraped by Prometheus or simply read with curl:
+#
+#   python server.py 0.0.0.0 3389 --metrics-port 9100
+#   curl http://127.0.0.1:9100/metrics
+#
+# Counters only ever go up, rates such as messages per second are derived
+# from two scrapes. When running sharded, every worker keeps its own metrics.
+import bisect
+import socket
+import selectors
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+# upper bounds of the histogram buckets counting things, like lobby members
+SIZE_BUCKETS = (1, 2, 4, 5, 8, 10, 16, 32, 64)
+
+# a value that only goes up
+class Counter:
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, "", self.value
+
+# a counter split up by the value of a single label, e.g. the command name
+class LabelledCounter:
+    def __init__(self, name, description, label):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.values = {}
+
+    def inc(self, label_value, amount=1):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def samples(self):
+        for label_value, value in sorted(self.values.items()):
+            yield self.name, f'{{{self.label}="{label_value}"}}', value
+
+# a value that is read from the given function when the metrics are rendered,
+# so things that are already tracked elsewhere cost nothing to expose
+class Gauge:
+    def __init__(self, name, description, function):
+        self.name = name
+        self.description = description
+        self.function = function
+
+    def samples(self):
+        yield self.name, "", self.function()
+
+# counts observed values into buckets of fixed upper bounds
+class Histogram:
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield f"{self.name}_bucket", f'{{le="{bound}"}}', total
+        yield f"{self.name}_bucket", '{le="+Inf"}', self.count
+        yield f"{self.name}_sum", "", self.sum
+        yield f"{self.name}_count", "", self.count
+
+# holds every metric of the server and renders them as text.
+# names must be unique, prometheus rejects metrics that appear twice.
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        if any(existing.name == metric.name for existing in self.metrics):
+            raise ValueError(f"metric {metric.name} is already registered")
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, description):
+        return self.register(Counter(name, description))
+
+    def labelled_counter(self, name, description, label):
+        return self.register(LabelledCounter(name, description, label))
+
+    def gauge(self, name, description, function):
+        return self.register(Gauge(name, description, function))
+
+    def histogram(self, name, description, buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, description, buckets))
+
+    # returns every metric in the prometheus text format
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            metric_type = {Counter: "counter", LabelledCounter: "counter",
+                           Gauge: "gauge", Histogram: "histogram"}[type(metric)]
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric_type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+# the metrics of this server process
+registry = Registry()
+
+# serves the registry over http on its own port, from the event loop of the
+# server. every request gets the metrics, whatever its path, and the
+# connection is closed afterwards.
+class MetricsEndpoint:
+    def __init__(self, host, port, registry=registry):
+        self.registry = registry
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(16)
+        self.socket.setblocking(0)
+
+    # registers the endpoint with the selector of the server
+    def serve(self, selector):
+        self.selector = selector
+        selector.register(self.socket, selectors.EVENT_READ, lambda mask: self._accept())
+
+    def _accept(self):
+        try:
+            connection, address = self.socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        connection.setblocking(0)
+        self.selector.register(connection, selectors.EVENT_READ,
+                               lambda mask: self._respond(connection))
+
+    # answers once the request has arrived. the response is small, so it is
+    # written with a short blocking send rather than buffered.
+    def _respond(self, connection):
+        self.selector.unregister(connection)
+        try:
+            connection.recv(4096)
+            body = self.registry.render().encode()
+            header = ("HTTP/1.1 200 OK\r\n"
+                      "Content-Type: text/plain; version=0.0.4\r\n"
+                      f"Content-Length: {len(body)}\r\n"
+                      "Connection: close\r\n\r\n").encode()
+            connection.settimeout(1)
+            connection.sendall(header + body)
+        except OSError:
+            pass
+        finally:
+            connection.close()
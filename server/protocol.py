@@ -0,0 +1,163 @@
+# Framed wire protocol shared by the server and the clients.
+# Every frame starts with a fixed size header followed by a typed payload:
+#
+#   | payload length (4) | frame type (1) | data type (1) | request id (4) | payload |
+#
+# Because every frame carries its own length, any number of frames can arrive
+# in a single read and a frame can be split over several reads without being
+# garbled. The payload is never split on a separator, so content may contain
+# any character, including "|".
+#
+# The request id is chosen by the client for every command and echoed back by
+# the server on the response, so several requests can be in flight at once and
+# every response finds its way back to the caller that sent the request.
+# Frames that are not an answer to a request use NO_REQUEST.
+#
+# This module is imported both by the server (as "protocol") and by the
+# clients (as "server.protocol"), so it must not import anything from the
+# rest of the project.
+import json
+import struct
+
+# sent by a framed client as the very first bytes of a connection. the server
+# answers with the same bytes when it understands the framed protocol.
+# legacy commands are plain text and can never start with a null byte.
+HANDSHAKE = b"\x00FTP\x01"
+
+HEADER = struct.Struct("!IBBI")
+MAX_FRAME_SIZE = 1024 * 1024
+NO_REQUEST = 0
+
+# clients send a ping whenever they have sent nothing else for
+# HEARTBEAT_INTERVAL seconds, which is answered with a pong. either side may
+# consider the other gone when it has heard nothing for HEARTBEAT_TIMEOUT.
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT = 30
+
+# raised when the stream can not be decoded, the connection should be dropped
+class ProtocolError(ValueError):
+    pass
+
+# the kind of frame, mirrors MessageType in server_utils with added
+# types for commands sent from client to server.
+# a batch carries a list of commands and is answered by a single response
+# holding the list of their results, in order.
+# an event carries bytes the server relays to the lobby of the sender without
+# looking at them, as a message. it is answered with a boolean response.
+# a ping is answered with a pong carrying the same request id.
+class FrameType:
+    COMMAND = 1
+    RESPONSE = 2
+    MESSAGE = 3
+    BATCH = 4
+    EVENT = 5
+    PING = 6
+    PONG = 7
+
+# data type of the payload, so the receiver gets back the type that was sent
+class DataType:
+    NONE = 0
+    STR = 1
+    BOOL = 2
+    LIST = 3
+    BYTES = 4
+
+# converts a python value into its data type and payload bytes
+def _encode_payload(content):
+    if (content is None):
+        return DataType.NONE, b""
+    elif (isinstance(content, bool)):
+        return DataType.BOOL, b"\x01" if content else b"\x00"
+    elif (isinstance(content, str)):
+        return DataType.STR, content.encode("utf-8")
+    elif (isinstance(content, (bytes, bytearray, memoryview))):
+        return DataType.BYTES, bytes(content)
+    elif (isinstance(content, (list, tuple))):
+        return DataType.LIST, json.dumps(list(content)).encode("utf-8")
+    raise ProtocolError(f"can not encode content of type {type(content).__name__}")
+
+# converts a payload back into the python value it was encoded from.
+# payload is a memoryview into the decoders buffer.
+# raises ProtocolError for payloads that could not have been encoded.
+def _decode_payload(data_type, payload):
+    if (data_type == DataType.NONE):
+        return None
+    elif (data_type == DataType.BOOL):
+        if (len(payload) != 1):
+            raise ProtocolError(f"bool payload of {len(payload)} bytes")
+        return payload[0] == 1
+    elif (data_type == DataType.BYTES):
+        return payload.tobytes()
+    try:
+        if (data_type == DataType.STR):
+            return str(payload, "utf-8")
+        elif (data_type == DataType.LIST):
+            content = json.loads(str(payload, "utf-8"))
+            if not (isinstance(content, list)):
+                raise ProtocolError("list payload does not hold a list")
+            return content
+    except ValueError as e:
+        raise ProtocolError(f"malformed payload: {e}") from e
+    raise ProtocolError(f"unknown data type {data_type}")
+
+# returns the bytes of a single frame ready to be written to a socket
+def encode_frame(frame_type, content, request_id=NO_REQUEST):
+    data_type, payload = _encode_payload(content)
+    return HEADER.pack(len(payload), frame_type, data_type, request_id) + payload
+
+# returns the commands carried by a frame, a single command or a batch of
+# them. frames of any other type carry none.
+# raises ProtocolError for commands a well behaved client never sends.
+def frame_commands(frame_type, content):
+    if (frame_type == FrameType.COMMAND):
+        if not (isinstance(content, str)):
+            raise ProtocolError("command is not a string")
+        return [content]
+    if (frame_type == FrameType.BATCH):
+        if not (isinstance(content, list)
+                and all(isinstance(command, str) for command in content)):
+            raise ProtocolError("batch is not a list of commands")
+        return content
+    return []
+
+# incremental decoder for a stream of frames.
+# bytes are fed in as they are read from the socket, and every complete frame
+# found in the buffer is returned. incomplete frames are kept until the rest
+# arrives. frames are parsed through a memoryview of the buffer, so payloads
+# are only copied once, when they are turned into their python value.
+class FrameDecoder:
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+
+    # adds data to the buffer and returns a list of
+    # (frame_type, request_id, content) for every complete frame that is now available.
+    def feed(self, data):
+        self._buffer += data
+        frames = []
+        offset = 0
+        with memoryview(self._buffer) as view:
+            while len(view) - offset >= HEADER.size:
+                length, frame_type, data_type, request_id = HEADER.unpack_from(view, offset)
+                if (length > self.max_frame_size):
+                    raise ProtocolError(f"frame of {length} bytes exceeds limit")
+
+                end = offset + HEADER.size + length
+                if (end > len(view)):
+                    break
+
+                payload = view[offset + HEADER.size:end]
+                frames.append((frame_type, request_id, _decode_payload(data_type, payload)))
+                payload.release()
+                offset = end
+
+        # drop everything that has been consumed, keeping any partial frame
+        if (offset):
+            del self._buffer[:offset]
+        return frames
+
+    # removes and returns the bytes waiting for the rest of a frame
+    def take_pending(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
@@ -1,260 +1,937 @@
-import threading
-import time
-import argparse
-import server_utils
-from server_utils import NetworkMessage, Command, ServerCommands, MessageType
-from datetime import datetime
-
-# wrapper class for the socket module to easily interface with the created socket
-class Socket:
-    def __init__(self, host, port):
-        import socket
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.bind((host, port))
-        self.socket.listen(1000)
-        self.socket.setblocking(0)
-
-    # create a separate thread to listen for connections.
-    def accept_connections(self, connection_callback):
-        self.accept_thread = threading.Thread(target=self._connection_listener,
-                                              args=(connection_callback,)
-                                              ).start()
-
-    # listens for connections and returns new connection in callback
-    def _connection_listener(self, callback):
-        while True:
-            try:
-                c, a = self.socket.accept()
-                if not c: continue
-                callback(c, a)
-            except BlockingIOError:
-                pass
-
-# class for keeping clients grouped together and only sending information to
-# other clients in the same lobby.
-class Lobby:
-    def __init__(self, lobby_id, master_client, deletion_callback):
-        self.id = lobby_id # identifier for lobby
-        self.master_client = master_client # client that made lobby
-        self.clients = [] # all clients currently in lobby
-        self.deletion_callback = deletion_callback # function to be called when lobby is deleted
-
-        # add master client to list of clients
-        self.add_client(self.master_client)
-
-    # adds the client to the lobby.
-    # client_in_lobby() should already have been used to prevent duplicates
-    def add_client(self, client):
-        self.clients.append(client)
-        client.current_lobby = self
-        self.broadcast(client, f"{client.address} joined the lobby")
-
-    # removes the client from client list.
-    # will transfer ownership of lobby to next in list.
-    # if there are no other clients in lobby to transfer ownership to,
-    # lobby will close.
-    def remove_client(self, client):
-        self.clients.remove(client)
-
-        # there are more clients in lobby
-        if (len(self.clients) > 0):
-            self.master_client = self.clients[0]
-
-        # no other client in lobby
-        else:
-            self.deletion_callback(self)
-
-    # sends a message to all the clients in the lobby except for the sender.
-    def broadcast(self, sender, message):
-        for client in self.clients:
-            if (client != sender):
-                client.send_message(MessageType.MESSAGE, message)
-
-    # compares the client passed to method with all clients connected to this room.
-    # return bool indicating whether client is found
-    def client_in_lobby(self, client):
-        if client in self.clients:
-            return True
-        return False
-
-# class for interfacing with a connection
-class Client:
-    def __init__(self, connection, address):
-        self.connection = connection
-        self.address = address
-        self.current_lobby = None
-
-    # starts a new loop to listen for messages from the client.
-    # will trigger message callback when data is recieved.
-    # calls disconnect_callback and exits loop when
-    # encountering connection reset error.
-    def start_listening(self, message_callback, disconnect_callback):
-        while True:
-            try:
-                data = self.connection.recv(1024)
-                if not data: continue
-                message_callback(NetworkMessage(self, data))
-            except ConnectionResetError:
-                disconnect_callback(self)
-                break
-            except BlockingIOError:
-                pass
-
-    # sends a message to the client.
-    # type of message distinguises from a server message and lobby message.
-    # the data type of message content will also be send as prefix.
-    # because message has different parts, using the char "|" in content will break server.
-    def send_message(self, message_type, message_content):
-        data_type = type(message_content).__name__
-        message = str.encode(f"{message_type}|{data_type}|{message_content}")
-        self.connection.send(message)
-
-    # determines if the client is in a lobby and returns result as bool
-    def in_lobby(self):
-        if (self.current_lobby != None):
-            return True
-        return False
-
-# main class for the server
-class Server:
-    def __init__(self, host, port, is_verbose=False):
-        # set extra info flag
-        self.verbose = is_verbose
-
-        # create socket and start listening for connections
-        self.socket = Socket(host, port)
-        self.socket.accept_connections(self._on_new_connection)
-        self._log(f"Created a socket on {(host, port)}")
-
-        # create master list of all clients connected to the server
-        self.client_list = []
-
-        # create a list of all the lobbies currently active
-        self.lobby_list = []
-
-    # callback when a new connection is established to the socket
-    # will create a new client object and start listening for messages on a new thread
-    # stores the client in the master list
-    def _on_new_connection(self, connection, address):
-        self._log(f"Got a new connection from {address}")
-        new_client = Client(connection, address)
-        self.client_list.append(new_client)
-        threading.Thread(target=new_client.start_listening,
-                         args=(self._on_message, self._on_disconnect)).start()
-
-    # called when a client has sent a message to the server.
-    # all messages to be recieved from a client will be in the form of a command.
-    # commands are in the format: COMMAND OPT_ARG1, OPT_ARG2, ...
-    def _on_message(self, message):
-        command = Command(message.content)
-
-        # LOBBY LIST
-        if (command.prefix == ServerCommands.LOBBY_LIST):
-            self._log(f"{message.sender.address} requested lobby list")
-            lobbies = []
-            for lobby in self.lobby_list:
-                lobbies.append(lobby.id)
-            message.sender.send_message(MessageType.RESPONSE, lobbies)
-
-        # LOBBY CREATION
-        elif (command.prefix == ServerCommands.CREATE_LOBBY):
-                lobby_id = command.args[0]
-                if not (self._is_lobby(lobby_id)):
-                    new_lobby = Lobby(lobby_id, message.sender, self._on_lobby_deletion)
-                    self.lobby_list.append(new_lobby)
-                    self._log(f"{message.sender.address} created lobby with id: {lobby_id}")
-                    message.sender.send_message(MessageType.RESPONSE, True)
-
-                # lobby already exists
-                else:
-                    error_message = f"{message.sender.address} failed to create lobby with id: {lobby_id}"
-                    self._log(error_message)
-                    message.sender.send_message(MessageType.RESPONSE, False)
-
-        # LOBBY JOINING
-        elif (command.prefix == ServerCommands.JOIN_LOBBY):
-            lobby_id = command.args[0]
-            if (self._is_lobby(lobby_id)):
-                desired_lobby = self._get_lobby_by_id(lobby_id)
-
-                # check that client is not already in the lobby
-                if not (desired_lobby.client_in_lobby(message.sender)):
-                    desired_lobby.add_client(message.sender)
-                    self._log(f"{message.sender.address} joined lobby {lobby_id}")
-                    message.sender.send_message(MessageType.RESPONSE, True)
-
-                # client is already in the lobby
-                else:
-                    self._log(f"{message.sender.address} attempted to join lobby it's already in ({lobby_id})")
-                    message.sender.send_message(MessageType.RESPONSE, False)
-
-            # lobby does not exist
-            else:
-                self._log(f"{message.sender.address} attempted to join lobby that does not exist ({lobby_id})")
-                message.sender.send_message(MessageType.RESPONSE, False)
-
-        # LOBBY BROADCAST
-        elif (command.prefix == ServerCommands.LOBBY_BROADCAST):
-            msg = command.args[0]
-            # make sure client is in a lobby
-            if (message.sender.in_lobby()):
-                message.sender.current_lobby.broadcast(message.sender, msg)
-                self._log(f"{message.sender.address} broadcasted {msg} to lobby {message.sender.current_lobby.id}")
-                message.sender.send_message(MessageType.RESPONSE, True)
-
-            # client not in lobby
-            else:
-                self._log(f"{message.sender.address} tried to broadcast while not in lobby")
-                message.sender.send_message(MessageType.RESPONSE, False)
-
-        # UNKNOWN COMMAND
-        else:
-            message.sender.send_message(MessageType.RESPONSE, "unknown_command")
-            self._log(f"{message.sender.address} requested unknown command: {command.prefix}")
-
-    # called when a client has disconnected from server
-    def _on_disconnect(self, client):
-        self._log(f"{client.address} disconnected from server")
-
-        # remove client from lobby if in one
-        if (client.in_lobby()):
-            client.current_lobby.remove_client(client)
-
-        # remove client from master client list
-        self.client_list.remove(client)
-
-    # called when a lobby has no more clients in it
-    def _on_lobby_deletion(self, lobby):
-        self.lobby_list.remove(lobby)
-        self._log(f'Lobby "{lobby.id}" has been deleted due to no clients in it')
-
-    # prints the message to console if verbose is enabled.
-    # stores log in output file on shutdown
-    def _log(self, message):
-        if (self.verbose):
-            time = datetime.now().strftime("%H:%M:%S")
-            print(f"[{time}]: {message}")
-
-    # looks through all the active lobbies and determines if anyone has a
-    # corresponding id.
-    def _is_lobby(self, lobby_id):
-        for lobby in self.lobby_list:
-            if (lobby.id == lobby_id):
-                return True
-        return False
-
-    # returns a reference to the lobby with the given id
-    def _get_lobby_by_id(self, lobby_id):
-        for lobby in self.lobby_list:
-            if (lobby.id == lobby_id):
-                return lobby
-
-if __name__ == '__main__':
-    # argument parsing
-    parser = argparse.ArgumentParser()
-    parser.add_argument('host', type=str, help="The address to listen on")
-    parser.add_argument('port', type=int, help="The port to listen on")
-    parser.add_argument('--verbal', action='store_true', help="Server logs more information")
-    arguments = parser.parse_args()
-
-    Server(arguments.host, arguments.port, arguments.verbal)
+import time
+import secrets
+import traceback
+import importlib
+import selectors
+import collections
+import socket
+import argparse
+import itertools
+import weakref
+import server_utils
+from server_utils import (NetworkMessage, BatchResponse, Command, CommandRegistry,
+                          ServerCommands, MessageType, enable_keepalive)
+from protocol import (HANDSHAKE, NO_REQUEST, HEARTBEAT_TIMEOUT, FrameDecoder, FrameType,
+                      ProtocolError, encode_frame, frame_commands)
+from metrics import registry, MetricsEndpoint, SIZE_BUCKETS
+from datetime import datetime
+
+# maximum amount of lobby ids returned by a single lobby_list command
+LOBBY_PAGE_SIZE = 100
+
+# backpressure limits of the data waiting to be written to a single client.
+# above PAUSE_READING_BYTES no more commands are read from the client until it
+# has caught up, so a client that does not read its responses can not make the
+# server buffer without end. a client with more than MAX_QUEUED_BYTES waiting
+# is too slow to keep up with its lobby and is disconnected.
+PAUSE_READING_BYTES = 64 * 1024
+MAX_QUEUED_BYTES = 1024 * 1024
+
+# seconds between passes of the reaper, which disconnects dead clients and
+# deletes abandoned lobbies
+REAP_INTERVAL = 5
+
+# seconds a client that has started the handshake gets to finish it.
+# clients that have sent nothing at all are never timed out, legacy clients
+# connect at startup and stay silent until their game starts, and tcp
+# keepalive already finds the ones that are gone
+NEGOTIATION_TIMEOUT = 10
+
+# seconds a client that lost its connection keeps its place in the lobby,
+# and the number of broadcasts kept for it until it resumes its session
+RESUME_TIMEOUT = 120
+MAX_MISSED_MESSAGES = 64
+
+# seconds without a join or broadcast after which a lobby is considered
+# abandoned and deleted, well over the length of a game
+LOBBY_IDLE_TIMEOUT = 3 * 60 * 60
+
+# longest a worker of a sharded server waits for the responses it still owes
+# a client to be written before handing the client to another worker
+HAND_BACK_TIMEOUT = 1
+
+# metrics recorded on the hot path, see metrics.py
+connections_total = registry.counter("flash_connections_total", "Connections accepted")
+disconnects_total = registry.counter("flash_disconnects_total", "Connections closed")
+# commands without a handler are counted as unknown, so clients can not
+# create new metrics by sending garbage
+messages_total = registry.labelled_counter("flash_messages_total", "Commands received", "command")
+bytes_in = registry.counter("flash_bytes_received_total", "Bytes read from clients")
+bytes_out = registry.counter("flash_bytes_sent_total", "Bytes written to clients")
+broadcast_latency = registry.histogram("flash_broadcast_seconds",
+                                       "Time to queue a broadcast to every client in the lobby")
+broadcast_fanout = registry.histogram("flash_broadcast_recipients",
+                                      "Clients a broadcast is queued to", SIZE_BUCKETS)
+slow_consumers_total = registry.counter("flash_slow_consumers_total",
+                                        "Clients disconnected for falling too far behind")
+resumes_total = registry.counter("flash_resumes_total", "Sessions resumed after a reconnect")
+reaped_total = registry.labelled_counter("flash_reaped_total",
+                                         "Clients and lobbies removed by the reaper", "reason")
+client_errors_total = registry.counter("flash_client_errors_total",
+                                       "Clients disconnected for an error handling their data")
+handbacks_total = registry.counter("flash_handbacks_total",
+                                   "Connections handed back to be routed to another worker")
+
+# servers of this process. the gauges read what the servers already keep
+# track of when the metrics are rendered, summed over every server
+servers = weakref.WeakSet()
+registry.gauge("flash_clients", "Clients currently connected",
+               lambda: sum(len(server.client_list) for server in servers))
+registry.gauge("flash_lobbies", "Lobbies currently active",
+               lambda: sum(len(server.lobbies) for server in servers))
+registry.gauge("flash_sessions", "Sessions in lobbies, including detached ones",
+               lambda: sum(len(server.sessions) for server in servers))
+
+# wrapper class for the socket module to easily interface with the created socket
+class Socket:
+    def __init__(self, host, port):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(1000)
+        self.socket.setblocking(0)
+
+    # registers the listening socket with the selector, so the event loop
+    # will call connection_callback whenever there are connections to accept.
+    def accept_connections(self, selector, connection_callback):
+        selector.register(self.socket, selectors.EVENT_READ,
+                          lambda mask: self._accept(connection_callback))
+
+    # accepts every pending connection and returns each one in callback.
+    # the listening socket is level triggered, so anything left in the backlog
+    # will be picked up on the next pass of the event loop.
+    def _accept(self, callback):
+        while True:
+            try:
+                c, a = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            c.setblocking(0)
+            callback(c, a)
+
+# a client's membership of a lobby, identified by a resumption token.
+# when the connection of the client drops, the session stays in the lobby for
+# RESUME_TIMEOUT seconds and keeps the messages broadcast to the lobby, so the
+# client can reconnect and resume it without joining again.
+# the token ends with the lobby id, so a sharded server can route it.
+class Session:
+    def __init__(self, lobby, client):
+        self.token = f"{secrets.token_hex(16)}.{lobby.id}"
+        self.lobby = lobby
+        self.client = client # None while detached
+        self.detached_at = None
+        self.missed = collections.deque(maxlen=MAX_MISSED_MESSAGES)
+
+# class for keeping clients grouped together and only sending information to
+# other clients in the same lobby.
+class Lobby:
+    def __init__(self, lobby_id, master_client, deletion_callback):
+        self.id = lobby_id # identifier for lobby
+        self.master_client = master_client # client that made lobby
+        # all clients currently in lobby. a dict is used as an ordered set,
+        # so membership and removal are constant time while join order is kept
+        self.clients = {}
+        # sessions of clients that lost their connection, by token
+        self.detached = {}
+        self.deletion_callback = deletion_callback # function to be called when lobby is deleted
+        self.last_activity = time.monotonic() # time of the last join or broadcast
+
+        # add master client to list of clients
+        self.add_client(self.master_client)
+
+    # adds the client to the lobby.
+    # client_in_lobby() should already have been used to prevent duplicates
+    def add_client(self, client):
+        self.clients[client] = None
+        client.current_lobby = self
+        self.broadcast(client, f"{client.address} joined the lobby")
+
+    # removes the client from client list.
+    # will transfer ownership of lobby to next in list.
+    # if there are no other clients in lobby to transfer ownership to,
+    # and no detached sessions waiting to be resumed, lobby will close.
+    def remove_client(self, client):
+        self.clients.pop(client, None)
+        client.current_lobby = None
+
+        # there are more clients in lobby
+        if (len(self.clients) > 0):
+            self.master_client = next(iter(self.clients))
+
+        # no other client in lobby
+        elif not (self.detached):
+            self.deletion_callback(self)
+
+    # removes a client that lost its connection, keeping its session so it
+    # can be resumed. broadcasts are kept for the session until then.
+    def detach(self, client):
+        session = client.session
+        session.client = None
+        session.detached_at = time.monotonic()
+        self.detached[session.token] = session
+        self.remove_client(client)
+
+    # puts the client back in the lobby in place of the detached session and
+    # sends it everything it has missed
+    def reattach(self, session, client):
+        self.detached.pop(session.token, None)
+        session.client = client
+        session.detached_at = None
+        client.session = session
+        self.clients[client] = None
+        client.current_lobby = self
+        if (self.master_client not in self.clients):
+            self.master_client = client
+
+        for message in session.missed:
+            if (isinstance(message, str) or client.framed):
+                client.send_message(MessageType.MESSAGE, message)
+        session.missed.clear()
+
+    # drops a detached session that was never resumed
+    def expire(self, session):
+        self.detached.pop(session.token, None)
+        if not (self.clients or self.detached):
+            self.deletion_callback(self)
+
+    # sends a message to all the clients in the lobby except for the sender.
+    # the message is encoded once for each protocol in use and the same bytes
+    # are queued to every client speaking it.
+    # messages of bytes are only sent to framed clients, legacy clients can
+    # only read text. legacy_only sends the message to the legacy clients
+    # alone, which is how framed clients reach them alongside an event.
+    def broadcast(self, sender, message, legacy_only=False):
+        start = time.monotonic()
+        self.last_activity = start
+        encoded = {}
+        text = isinstance(message, str)
+        for client in self.clients:
+            if (client is sender or (client.framed and legacy_only)
+                    or not (text or client.framed)):
+                continue
+            data = encoded.get(client.framed)
+            if (data is None):
+                data = encode_message(client.framed, MessageType.MESSAGE, message)
+                encoded[client.framed] = data
+            client.send_data(data)
+        # only framed clients have sessions to resume
+        if not (legacy_only):
+            for session in self.detached.values():
+                session.missed.append(message)
+        broadcast_latency.observe(time.monotonic() - start)
+        broadcast_fanout.observe(len(self.clients) - 1)
+
+    # compares the client passed to method with all clients connected to this room.
+    # return bool indicating whether client is found
+    def client_in_lobby(self, client):
+        if client in self.clients:
+            return True
+        return False
+
+# frame type used for each message type when talking to a framed client
+FRAME_TYPES = {
+    MessageType.RESPONSE: FrameType.RESPONSE,
+    MessageType.MESSAGE: FrameType.MESSAGE
+}
+
+# returns the bytes of a message for a framed or legacy client.
+# framed clients get the message as a single frame, while legacy clients
+# get the data type of message content as prefix.
+# for legacy clients, using the char "|" in content will break parsing.
+# request_id is only sent to framed clients, legacy clients rely on responses
+# arriving in the same order as their commands.
+def encode_message(framed, message_type, message_content, request_id=NO_REQUEST):
+    if (framed):
+        return encode_frame(FRAME_TYPES[message_type], message_content, request_id)
+    data_type = type(message_content).__name__
+    return str.encode(f"{message_type}|{data_type}|{message_content}")
+
+# class for interfacing with a connection.
+# the client never blocks: incoming data is read when the selector reports the
+# connection as readable, and outgoing data is queued and written whenever the
+# connection is writable.
+# slow_consumer_callback is called when the client has fallen too far behind
+# on reading what is sent to it and should be disconnected.
+class Client:
+    def __init__(self, connection, address, selector, slow_consumer_callback=None):
+        self.connection = connection
+        self.address = address
+        self.current_lobby = None
+        self.session = None # session of the client in its current lobby
+        self.selector = selector
+        self.slow_consumer_callback = slow_consumer_callback
+        self.closed = False
+        # set once the client has fallen too far behind, nothing more is
+        # queued for it until it is disconnected
+        self.slow = False
+
+        # liveness. clients that have sent a heartbeat are expected to keep
+        # sending them and are disconnected when they go quiet
+        self.connected_at = time.monotonic()
+        self.last_seen = self.connected_at
+        self.heartbeats = False
+
+        # data waiting to be written to the client. the buffers are queued as
+        # they are, so a broadcast shares its bytes between all recipients
+        self.out_queue = collections.deque()
+        self.out_size = 0
+        self.events = selectors.EVENT_READ # events the selector watches for
+
+        # protocol is decided by the first bytes the client sends.
+        # None until then, True for framed clients and False for legacy clients
+        self.framed = None
+        self.decoder = FrameDecoder()
+        self.handshake_buffer = bytearray()
+
+        # workers of a sharded server check every frame for commands about a
+        # lobby of another worker. the data from the first such frame on is
+        # kept in handoff_data, for the connection to be handed back.
+        self.route_check = None
+        self.handoff_data = None
+
+    # called by the event loop when the connection has events ready.
+    # will trigger message callback when data is recieved.
+    # calls disconnect_callback when the connection is closed or reset.
+    def on_ready(self, mask, message_callback, disconnect_callback):
+        if (mask & selectors.EVENT_READ):
+            try:
+                data = self.connection.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                data = None
+            except OSError:
+                disconnect_callback(self)
+                return
+
+            # an empty read means the peer closed its end of the connection
+            if (data == b''):
+                disconnect_callback(self)
+                return
+            if (data):
+                self.receive(data, message_callback, disconnect_callback)
+
+        if (mask & selectors.EVENT_WRITE and not self.closed):
+            self._flush(disconnect_callback)
+
+    # handles data read from the client, or handed over together with the connection
+    def receive(self, data, message_callback, disconnect_callback):
+        bytes_in.inc(len(data))
+        self.last_seen = time.monotonic()
+        try:
+            messages = self._read_messages(data)
+        except ValueError:
+            # the stream could not be decoded, nothing more can be trusted
+            disconnect_callback(self)
+            return
+        for message in messages:
+            message_callback(message)
+
+    # returns a list of the messages contained in the data read from the client.
+    # framed clients can send any number of commands, or parts of them, in one read.
+    # legacy clients are expected to send exactly one command per read.
+    def _read_messages(self, data):
+        if (self.framed is None):
+            data = self._negotiate(data)
+            if (data is None):
+                return []
+
+        if not (self.framed):
+            if (self.route_check is not None
+                    and self.route_check([data.decode("utf-8", "replace")])):
+                self.handoff_data = data
+                return []
+            return [NetworkMessage(self, data, NO_REQUEST)]
+
+        # frames holding content a well behaved client never sends raise
+        # ProtocolError, which disconnects the client
+        messages = []
+        frames = self.decoder.feed(data)
+        for index, (frame_type, request_id, content) in enumerate(frames):
+            commands = frame_commands(frame_type, content)
+            if (self.route_check is not None and self.route_check(commands)):
+                # this frame and everything after it go to the worker owning
+                # the lobby, the messages before it are still handled here
+                self.handoff_data = b"".join(encode_frame(frame_type, content, request_id)
+                                             for frame_type, request_id, content in frames[index:])
+                self.handoff_data += self.decoder.take_pending()
+                break
+
+            if (frame_type == FrameType.COMMAND):
+                messages.append(NetworkMessage(self, content, request_id))
+
+            elif (frame_type == FrameType.PING):
+                self.heartbeats = True
+                self._queue(encode_frame(FrameType.PONG, None, request_id))
+
+            elif (frame_type == FrameType.EVENT):
+                if not (isinstance(content, bytes)):
+                    raise ProtocolError("event is not bytes")
+                messages.append(NetworkMessage(self, ServerCommands.LOBBY_EVENT, request_id,
+                                               payload=content))
+
+            # every command of a batch is handled on its own, but they are
+            # answered together with one response
+            elif (frame_type == FrameType.BATCH and commands):
+                batch = BatchResponse(self, request_id, len(commands))
+                for command in commands:
+                    messages.append(NetworkMessage(self, command, request_id, batch))
+        return messages
+
+    # decides which protocol the client speaks from the first bytes it sends.
+    # framed clients start with the handshake, which is echoed back to confirm
+    # that the server supports it. returns the data following the handshake,
+    # or None if more bytes are needed to decide.
+    def _negotiate(self, data):
+        self.handshake_buffer += data
+        if not (self.handshake_buffer.startswith(HANDSHAKE[:1])):
+            self.framed = False
+            data = bytes(self.handshake_buffer)
+            self.handshake_buffer.clear()
+            return data
+
+        if (len(self.handshake_buffer) < len(HANDSHAKE)):
+            return None
+        if not (self.handshake_buffer.startswith(HANDSHAKE)):
+            raise ValueError("invalid handshake")
+
+        self.framed = True
+        self._queue(HANDSHAKE)
+        data = bytes(self.handshake_buffer[len(HANDSHAKE):])
+        self.handshake_buffer.clear()
+        return data
+
+    # sends a message to the client.
+    # type of message distinguises from a server message and lobby message.
+    def send_message(self, message_type, message_content, request_id=NO_REQUEST):
+        self._queue(encode_message(self.framed, message_type, message_content, request_id))
+
+    # sends data already encoded for the protocol of this client
+    def send_data(self, data):
+        self._queue(data)
+
+    # adds data to the outgoing queue and attempts to write it straight away.
+    # anything the socket can not take right now is written once the selector
+    # reports the connection as writable again.
+    # the client is reported as a slow consumer when too much is already
+    # waiting. from then on all data for it is dropped, as skipping a frame
+    # and sending the ones after it would corrupt the stream.
+    def _queue(self, data):
+        if (self.closed or self.slow):
+            return
+        if (self.out_size + len(data) > MAX_QUEUED_BYTES):
+            self.slow = True
+            if (self.slow_consumer_callback):
+                self.slow_consumer_callback(self)
+            return
+        self.out_queue.append(data)
+        self.out_size += len(data)
+        self._flush()
+
+    # writes as much of the outgoing queue as the socket will accept and only
+    # listens for write events while there is data left over.
+    def _flush(self, disconnect_callback=None):
+        try:
+            while (self.out_queue):
+                data = self.out_queue[0]
+                sent = self.connection.send(data)
+                self.out_size -= sent
+                bytes_out.inc(sent)
+                if (sent < len(data)):
+                    # keep the rest without copying it
+                    self.out_queue[0] = memoryview(data)[sent:]
+                    break
+                self.out_queue.popleft()
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            # the connection is gone. the read side will report the disconnect
+            # unless we were called from the event loop with a callback
+            self.out_queue.clear()
+            self.out_size = 0
+            if (disconnect_callback):
+                disconnect_callback(self)
+            return
+
+        # stop reading commands while the client is not reading our responses
+        events = 0 if self.out_size > PAUSE_READING_BYTES else selectors.EVENT_READ
+        if (self.out_queue):
+            events |= selectors.EVENT_WRITE
+        if (events != self.events and not self.closed):
+            self.events = events
+            key = self.selector.get_key(self.connection)
+            self.selector.modify(self.connection, events, key.data)
+
+    # stops watching the connection and closes it
+    def close(self):
+        if (self.closed):
+            return
+        self.closed = True
+        try:
+            self.selector.unregister(self.connection)
+        except (KeyError, ValueError):
+            pass
+        self.connection.close()
+
+    # returns the reason the client should be reaped, or None if it is alive
+    def dead_reason(self, now):
+        if (self.framed is None and self.handshake_buffer
+                and now - self.connected_at > NEGOTIATION_TIMEOUT):
+            return "negotiation_timeout"
+        if (self.heartbeats and now - self.last_seen > HEARTBEAT_TIMEOUT):
+            return "heartbeat_timeout"
+        return None
+
+    # determines if the client is in a lobby and returns result as bool
+    def in_lobby(self):
+        if (self.current_lobby != None):
+            return True
+        return False
+
+# main class for the server.
+# when running as a worker of a sharded server, shard is the WorkerShard the
+# connections are handed over through, and no socket is created.
+class Server:
+    def __init__(self, host, port, is_verbose=False, shard=None, metrics_port=None):
+        # set extra info flag
+        self.verbose = is_verbose
+        self.shard = shard
+
+        # all sockets are multiplexed on a single selector (epoll on linux),
+        # so the whole server runs on one thread
+        self.selector = selectors.DefaultSelector()
+
+        # create socket and start listening for connections
+        if (shard is None):
+            self.socket = Socket(host, port)
+            self.socket.accept_connections(self.selector, self._on_new_connection)
+            self._log("Created a socket on %s", (host, port))
+        else:
+            self.selector.register(shard.channel, selectors.EVENT_READ, self._on_handover)
+            self._log("Started worker %s", shard.index)
+
+        # create master set of all clients connected to the server
+        self.client_list = set()
+
+        # clients found to be too slow while sending to them. they are
+        # disconnected after the current events are handled, as they may have
+        # been found while going through the clients of their lobby
+        self.slow_consumers = set()
+        self.next_reap = time.monotonic() + REAP_INTERVAL
+
+        # index of all the lobbies currently active by their id.
+        # insertion ordered, so paging through the lobby list is stable
+        self.lobbies = {}
+
+        # sessions of clients in lobbies by their token, including detached ones
+        self.sessions = {}
+
+        # handlers of the commands clients can send, by prefix
+        self.commands = CommandRegistry()
+        self._register_commands()
+
+        servers.add(self)
+        if (metrics_port is not None):
+            MetricsEndpoint("127.0.0.1", metrics_port).serve(self.selector)
+            self._log("Serving metrics on port %s", metrics_port)
+
+    # runs the event loop. waits for any socket to become ready and calls the
+    # callback it was registered with. idle connections cost nothing here,
+    # as the thread sleeps in select() until there is something to do.
+    # wakes up at least every REAP_INTERVAL to run the reaper.
+    def serve_forever(self):
+        while True:
+            for key, mask in self.selector.select(REAP_INTERVAL):
+                key.data(mask)
+            while (self.slow_consumers):
+                self._on_disconnect(self.slow_consumers.pop())
+
+            now = time.monotonic()
+            if (now >= self.next_reap):
+                self._reap(now)
+                self.next_reap = now + REAP_INTERVAL
+
+    # disconnects clients that have stopped answering and deletes lobbies
+    # nobody has used for LOBBY_IDLE_TIMEOUT. peers that vanished without
+    # sending heartbeats are found by tcp keepalive, which makes their
+    # connection report an error.
+    def _reap(self, now):
+        for client in [client for client in self.client_list if client.dead_reason(now)]:
+            reason = client.dead_reason(now)
+            reaped_total.inc(reason)
+            self._log("Reaping %s: %s", client.address, reason)
+            self._on_disconnect(client)
+
+        for session in [session for session in self.sessions.values()
+                        if session.detached_at is not None
+                        and now - session.detached_at > RESUME_TIMEOUT]:
+            reaped_total.inc("session_timeout")
+            self._expire_session(session)
+
+        for lobby in [lobby for lobby in self.lobbies.values()
+                      if now - lobby.last_activity > LOBBY_IDLE_TIMEOUT]:
+            reaped_total.inc("lobby_idle")
+            self._log('Lobby "%s" has been abandoned', lobby.id)
+            for client in list(lobby.clients):
+                self._leave_lobby(client)
+            for session in list(lobby.detached.values()):
+                self._expire_session(session)
+
+    # callback when a new connection is established to the socket
+    # will create a new client object and register it with the selector
+    # stores the client in the master list
+    # framed and initial_data are given for connections handed over by the
+    # acceptor of a sharded server, which has already negotiated the protocol.
+    def _on_new_connection(self, connection, address, framed=None, initial_data=b""):
+        self._log("Got a new connection from %s", address)
+        connections_total.inc()
+        enable_keepalive(connection)
+        # messages are small and written as soon as they are ready, so they
+        # must not wait for the acknowledgement of the previous one
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        new_client = Client(connection, address, self.selector, self._on_slow_consumer)
+        new_client.framed = framed
+        if (self.shard is not None):
+            new_client.route_check = self.shard.routes_elsewhere
+        self.client_list.add(new_client)
+        self.selector.register(connection, selectors.EVENT_READ,
+                               lambda mask: self._on_client_ready(new_client, mask))
+        if (initial_data):
+            self._on_client_ready(new_client, initial_data=initial_data)
+
+    # handles events of a client, or data handed over with its connection.
+    # every client shares the thread of the server, so an error handling the
+    # data of one client only disconnects that client.
+    def _on_client_ready(self, client, mask=0, initial_data=b""):
+        try:
+            if (initial_data):
+                client.receive(initial_data, self._on_message, self._on_disconnect)
+            else:
+                client.on_ready(mask, self._on_message, self._on_disconnect)
+        except Exception as e:
+            client_errors_total.inc()
+            self._log("Error handling %s, disconnecting: %r\n%s", client.address, e,
+                      traceback.format_exc())
+            self._on_disconnect(client)
+            return
+        if (client.handoff_data is not None and not client.closed):
+            self._hand_back(client)
+
+    # hands a client that wants a lobby of another worker back to the acceptor
+    # of the sharded server, which routes it to the worker owning the lobby.
+    # the client leaves its lobby here, as it would when moving to another.
+    def _hand_back(self, client):
+        # responses still queued have to reach the client before the other
+        # worker starts answering it
+        try:
+            client.connection.setblocking(True)
+            client.connection.settimeout(HAND_BACK_TIMEOUT)
+            while (client.out_queue):
+                client.connection.sendall(client.out_queue.popleft())
+            self.shard.hand_back(client.connection, client.address, client.framed,
+                                 client.handoff_data)
+        except OSError as e:
+            self._log("Could not hand %s back to the acceptor: %s", client.address, e)
+            self._on_disconnect(client)
+            return
+
+        handbacks_total.inc()
+        self._log("Handed %s back to the acceptor", client.address)
+        self._leave_lobby(client)
+        client.close()
+        self.client_list.discard(client)
+
+    # called when the acceptor of a sharded server has handed over a connection
+    # or passed on a lobby of another worker. the worker shuts down with the
+    # acceptor.
+    def _on_handover(self, mask):
+        try:
+            handover = self.shard.receive_connection()
+        except EOFError:
+            raise SystemExit(f"worker {self.shard.index} lost its acceptor")
+        if (handover is not None):
+            self._on_new_connection(*handover)
+
+    # called when a client has sent a message to the server.
+    # all messages to be recieved from a client will be in the form of a command.
+    # commands are in the format: COMMAND OPT_ARG1, OPT_ARG2, ...
+    # the command is passed on to the handler registered for its prefix.
+    def _on_message(self, message):
+        command = Command(message.content)
+        entry = self.commands.get(command.prefix)
+
+        # UNKNOWN COMMAND
+        if (entry is None):
+            messages_total.inc("unknown")
+            message.respond("unknown_command")
+            self._log("%s requested unknown command: %s", message.sender.address, command.prefix)
+            return
+
+        messages_total.inc(command.prefix)
+        handler, min_args = entry
+        if (min_args and len(command.args) < min_args):
+            self._log("%s sent %s without enough arguments", message.sender.address, command.prefix)
+            message.respond(False)
+            return
+        handler(message, command)
+
+    # registers the handlers of the built in commands
+    def _register_commands(self):
+        self.commands.register(ServerCommands.LOBBY_LIST, self._lobby_list)
+        self.commands.register(ServerCommands.CREATE_LOBBY, self._create_lobby, min_args=1)
+        self.commands.register(ServerCommands.JOIN_LOBBY, self._join_lobby, min_args=1)
+        self.commands.register(ServerCommands.LOBBY_BROADCAST, self._lobby_broadcast, min_args=1)
+        self.commands.register(ServerCommands.LEGACY_BROADCAST, self._legacy_broadcast,
+                               min_args=1)
+        self.commands.register(ServerCommands.LOBBY_EVENT, self._lobby_event)
+        self.commands.register(ServerCommands.RESUME_TOKEN, self._resume_token)
+        self.commands.register(ServerCommands.RESUME, self._resume, min_args=1)
+
+    # imports the module with the given name and calls its register(server)
+    # function, which can add commands through server.commands.register()
+    def load_plugin(self, module_name):
+        plugin = importlib.import_module(module_name)
+        plugin.register(self)
+        self._log("Loaded plugin %s", module_name)
+
+    # LOBBY LIST
+    # takes an optional page number and page size: lobby_list [page] [size]
+    def _lobby_list(self, message, command):
+        self._log("%s requested lobby list", message.sender.address)
+        args = command.args
+        try:
+            page = max(int(args[0]), 0) if len(args) > 0 else 0
+            page_size = int(args[1]) if len(args) > 1 else LOBBY_PAGE_SIZE
+            page_size = min(max(page_size, 1), LOBBY_PAGE_SIZE)
+        except ValueError:
+            page, page_size = 0, LOBBY_PAGE_SIZE
+        start = page * page_size
+        # workers of a sharded server list the lobbies of every worker
+        lobby_ids = self.lobbies if self.shard is None else self.shard.directory
+        lobbies = list(itertools.islice(lobby_ids, start, start + page_size))
+        message.respond(lobbies)
+
+    # LOBBY CREATION
+    def _create_lobby(self, message, command):
+        lobby_id = command.args[0]
+        if not (self._owns_lobby(lobby_id)):
+            self._log("%s tried to create lobby %s owned by another worker",
+                      message.sender.address, lobby_id)
+            message.respond(False)
+
+        elif not (self._is_lobby(lobby_id)):
+            self._leave_lobby(message.sender)
+            new_lobby = Lobby(lobby_id, message.sender, self._on_lobby_deletion)
+            self.lobbies[lobby_id] = new_lobby
+            if (self.shard is not None):
+                self.shard.announce(lobby_id, True)
+            self._start_session(message.sender)
+            self._log("%s created lobby with id: %s", message.sender.address, lobby_id)
+            message.respond(True)
+
+        # lobby already exists
+        else:
+            self._log("%s failed to create lobby with id: %s", message.sender.address, lobby_id)
+            message.respond(False)
+
+    # LOBBY JOINING
+    def _join_lobby(self, message, command):
+        lobby_id = command.args[0]
+        desired_lobby = self._get_lobby_by_id(lobby_id)
+        if not (self._owns_lobby(lobby_id)):
+            self._log("%s tried to join lobby %s owned by another worker",
+                      message.sender.address, lobby_id)
+            message.respond(False)
+
+        elif (desired_lobby is not None):
+            # check that client is not already in the lobby
+            if not (desired_lobby.client_in_lobby(message.sender)):
+                self._leave_lobby(message.sender)
+                desired_lobby.add_client(message.sender)
+                self._start_session(message.sender)
+                self._log("%s joined lobby %s", message.sender.address, lobby_id)
+                message.respond(True)
+
+            # client is already in the lobby
+            else:
+                self._log("%s attempted to join lobby it's already in (%s)",
+                          message.sender.address, lobby_id)
+                message.respond(False)
+
+        # lobby does not exist
+        else:
+            self._log("%s attempted to join lobby that does not exist (%s)",
+                      message.sender.address, lobby_id)
+            message.respond(False)
+
+    # LOBBY BROADCAST
+    def _lobby_broadcast(self, message, command, legacy_only=False):
+        msg = command.args[0]
+        # make sure client is in a lobby
+        if (message.sender.in_lobby()):
+            message.sender.current_lobby.broadcast(message.sender, msg, legacy_only)
+            self._log("%s broadcasted %s to lobby %s", message.sender.address, msg,
+                      message.sender.current_lobby.id)
+            message.respond(True)
+
+        # client not in lobby
+        else:
+            self._log("%s tried to broadcast while not in lobby", message.sender.address)
+            message.respond(False)
+
+    # LEGACY BROADCAST
+    # broadcasts to the legacy clients of the lobby only. framed clients send
+    # it together with an event, for the clients that can not read events.
+    def _legacy_broadcast(self, message, command):
+        self._lobby_broadcast(message, command, legacy_only=True)
+
+    # LOBBY EVENT
+    # relays the bytes of an event frame to the rest of the lobby as they are
+    def _lobby_event(self, message, command):
+        if (message.payload is None or not isinstance(message.payload, bytes)):
+            self._log("%s sent an event without a payload", message.sender.address)
+            message.respond(False)
+
+        elif (message.sender.in_lobby()):
+            message.sender.current_lobby.broadcast(message.sender, message.payload)
+            self._log("%s sent an event of %s bytes to lobby %s", message.sender.address,
+                      len(message.payload), message.sender.current_lobby.id)
+            message.respond(True)
+
+        else:
+            self._log("%s tried to send an event while not in lobby", message.sender.address)
+            message.respond(False)
+
+    # RESUME TOKEN
+    # returns the token of the session of the client in its lobby
+    def _resume_token(self, message, command):
+        session = message.sender.session
+        message.respond(session.token if session is not None else False)
+
+    # RESUME
+    # puts the client back in the lobby of the session with the given token,
+    # in place of the connection it was made on, and sends it everything
+    # broadcast to the lobby since that connection dropped.
+    def _resume(self, message, command):
+        session = self.sessions.get(command.args[0])
+        client = message.sender
+        if (session is None):
+            self._log("%s tried to resume an unknown session", client.address)
+            message.respond(False)
+            return
+
+        if (session.client is not client):
+            # the old connection may not have been noticed as gone yet
+            if (session.client is not None):
+                self._on_disconnect(session.client)
+            self._leave_lobby(client)
+            session.lobby.reattach(session, client)
+            resumes_total.inc()
+            self._log("%s resumed its session in lobby %s", client.address, session.lobby.id)
+        message.respond(True)
+
+    # called when a client has disconnected from server
+    def _on_disconnect(self, client):
+        if (client.closed):
+            return
+        client.close()
+        disconnects_total.inc()
+        self._log("%s disconnected from server", client.address)
+
+        # keep the place of the client in its lobby, so it can resume it
+        if (client.in_lobby() and client.session is not None):
+            client.current_lobby.detach(client)
+        else:
+            self._leave_lobby(client)
+
+        # remove client from master client list
+        self.client_list.discard(client)
+
+    # removes the client from its lobby, if it is in one, ending its session.
+    # a client is only ever in one lobby, so it leaves its old lobby when it
+    # creates or joins another
+    def _leave_lobby(self, client):
+        if (client.session is not None):
+            self.sessions.pop(client.session.token, None)
+            client.session = None
+        if (client.in_lobby()):
+            client.current_lobby.remove_client(client)
+
+    # issues a session for the client in the lobby it has just entered.
+    # legacy clients can not resume, so they get no session and leave the
+    # lobby as soon as they disconnect.
+    def _start_session(self, client):
+        if not (client.framed):
+            return
+        client.session = Session(client.current_lobby, client)
+        self.sessions[client.session.token] = client.session
+
+    # drops a detached session that was not resumed in time
+    def _expire_session(self, session):
+        self.sessions.pop(session.token, None)
+        session.lobby.expire(session)
+
+    # called when a client has too much data waiting to be written to it
+    def _on_slow_consumer(self, client):
+        if (client.closed or client in self.slow_consumers):
+            return
+        slow_consumers_total.inc()
+        self.slow_consumers.add(client)
+        self._log("%s is too slow to keep up and will be disconnected", client.address)
+
+    # called when a lobby has no more clients in it
+    def _on_lobby_deletion(self, lobby):
+        self.lobbies.pop(lobby.id, None)
+        if (self.shard is not None):
+            self.shard.announce(lobby.id, False)
+        self._log('Lobby "%s" has been deleted due to no clients in it', lobby.id)
+
+    # prints the message to console if verbose is enabled.
+    # the message is only formatted with args when it is printed, so logging
+    # costs next to nothing while verbose is disabled.
+    def _log(self, message, *args):
+        if (self.verbose):
+            time_stamp = datetime.now().strftime("%H:%M:%S")
+            print(f"[{time_stamp}]: {message % args if args else message}")
+
+    # determines if there is an active lobby with the given id.
+    def _is_lobby(self, lobby_id):
+        return lobby_id in self.lobbies
+
+    # determines if lobbies with the given id belong to this server.
+    # always true unless this is a worker of a sharded server.
+    def _owns_lobby(self, lobby_id):
+        return self.shard is None or self.shard.owns(lobby_id)
+
+    # returns a reference to the lobby with the given id, or None if there is none
+    def _get_lobby_by_id(self, lobby_id):
+        return self.lobbies.get(lobby_id)
+
+if __name__ == '__main__':
+    # argument parsing
+    parser = argparse.ArgumentParser()
+    parser.add_argument('host', type=str, help="The address to listen on")
+    parser.add_argument('port', type=int, help="The port to listen on")
+    parser.add_argument('--verbal', action='store_true', help="Server logs more information")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of worker processes to shard the lobbies over")
+    parser.add_argument('--plugin', action='append', default=[],
+                        help="Module adding commands to the server, can be given several times")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="Serve metrics on this local port. Workers of a sharded server "
+                             "use the following ports, one each")
+    arguments = parser.parse_args()
+
+    def create_server(host, port, shard=None):
+        metrics_port = arguments.metrics_port
+        if (metrics_port is not None and shard is not None):
+            metrics_port += shard.index
+        server = Server(host, port, arguments.verbal, shard, metrics_port)
+        for module_name in arguments.plugin:
+            server.load_plugin(module_name)
+        return server
+
+    if (arguments.workers > 1):
+        import sharding
+        sharding.serve_sharded(arguments.host, arguments.port, arguments.workers,
+                               lambda shard: create_server(None, None, shard), arguments.verbal)
+    else:
+        create_server(arguments.host, arguments.port).serve_forever()
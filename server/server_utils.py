@@ -1,26 +1,124 @@
-# Contains multiple methods and classes for the server that is too
-# small or simply makes the main script more organized by keeping them here.
-
-class NetworkMessage:
-    def __init__(self, sender, content):
-        from datetime import datetime
-
-        self.sender = sender
-        self.content = content.decode('utf-8')
-        self.time_stamp = datetime.now().strftime("%H:%M:%S")
-
-class Command:
-    def __init__(self, content):
-        content = content.split(" ")
-        self.prefix = content[0]
-        self.args = content[1:]
-
-class ServerCommands:
-    LOBBY_LIST = "lobby_list"
-    CREATE_LOBBY = "create_lobby"
-    JOIN_LOBBY = "join_lobby"
-    LOBBY_BROADCAST = "lobby_broadcast"
-
-class MessageType:
-    RESPONSE = "response"
-    MESSAGE = "message"
+# Contains multiple methods and classes for the server that is too
+# small or simply makes the main script more organized by keeping them here.
+
+import time
+import socket
+from datetime import datetime
+
+# tcp keepalive, so the kernel finds peers that disappeared without closing
+# their connection, also for clients that do not send heartbeats.
+# a silent peer is probed after KEEPALIVE_IDLE seconds and dropped after
+# KEEPALIVE_COUNT unanswered probes KEEPALIVE_INTERVAL seconds apart.
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
+# turns on tcp keepalive for the connection, with the timings above where
+# the platform allows setting them
+def enable_keepalive(connection):
+    connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+                          ("TCP_KEEPCNT", KEEPALIVE_COUNT)):
+        if (hasattr(socket, option)):
+            connection.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+# a command received from a client.
+# slotted, as one is created for every command the server handles.
+class NetworkMessage:
+    __slots__ = ("sender", "content", "request_id", "batch", "payload", "received_at")
+
+    # payload holds the bytes of an event, which are relayed without decoding
+    def __init__(self, sender, content, request_id=0, batch=None, payload=None):
+        self.sender = sender
+        self.request_id = request_id
+        self.batch = batch
+        self.payload = payload
+        # framed clients deliver commands already decoded
+        if (isinstance(content, bytes)):
+            content = content.decode('utf-8')
+        self.content = content
+        self.received_at = time.time()
+
+    # time the message was received, only formatted when asked for
+    @property
+    def time_stamp(self):
+        return datetime.fromtimestamp(self.received_at).strftime("%H:%M:%S")
+
+    # sends the response to this message back to the sender.
+    # framed clients get the request id back so they can match it to the request.
+    # commands that arrived in a batch are answered together by the batch.
+    def respond(self, content):
+        if (self.batch is not None):
+            self.batch.add_result(content)
+        else:
+            self.sender.send_message(MessageType.RESPONSE, content, self.request_id)
+
+# collects the responses to the commands of a batch and sends them back as a
+# single response once every command has been answered.
+class BatchResponse:
+    __slots__ = ("sender", "request_id", "size", "results")
+
+    def __init__(self, sender, request_id, size):
+        self.sender = sender
+        self.request_id = request_id
+        self.size = size
+        self.results = []
+
+    def add_result(self, content):
+        self.results.append(content)
+        if (len(self.results) == self.size):
+            self.sender.send_message(MessageType.RESPONSE, self.results, self.request_id)
+
+# a command in the format: COMMAND ARG1 ARG2 ...
+# only the prefix is split off up front, as that is all dispatching needs.
+# the arguments are split the first time they are used, so unknown commands
+# and handlers that ignore their arguments never pay for it.
+class Command:
+    __slots__ = ("prefix", "_rest", "_args")
+
+    def __init__(self, content):
+        self.prefix, separator, self._rest = content.partition(" ")
+        self._args = None if separator else []
+
+    @property
+    def args(self):
+        if (self._args is None):
+            self._args = self._rest.split(" ")
+        return self._args
+
+# maps command prefixes to the functions handling them.
+# handlers are called with the NetworkMessage and its Command, and answer
+# through message.respond(). commands with fewer than min_args arguments are
+# answered with False without calling the handler.
+class CommandRegistry:
+    def __init__(self):
+        self.handlers = {}
+
+    # registers handler for the prefix, replacing any previous handler.
+    # can be used as a decorator when handler is not given.
+    def register(self, prefix, handler=None, min_args=0):
+        if (handler is None):
+            return lambda handler: self.register(prefix, handler, min_args)
+        self.handlers[prefix] = (handler, min_args)
+        return handler
+
+    # returns (handler, min_args) for the prefix, or None for unknown commands
+    def get(self, prefix):
+        return self.handlers.get(prefix)
+
+    def __contains__(self, prefix):
+        return prefix in self.handlers
+
+class ServerCommands:
+    LOBBY_LIST = "lobby_list"
+    CREATE_LOBBY = "create_lobby"
+    JOIN_LOBBY = "join_lobby"
+    LOBBY_BROADCAST = "lobby_broadcast"
+    LEGACY_BROADCAST = "legacy_broadcast"
+    LOBBY_EVENT = "lobby_event"
+    RESUME_TOKEN = "resume_token"
+    RESUME = "resume"
+
+class MessageType:
+    RESPONSE = "response"
+    MESSAGE = "message"
@@ -0,0 +1,447 @@
+# Runs the server as several worker processes, each owning a shard of the lobbies.
+#
+# Lobbies never talk to each other, so they can be spread over processes to get
+# around the GIL. Lobby ids are mapped to workers with a consistent hash ring.
+# A front acceptor process accepts every connection, reads just enough of it to
+# find out which lobby the client is about to create or join, and hands the
+# connection over to the worker owning that lobby by passing its file
+# descriptor over a unix socket, together with the bytes already read.
+# From then on the client talks to the worker directly, the acceptor never
+# sees any more of its traffic.
+#
+# Clients can ask for the lobby list, or move to another lobby, long after
+# they were routed. A worker that is asked to create, join or resume a lobby
+# it does not own hands the connection back to the acceptor, together with
+# the frames it has not handled yet, and the acceptor routes it again.
+#
+# Every worker keeps a directory of the lobbies of all workers, so the lobby
+# list is the same wherever it is asked for. Workers announce the lobbies they
+# create and delete, and the acceptor passes the announcements on to the
+# other workers.
+#
+# Only available on unix systems, as it relies on passing file descriptors.
+import os
+import sys
+import time
+import json
+import signal
+import collections
+import struct
+import socket
+import bisect
+import hashlib
+import selectors
+import multiprocessing
+from protocol import HANDSHAKE, FrameDecoder, FrameType, ProtocolError, frame_commands
+from server_utils import Command, ServerCommands, enable_keepalive
+
+# number of points every shard gets on the hash ring
+RING_REPLICAS = 64
+
+# largest amount of data the acceptor reads from a client before giving up
+# on finding out where it belongs
+MAX_ROUTING_BYTES = 64 * 1024
+
+# seconds a connection may wait in the acceptor for a frame to route it by.
+# connections that have not finished the handshake by then are dropped, the
+# rest are handed to a worker by address, which keeps silent legacy clients
+# the same way an unsharded server does. the acceptor checks every
+# ROUTING_CHECK_INTERVAL seconds.
+ROUTING_TIMEOUT = 10
+ROUTING_CHECK_INTERVAL = 1
+
+HANDOFF_HEADER = struct.Struct("!I")
+
+# stable hash of a key, the same in every process unlike hash()
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+# consistent hash ring mapping keys to shard numbers.
+# adding or removing a shard only moves the keys next to its points.
+class ShardRing:
+    def __init__(self, shards, replicas=RING_REPLICAS):
+        self.shards = shards
+        points = sorted((_hash(f"shard-{shard}-{i}"), shard)
+                        for shard in range(shards) for i in range(replicas))
+        self._hashes = [point for point, shard in points]
+        self._shards = [shard for point, shard in points]
+
+    def shard_for(self, key):
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._shards[index]
+
+# returns the id of the lobby the command is about, or None.
+# resumed sessions belong to the lobby their token ends with.
+def lobby_key(command):
+    if (command.prefix in (ServerCommands.CREATE_LOBBY, ServerCommands.JOIN_LOBBY)
+            and command.args):
+        return command.args[0]
+    if (command.prefix == ServerCommands.RESUME and command.args):
+        return command.args[0].partition(".")[2]
+    return None
+
+# returns the id of the first lobby named by the commands, or None.
+# the acceptor and the workers both route a frame by it, so a connection
+# handed back by a worker never ends up with that worker again.
+def first_lobby_key(commands):
+    for command in commands:
+        key = lobby_key(Command(command))
+        if (key is not None):
+            return key
+    return None
+
+# returns the key a connection should be routed by from its first commands.
+# commands that name a lobby are routed to the worker owning the lobby.
+# anything else is spread over the workers by the address of the client.
+def routing_key(commands, address):
+    key = first_lobby_key(commands)
+    if (key is None):
+        return f"{address[0]}:{address[1]}"
+    return key
+
+# announcement of a lobby created or deleted by a worker, passed on to the
+# other workers by the acceptor
+class LobbyUpdate:
+    def __init__(self, lobby_id, active):
+        self.lobby_id = lobby_id
+        self.active = active
+
+    def encode(self):
+        return json.dumps({"lobby": self.lobby_id, "active": self.active}).encode()
+
+# packs a connection handed between the acceptor and a worker into the
+# message sent along with its file descriptor
+def _pack_handoff(address, framed, data):
+    header = json.dumps({"address": list(address), "framed": framed}).encode()
+    return HANDOFF_HEADER.pack(len(header)) + header + bytes(data)
+
+# receives a message from the channel. returns a LobbyUpdate, or
+# (connection, address, framed, data) for a connection handed over with its
+# file descriptor. raises EOFError if the other end is gone.
+def _receive_message(channel):
+    message, fds, flags, address = socket.recv_fds(channel, MAX_ROUTING_BYTES + 4096, 1)
+    if not (message):
+        for fd in fds:
+            os.close(fd)
+        raise EOFError("channel closed")
+    if not (fds):
+        update = json.loads(message)
+        return LobbyUpdate(update["lobby"], update["active"])
+
+    length, = HANDOFF_HEADER.unpack_from(message)
+    header = json.loads(message[HANDOFF_HEADER.size:HANDOFF_HEADER.size + length])
+    data = message[HANDOFF_HEADER.size + length:]
+    connection = socket.socket(fileno=fds[0])
+    connection.setblocking(0)
+    return connection, tuple(header["address"]), header["framed"], data
+
+# the worker side of the channel to the acceptor
+class WorkerShard:
+    def __init__(self, index, ring, channel):
+        self.index = index
+        self.ring = ring
+        self.channel = channel
+        # ids of the lobbies of every worker, in the order they were announced
+        self.directory = {}
+
+    # determines if the lobby with the given id belongs to this worker
+    def owns(self, lobby_id):
+        return self.ring.shard_for(lobby_id) == self.index
+
+    # determines if the commands of a frame belong to a lobby of another worker
+    def routes_elsewhere(self, commands):
+        key = first_lobby_key(commands)
+        return key is not None and not self.owns(key)
+
+    # receives a connection handed over by the acceptor.
+    # returns (connection, address, framed, data), or None if the message was
+    # a lobby announcement of another worker, which is added to the directory.
+    # raises EOFError if the acceptor is gone.
+    def receive_connection(self):
+        message = _receive_message(self.channel)
+        if (isinstance(message, LobbyUpdate)):
+            self._update_directory(message)
+            return None
+        return message
+
+    # tells the other workers about a lobby this worker created or deleted
+    def announce(self, lobby_id, active):
+        update = LobbyUpdate(lobby_id, active)
+        self._update_directory(update)
+        self.channel.send(update.encode())
+
+    def _update_directory(self, update):
+        if (update.active):
+            self.directory[update.lobby_id] = None
+        else:
+            self.directory.pop(update.lobby_id, None)
+
+    # hands a connection back to the acceptor to be routed again, together
+    # with the data the worker has not handled. the caller closes its copy.
+    # raises OSError if the acceptor could not take it.
+    def hand_back(self, connection, address, framed, data):
+        if (len(data) > MAX_ROUTING_BYTES):
+            raise OSError("too much unhandled data to hand back")
+        socket.send_fds(self.channel, [_pack_handoff(address, framed, data)],
+                        [connection.fileno()])
+
+# a connection the acceptor has not routed yet
+class PendingConnection:
+    def __init__(self, connection, address):
+        self.connection = connection
+        self.address = address
+        self.buffer = bytearray()
+        self.framed = None
+        self.waiting_since = time.monotonic()
+
+# accepts connections and hands each one over to the worker that owns its lobby
+class Acceptor:
+    def __init__(self, host, port, channels, ring, is_verbose=False):
+        self.channels = channels
+        self.ring = ring
+        self.verbose = is_verbose
+        self.selector = selectors.DefaultSelector()
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(1000)
+        self.socket.setblocking(0)
+        self.selector.register(self.socket, selectors.EVENT_READ, None)
+        # workers hand connections back and announce lobbies over their channel.
+        # the acceptor never blocks writing to a worker, as the worker may be
+        # blocked writing to the acceptor at the same time. messages a worker
+        # can not take yet wait in its backlog as (message, connection).
+        self.backlogs = {}
+        for channel in channels:
+            channel.setblocking(0)
+            self.selector.register(channel, selectors.EVENT_READ, channel)
+            self.backlogs[channel] = collections.deque()
+
+        # connections not routed yet, oldest first. a dict is used as an
+        # ordered set, so routed connections are removed in constant time
+        self.pending = {}
+
+    def serve_forever(self):
+        while True:
+            for key, mask in self.selector.select(ROUTING_CHECK_INTERVAL):
+                if (key.data is None):
+                    self._accept()
+                elif (isinstance(key.data, PendingConnection)):
+                    self._on_readable(key.data)
+                else:
+                    if (mask & selectors.EVENT_WRITE):
+                        self._flush_channel(key.data)
+                    if (mask & selectors.EVENT_READ):
+                        self._on_channel_readable(key.data)
+            self._route_expired(time.monotonic())
+
+    # routes the connections that have waited longer than ROUTING_TIMEOUT
+    def _route_expired(self, now):
+        for pending in list(self.pending):
+            if (now - pending.waiting_since < ROUTING_TIMEOUT):
+                return
+            if (pending.framed is None and pending.buffer):
+                self._log("%s did not finish the handshake", pending.address)
+                self._drop(pending)
+            else:
+                self._hand_over(pending, [])
+
+    def _wait_for_route(self, pending):
+        self.pending[pending] = None
+        self.selector.register(pending.connection, selectors.EVENT_READ, pending)
+
+    def _accept(self):
+        while True:
+            try:
+                connection, address = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            connection.setblocking(0)
+            enable_keepalive(connection)
+            self._wait_for_route(PendingConnection(connection, address))
+
+    def _on_readable(self, pending):
+        try:
+            data = pending.connection.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+
+        if not (data):
+            self._drop(pending)
+            return
+
+        pending.buffer += data
+        self._route(pending)
+
+    # called when a worker has handed a connection back to be routed again,
+    # or announced a lobby
+    def _on_channel_readable(self, channel):
+        try:
+            message = _receive_message(channel)
+        except (BlockingIOError, InterruptedError):
+            return
+        except (EOFError, OSError):
+            # the worker is gone
+            self._log("Lost a worker")
+            self.selector.unregister(channel)
+            self._drop_backlog(channel)
+            return
+
+        if (isinstance(message, LobbyUpdate)):
+            for other in self.channels:
+                if (other is not channel and other in self.backlogs):
+                    self._send(other, message.encode())
+            return
+
+        connection, address, framed, data = message
+        pending = PendingConnection(connection, address)
+        pending.framed = framed
+        pending.buffer += data
+        self._wait_for_route(pending)
+        self._route(pending)
+
+    # hands the connection over once it is known where it belongs
+    def _route(self, pending):
+        try:
+            commands = self._first_commands(pending)
+        except (ValueError, IndexError):
+            self._drop(pending)
+            return
+
+        if (commands is not None):
+            self._hand_over(pending, commands)
+        elif (len(pending.buffer) > MAX_ROUTING_BYTES):
+            self._drop(pending)
+
+    # returns the commands of the first frame of the connection that is not a
+    # heartbeat, or None if it has not arrived in full yet. heartbeats are
+    # left in the buffer for the worker to answer. answers the handshake of
+    # framed clients, as they wait for it before sending any command.
+    def _first_commands(self, pending):
+        if (pending.framed is False):
+            # legacy clients send one command per write
+            return [pending.buffer.decode("utf-8")]
+
+        if (pending.framed is None):
+            if not (pending.buffer.startswith(HANDSHAKE[:1])):
+                pending.framed = False
+                return [pending.buffer.decode("utf-8")]
+
+            if (len(pending.buffer) < len(HANDSHAKE)):
+                return None
+            if not (pending.buffer.startswith(HANDSHAKE)):
+                raise ProtocolError("invalid handshake")
+
+            pending.framed = True
+            del pending.buffer[:len(HANDSHAKE)]
+            pending.connection.sendall(HANDSHAKE)
+
+        # peek at the frames without consuming them, the worker decodes them again
+        for frame_type, request_id, content in FrameDecoder().feed(bytes(pending.buffer)):
+            if (frame_type == FrameType.PING):
+                continue
+            return frame_commands(frame_type, content)
+        return None
+
+    def _hand_over(self, pending, commands):
+        shard = self.ring.shard_for(routing_key(commands, pending.address))
+        message = _pack_handoff(pending.address, pending.framed, pending.buffer)
+
+        self._stop_waiting(pending)
+        if (self.channels[shard] not in self.backlogs):
+            self._log("Could not hand %s to worker %s, it is gone", pending.address, shard)
+            pending.connection.close()
+            return
+        self._log("Handing %s to worker %s", pending.address, shard)
+        self._send(self.channels[shard], message, pending.connection)
+
+    # writes a message to a worker, after anything already waiting for it.
+    # connection is passed along with the message and closed once sent, as
+    # the worker has its own copy of it then.
+    def _send(self, channel, message, connection=None):
+        backlog = self.backlogs[channel]
+        backlog.append((message, connection))
+        if (len(backlog) == 1):
+            self._flush_channel(channel)
+
+    # writes as much of the backlog of a worker as its channel takes, and
+    # only listens for write events while something is left over
+    def _flush_channel(self, channel):
+        backlog = self.backlogs.get(channel)
+        if (backlog is None):
+            return
+        try:
+            while (backlog):
+                message, connection = backlog[0]
+                if (connection is None):
+                    channel.send(message)
+                else:
+                    socket.send_fds(channel, [message], [connection.fileno()])
+                    connection.close()
+                backlog.popleft()
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            self._log("Could not write to a worker: %s", e)
+            self.selector.unregister(channel)
+            self._drop_backlog(channel)
+            return
+
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if backlog else 0)
+        if (self.selector.get_key(channel).events != events):
+            self.selector.modify(channel, events, channel)
+
+    # forgets a worker that is gone, closing the connections meant for it
+    def _drop_backlog(self, channel):
+        for message, connection in self.backlogs.pop(channel, ()):
+            if (connection is not None):
+                connection.close()
+
+    def _drop(self, pending):
+        self._stop_waiting(pending)
+        pending.connection.close()
+
+    def _stop_waiting(self, pending):
+        del self.pending[pending]
+        self.selector.unregister(pending.connection)
+
+    def _log(self, message, *args):
+        if (self.verbose):
+            print(f"[acceptor]: {message % args if args else message}")
+
+# starts the given number of worker processes and runs the acceptor.
+# server_factory is called in each worker with its WorkerShard and must return
+# a server with a serve_forever() method.
+def serve_sharded(host, port, workers, server_factory, is_verbose=False):
+    ring = ShardRing(workers)
+    context = multiprocessing.get_context("fork")
+    channels = []
+    processes = []
+    for index in range(workers):
+        acceptor_end, worker_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        process = context.Process(target=_run_worker,
+                                  args=(server_factory, WorkerShard(index, ring, worker_end),
+                                        channels + [acceptor_end]),
+                                  daemon=True)
+        process.start()
+        worker_end.close()
+        channels.append(acceptor_end)
+        processes.append(process)
+
+    # make sure the workers are stopped when the acceptor is terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        Acceptor(host, port, channels, ring, is_verbose).serve_forever()
+    finally:
+        for process in processes:
+            process.terminate()
+
+# runs a worker. the acceptor ends of the channels inherited from the parent
+# are closed, so the worker sees its channel close when the acceptor exits.
+def _run_worker(server_factory, shard, inherited_channels):
+    for channel in inherited_channels:
+        channel.close()
+    server_factory(shard).serve_forever()